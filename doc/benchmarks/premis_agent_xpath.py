@@ -0,0 +1,66 @@
+"""Benchmark of reading the identifiers of PREMIS agents.
+
+get_premis_agent_identifiers() reads the type, name and identifier of
+every PREMIS agent of the workspace when the agent index does not
+exist. This compares the precompiled XPath expressions of
+siptools.xml.xpath, used by _agent_identifiers(), with the
+ElementTree find() calls with expression strings that were used
+before.
+
+Run from the root of the repository:
+
+    python doc/benchmarks/premis_agent_xpath.py
+"""
+from __future__ import print_function, unicode_literals
+
+import timeit
+
+import lxml.etree
+
+from siptools.scripts.premis_event import _agent_identifiers
+from siptools.xml.mets import NAMESPACES
+
+ROUNDS = 100000
+REPEAT = 5
+
+AGENT = lxml.etree.fromstring(
+    '<premis:agent xmlns:premis="%s">'
+    '<premis:agentIdentifier>'
+    '<premis:agentIdentifierType>UUID</premis:agentIdentifierType>'
+    '<premis:agentIdentifierValue>ab12</premis:agentIdentifierValue>'
+    '</premis:agentIdentifier>'
+    '<premis:agentName>Demo Application</premis:agentName>'
+    '<premis:agentType>software</premis:agentType>'
+    '</premis:agent>' % NAMESPACES['premis'])
+
+
+def find_agent_identifiers(agent):
+    """Read the identifiers of an agent with find() and expression
+    strings, as before the expressions were precompiled.
+
+    :agent: PREMIS agent element
+    :returns: Same as _agent_identifiers()
+    """
+    agent_type = agent.find("premis:agentType", namespaces=NAMESPACES).text
+    agent_name = agent.find("premis:agentName", namespaces=NAMESPACES).text
+    id_type = agent.find(
+        "premis:agentIdentifier/premis:agentIdentifierType",
+        namespaces=NAMESPACES).text
+    id_value = agent.find(
+        "premis:agentIdentifier/premis:agentIdentifierValue",
+        namespaces=NAMESPACES).text
+    return {(agent_type, agent_name): (id_type, id_value)}
+
+
+def main():
+    """Time both implementations and print the best of the runs."""
+    assert find_agent_identifiers(AGENT) == _agent_identifiers(AGENT)
+    for (name, function) in (('find()', find_agent_identifiers),
+                             ('precompiled', _agent_identifiers)):
+        seconds = min(timeit.repeat(lambda: function(AGENT),
+                                    number=ROUNDS, repeat=REPEAT))
+        print('%-12s %.2f s for %d agents' % (name, seconds, ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
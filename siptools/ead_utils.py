@@ -1,18 +1,24 @@
 """"Utility functions for EAD3 structmap creation."""
 from __future__ import unicode_literals, print_function
 
+import collections
+
 import lxml.etree as ET
 import mets
 from siptools.utils import (add_file_div,
                             add_file_to_filesec,
                             create_filegrp,
-                            get_md_references)
+                            DirectoryReferences)
 from siptools.xml.mets import NAMESPACES
 
 
 ALLOWED_C_SUBS = ['c', 'c01', 'c02', 'c03', 'c04', 'c05', 'c06', 'c07',
                   'c08', 'c09', 'c10', 'c11', 'c12']
 
+EAD3_ARCHDESC = '{%s}archdesc' % NAMESPACES['ead3']
+EAD3_DSC = '{%s}dsc' % NAMESPACES['ead3']
+EAD3_DID = '{%s}did' % NAMESPACES['ead3']
+
 
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-locals
@@ -23,7 +29,8 @@ def compile_ead3_structmap(dmdsec_loc,
                            object_refs,
                            file_properties,
                            supplementary_files,
-                           supplementary_types):
+                           supplementary_types,
+                           directory_references=None):
     """The function creates a METS structMap and fileSec section
     based on EAD3 metadata structure and the files listed in the
     EAD3 metadata.
@@ -42,7 +49,8 @@ def compile_ead3_structmap(dmdsec_loc,
         object_refs=object_refs,
         file_properties=file_properties,
         supplementary_files=supplementary_files,
-        supplementary_types=supplementary_types)
+        supplementary_types=supplementary_types,
+        directory_references=directory_references)
 
     for supplementary_type in supplementary_types:
         (s_filegrp, file_ids) = create_filegrp(
@@ -70,9 +78,15 @@ def _create_structmap(filegrp,
                       object_refs,
                       file_properties,
                       supplementary_files=None,
-                      supplementary_types=None):
+                      supplementary_types=None,
+                      directory_references=None):
     """Create structmap based on ead3 descriptive metadata structure.
 
+    The EAD3 document is not loaded in memory as a whole, but read
+    twice with iterparse: first to find the label of the archdesc
+    element and all dao hrefs, and then to create the divs of the c
+    elements, see _iter_ead3_c_divs().
+
     :param filegrp: fileGrp element
     :param all_amd_refs: XML element tree of administrative metadata
         references
@@ -80,11 +94,13 @@ def _create_structmap(filegrp,
         references
     :param dmdsec_loc: EAD3 descriptive metadata file
     :param structmap_type: TYPE attribute of structMap element
-    :param workspace: Workspace path, required by _ead3_c_div()
+    :param workspace: Workspace path
     :param object_refs: Object references.
     :param file_properties: Dictionary collection of file properties.
     :param supplementary_files: Supplementary files.
     :param supplementary_types: Supplementary types.
+    :param directory_references: DirectoryReferences of all_amd_refs
+        and all_dmd_refs. Will be created if missing.
     :returns: Struct map XML element tree.
     """
     if supplementary_files is None:
@@ -95,33 +111,29 @@ def _create_structmap(filegrp,
     structmap = mets.structmap(type_attr=structmap_type)
     container_div = mets.div(type_attr='logical')
 
-    root = ET.parse(dmdsec_loc).getroot()
-
-    try:
-        label = root.xpath(("//ead3:archdesc/@otherlevel | "
-                            "//ead3:archdesc/@level"),
-                           namespaces=NAMESPACES)[0]
-    except IndexError:
+    (label, has_dsc, hrefs) = _scan_ead3(dmdsec_loc)
+    if label is None:
         label = 'archdesc'
 
-    amdids = get_md_references(all_amd_refs, directory='.')
-    dmdids = get_md_references(all_dmd_refs, directory='.')
+    if directory_references is None:
+        directory_references = DirectoryReferences(all_amd_refs,
+                                                   all_dmd_refs)
+    (amdids, dmdids) = directory_references['.']
 
     div_ead = mets.div(type_attr='archdesc', label=label, dmdid=dmdids,
                        admid=amdids)
 
-    if root.xpath("//ead3:archdesc/ead3:dsc", namespaces=NAMESPACES):
-        for elem in root.xpath("//ead3:dsc/*", namespaces=NAMESPACES):
-            if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
-                _ead3_c_div(parent=elem,
-                            div=div_ead,
-                            filegrp=filegrp,
-                            all_amd_refs=all_amd_refs,
-                            object_refs=object_refs,
-                            supplementary_files=supplementary_files,
-                            supplementary_types=supplementary_types,
-                            file_properties=file_properties,
-                            workspace=workspace)
+    # Find the files of all dao hrefs at once
+    href_paths = match_hrefs(hrefs, file_properties)
+
+    if has_dsc:
+        for c_div in _iter_ead3_c_divs(dmdsec_loc=dmdsec_loc,
+                                       filegrp=filegrp,
+                                       all_amd_refs=all_amd_refs,
+                                       object_refs=object_refs,
+                                       file_properties=file_properties,
+                                       href_paths=href_paths):
+            div_ead.append(c_div)
 
     container_div.append(div_ead)
     structmap.append(container_div)
@@ -130,15 +142,42 @@ def _create_structmap(filegrp,
     return ET.ElementTree(mets_element)
 
 
-def _ead3_c_div(parent,
-                div,
-                filegrp,
-                all_amd_refs,
-                object_refs,
-                supplementary_files,
-                supplementary_types,
-                file_properties,
-                workspace):
+def _scan_ead3(dmdsec_loc):
+    """Read the EAD3 document for the label of the archdesc element,
+    whether the archdesc element has a dsc element, and the hrefs of
+    all dao elements.
+
+    :param dmdsec_loc: EAD3 descriptive metadata file
+    :returns: Tuple of the label (None if not found), True if dsc
+        element exists, and a list of hrefs without leading slashes
+    """
+    label = None
+    has_dsc = False
+    hrefs = []
+    for (event, elem) in ET.iterparse(dmdsec_loc, events=('start', 'end')):
+        if event == 'end':
+            _clear_element(elem)
+            continue
+        if elem.tag == EAD3_ARCHDESC and label is None:
+            label = _first_attribute(elem, ('otherlevel', 'level'))
+        elif elem.tag == EAD3_DSC and elem.getparent() is not None and \
+                elem.getparent().tag == EAD3_ARCHDESC:
+            has_dsc = True
+        elif ET.QName(elem.tag).localname == 'dao' and \
+                elem.get('href') is not None:
+            hrefs.append(elem.get('href').lstrip('/'))
+
+    return (label, has_dsc, hrefs)
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-branches
+def _iter_ead3_c_divs(dmdsec_loc,
+                      filegrp,
+                      all_amd_refs,
+                      object_refs,
+                      file_properties,
+                      href_paths):
     """Create div elements based on ead3 c elements. Fptr elements are
     created based on ead dao elements. The Ead3 elements tags are put
     into @type and the @level or @otherlevel attributes from ead3 will
@@ -147,61 +186,133 @@ def _ead3_c_div(parent,
     Daoset elements within the ead3 c element will be looped over and
     create their own divs if they exist, containing the dao elements.
 
-    :param parent: Element to follow in EAD3
-    :param div: Div element in structmap
+    The document is read with iterparse, and the elements are cleared
+    when they have been read. A div is completed when the end of its c
+    element is reached: the divs of the child c elements are added
+    first, then the divs of the daoset elements and then the dao
+    elements directly under the c element. Only the c elements directly
+    under the top-level dsc element get their own divs in the archdesc
+    div, so that the divs are in the order of the document. A dsc
+    element nested in a c element is not valid EAD3, and it is skipped.
+
+    :param dmdsec_loc: EAD3 descriptive metadata file
     :param filegrp: fileGrp element
     :param all_amd_refs: XML element tree of administrative metadata
         references.
     :param object_refs: Object references.
-    :param supplementary_files: Supplementary files.
-    :param supplementary_types: Supplementary types.
     :param file_properties: Dictionary collection of file properties.
-    :param workspace: Workspace path, required by add_fptrs_div_ead()
+    :param href_paths: Dict of dao hrefs and matching file paths, see
+        match_hrefs()
+    :returns: Generator of the divs of the c elements directly under
+        the top-level dsc element
     """
-
-    c_div = mets.div(type_attr=(ET.QName(parent.tag).localname),
-                     label=_parse_label(parent))
-
-    # Create child divs based on the child c elements
-    for elem in parent.findall("./*"):
-        if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
-            _ead3_c_div(parent=elem,
-                        div=c_div,
+    # Open c elements, innermost last
+    stack = []
+    # Number of open dsc elements
+    dsc_depth = 0
+    for (event, elem) in ET.iterparse(dmdsec_loc, events=('start', 'end')):
+        if event == 'end':
+            if elem.tag == EAD3_DSC:
+                dsc_depth -= 1
+            if stack and elem is stack[-1]['elem']:
+                frame = stack.pop()
+                c_div = frame['div']
+                for child_div in frame['divs']:
+                    c_div.append(child_div)
+                for (daoset_div, daoset_hrefs) in frame['daosets']:
+                    c_div.append(add_fptrs_div_ead(
+                        c_div=daoset_div,
+                        hrefs=daoset_hrefs,
                         filegrp=filegrp,
                         all_amd_refs=all_amd_refs,
                         object_refs=object_refs,
-                        supplementary_files=supplementary_files,
-                        supplementary_types=supplementary_types,
                         file_properties=file_properties,
-                        workspace=workspace)
-
-    # Create divs for daoset elements, appending the dao elements and file
-    # references to the daoset elements
-    for elem in parent.xpath("./ead3:did/*", namespaces=NAMESPACES):
-        if ET.QName(elem.tag).localname == 'daoset':
-            daoset_div = mets.div(type_attr='daoset', label=_parse_label(elem))
-
-            daoset_hrefs = collect_dao_hrefs(elem)
-            daoset_div = add_fptrs_div_ead(
-                c_div=daoset_div,
-                hrefs=daoset_hrefs,
-                filegrp=filegrp,
-                all_amd_refs=all_amd_refs,
-                object_refs=object_refs,
-                file_properties=file_properties)
-            c_div.append(daoset_div)
-
-    # Collect dao elements and file references as fptr elements if they
-    # exist directly under the ead3 c element
-    c_hrefs = collect_dao_hrefs(parent)
-    c_div = add_fptrs_div_ead(c_div=c_div,
-                              hrefs=c_hrefs,
-                              filegrp=filegrp,
-                              all_amd_refs=all_amd_refs,
-                              object_refs=object_refs,
-                              file_properties=file_properties)
-
-    div.append(c_div)
+                        href_paths=href_paths))
+                c_div = add_fptrs_div_ead(c_div=c_div,
+                                          hrefs=frame['hrefs'],
+                                          filegrp=filegrp,
+                                          all_amd_refs=all_amd_refs,
+                                          object_refs=object_refs,
+                                          file_properties=file_properties,
+                                          href_paths=href_paths)
+                if frame['parent'] is None:
+                    yield c_div
+                else:
+                    frame['parent']['divs'].append(c_div)
+            _clear_element(elem)
+            continue
+
+        if elem.tag == EAD3_DSC:
+            dsc_depth += 1
+        parent = elem.getparent()
+        if parent is None:
+            continue
+        frame = stack[-1] if stack else None
+        localname = ET.QName(elem.tag).localname
+        top_level = parent.tag == EAD3_DSC and dsc_depth == 1
+
+        if localname in ALLOWED_C_SUBS and (
+                top_level or
+                (frame is not None and parent is frame['elem'])):
+            if top_level:
+                frame = None
+            stack.append({
+                'elem': elem,
+                'parent': frame,
+                'div': mets.div(type_attr=localname,
+                                label=_parse_label(elem)),
+                'divs': [],
+                'daosets': [],
+                'daoset': None,
+                'hrefs': []})
+        elif frame is None:
+            continue
+        elif parent.tag == EAD3_DID and \
+                parent.getparent() is frame['elem']:
+            if localname == 'daoset':
+                frame['daoset'] = elem
+                frame['daosets'].append((
+                    mets.div(type_attr='daoset', label=_parse_label(elem)),
+                    []))
+            elif localname == 'dao':
+                frame['hrefs'].append(_dao_href(elem))
+        elif localname == 'dao' and parent is frame['daoset']:
+            frame['daosets'][-1][1].append(_dao_href(elem))
+
+
+def _clear_element(elem):
+    """Remove an element that has been read with iterparse, and the
+    preceding siblings of the element, from the document.
+
+    :elem: lxml.etree element
+    """
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def _dao_href(elem):
+    """Return the href and label attribute values of a dao element.
+
+    :elem: EAD3 dao element
+    :returns: Tuple of href without leading slashes, and label
+    """
+    return (elem.attrib['href'].lstrip('/'), elem.get('label', None))
+
+
+def _first_attribute(elem, names):
+    """Return the value of the first attribute of an element that has
+    one of the given names, in the order of the attributes in the
+    document.
+
+    :elem: lxml.etree element
+    :names: Attribute names
+    :returns: Attribute value, or None if none of the attributes exist
+    """
+    for (name, value) in elem.attrib.items():
+        if name in names:
+            return value
+    return None
 
 
 def _parse_label(elem):
@@ -212,10 +323,8 @@ def _parse_label(elem):
     :elem: lxml.etree element whose attributes (or name) is parsed
     :returns: The parsed label as a string
     """
-    try:
-        label = elem.xpath(("./@label | ./@otherlevel | ./@level"),
-                           namespaces=NAMESPACES)[0]
-    except IndexError:
+    label = _first_attribute(elem, ('label', 'otherlevel', 'level'))
+    if label is None:
         label = ET.QName(elem.tag).localname
 
     return label
@@ -226,7 +335,8 @@ def add_fptrs_div_ead(c_div,
                       filegrp,
                       all_amd_refs,
                       object_refs,
-                      file_properties):
+                      file_properties,
+                      href_paths=None):
     """Creates fptr elements for hrefs. If the files contain
     file properties, like ordering data, the data is written to the
     parent div element.
@@ -241,15 +351,16 @@ def add_fptrs_div_ead(c_div,
         metadata references.
     :param object_refs: Object references.
     :param file_properties: Dictionary collection of file properties.
+    :param href_paths: Dict of hrefs and matching file paths, see
+        match_hrefs(). Will be created if missing.
     :returns: The modified c_div element
     """
+    if href_paths is None:
+        href_paths = match_hrefs([href for (href, _) in hrefs],
+                                 file_properties)
 
     for href, label in hrefs:
-        amd_file = None
-        for path in file_properties:
-            if href in path:
-                amd_file = path
-                break
+        amd_file = href_paths.get(href)
         # href strings that do not match any file don't add anything new
         if not amd_file:
             break
@@ -292,7 +403,82 @@ def collect_dao_hrefs(parent):
 
     for elem in parent.xpath("%s" % xpath, namespaces=NAMESPACES):
         if ET.QName(elem.tag).localname == 'dao':
-            hrefs.append((elem.xpath("./@href")[0].lstrip('/'),
-                          elem.get('label', None)))
+            hrefs.append(_dao_href(elem))
 
     return hrefs
+
+
+def match_hrefs(hrefs, paths):
+    """Find the file path of each href. The path of an href is the
+    first path that contains the href.
+
+    All hrefs are searched at once with the Aho-Corasick algorithm: a
+    trie of the hrefs is extended with links from each node to the
+    longest proper suffix of the node that is also in the trie. The
+    paths are then read once character by character, following the
+    trie and the suffix links, so that the time taken is linear in the
+    total length of the hrefs and paths, and the number of matches.
+
+    :param hrefs: Iterable of hrefs
+    :param paths: Iterable of file paths, in the order of preference
+    :returns: Dict of hrefs and matching paths. Hrefs that do not match
+        any path are left out.
+    """
+    # Trie of the hrefs. The nodes are numbered, and the root is 0.
+    children = [{}]
+    node_hrefs = [None]
+    for href in set(hrefs):
+        node = 0
+        for char in href:
+            if char not in children[node]:
+                children[node][char] = len(children)
+                children.append({})
+                node_hrefs.append(None)
+            node = children[node][char]
+        node_hrefs[node] = href
+
+    # Suffix links, and links to the nearest node of an href along
+    # the suffix links, in breadth-first order
+    suffix_links = [0] * len(children)
+    href_links = [None] * len(children)
+    queue = collections.deque(children[0].values())
+    while queue:
+        node = queue.popleft()
+        for (char, child) in children[node].items():
+            suffix = suffix_links[node]
+            while suffix and char not in children[suffix]:
+                suffix = suffix_links[suffix]
+            if char in children[suffix]:
+                suffix = children[suffix][char]
+            suffix_links[child] = suffix
+            if node_hrefs[suffix] is not None:
+                href_links[child] = suffix
+            else:
+                href_links[child] = href_links[suffix]
+            queue.append(child)
+
+    href_paths = {}
+    unmatched = len([href for href in node_hrefs if href is not None])
+    if node_hrefs[0] is not None:
+        # Empty href is contained in every path
+        unmatched -= 1
+    for path in paths:
+        if node_hrefs[0] is not None:
+            href_paths.setdefault(node_hrefs[0], path)
+        if not unmatched:
+            break
+        node = 0
+        for char in path:
+            while node and char not in children[node]:
+                node = suffix_links[node]
+            node = children[node].get(char, 0)
+
+            match = node if node_hrefs[node] is not None else \
+                href_links[node]
+            while match is not None:
+                if node_hrefs[match] not in href_paths:
+                    href_paths[node_hrefs[match]] = path
+                    unmatched -= 1
+                match = href_links[match]
+
+    return href_paths
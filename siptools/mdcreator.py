@@ -3,6 +3,7 @@ Utilities for siptools
 """
 from __future__ import unicode_literals, print_function
 
+import collections
 import os
 import sys
 import json
@@ -11,8 +12,14 @@ import six
 
 import mets
 import xml_helpers
+from siptools.packed_amd import amd_file_exists, get_packed_amd
 from siptools.utils import generate_digest, encode_path
 
+try:
+    from scandir import scandir  # Python 2
+except ImportError:
+    from os import scandir  # Python 3+
+
 
 def _parse_refs(ref):
     """A helper function to parse the given reference according
@@ -37,20 +44,61 @@ def _uniques_list(reference_list, reference):
     return list(set_list)
 
 
-def _get_path_from_reference_file(reference_file, ref_path):
-    """An inner function to help read an existing JSON lines file.
+_DECODER = json.JSONDecoder()
+
+
+def _reference_key(line):
+    """Parse the path of a line in a JSON lines reference file.
 
-    :reference_file: JSON Line reference file to read from.
-    :ref_path: The ref_path key to look for.
-    :return: Dictionary on finding, None when none is found.
+    Each line contains an object with the path as its only key, so only
+    the key needs to be decoded.
+
+    :line: Line of the reference file as bytes
+    :return: The path of the line
     """
-    with open(reference_file, 'r') as out_file:
-        for line in out_file:
-            try:
-                return json.loads(line)[ref_path]
-            except KeyError:
-                continue
-    return None
+    line = line.decode('utf-8')
+    try:
+        return _DECODER.raw_decode(line, line.index('"'))[0]
+    except ValueError:
+        return next(iter(json.loads(line)))
+
+
+def _index_reference_file(in_file):
+    """Index the paths of an existing JSON lines reference file.
+
+    :in_file: Reference file opened in binary mode
+    :return: Dictionary of paths and the offsets of their lines
+    """
+    offsets = {}
+    offset = 0
+    for line in in_file:
+        if line.strip():
+            offsets.setdefault(_reference_key(line), offset)
+        offset += len(line)
+    return offsets
+
+
+def _read_reference(in_file, offset, ref_path):
+    """Read a path entry of a JSON lines reference file.
+
+    :in_file: Reference file opened in binary mode
+    :offset: Offset of the line from _index_reference_file()
+    :ref_path: Path of the entry
+    :return: Dictionary of the path entry
+    """
+    in_file.seek(offset)
+    return json.loads(in_file.readline().decode('utf-8'))[ref_path]
+
+
+def _write_references(out_file, paths):
+    """Write path entries to a JSON lines reference file.
+
+    :out_file: Reference file opened in binary mode
+    :paths: Dictionary of paths and their entries
+    """
+    for ref_path, path in six.iteritems(paths):
+        out_file.write(json.dumps({ref_path: path}).encode('utf-8'))
+        out_file.write(b'\n')
 
 
 def _setup_new_path(path_type):
@@ -82,6 +130,9 @@ class MetsSectionCreator(object):
         self.workspace = workspace
         self.md_elements = []
         self.references = []
+        self.written_md = {}
+        self.workspace_files = None
+        self.amd_store = None
 
     # pylint: disable=too-many-arguments
     def add_reference(self, md_id, filepath, stream=None, directory=None):
@@ -113,7 +164,8 @@ class MetsSectionCreator(object):
                filename=None,
                stream=None,
                directory=None,
-               given_metadata_dict=None):
+               given_metadata_dict=None,
+               md_key=None):
         """
         Append metadata XML element into self.md_elements list.
         self.md_elements is read by write() function and all the elements
@@ -132,12 +184,44 @@ class MetsSectionCreator(object):
         :stream: Stream index, or None if not a stream
         :directory: Path of the directory linking to the MD element
         :given_metadata_dict: Dict of file metadata
+        :md_key: Hashable value that identifies the metadata, see
+                 write_md()
         """
 
         md_element = (
-            metadata, filename, stream, directory, given_metadata_dict)
+            metadata, filename, stream, directory, given_metadata_dict,
+            md_key)
         self.md_elements.append(md_element)
 
+    def workspace_file_exists(self, filename):
+        """
+        Check whether a file exists in the workspace.
+
+        If several metadata elements are to be written, the workspace,
+        and its packed store if any, is listed when this is first called.
+        The listing is kept up to date by write_md() and write_dict(),
+        also over several calls of write(), and the existence of the
+        metadata files is then checked without a file system call for
+        each metadata element. The existence of a single metadata file is
+        checked directly, without listing the workspace.
+
+        :filename: File name in the workspace
+        :returns: True if the file exists, False otherwise
+        """
+        if self.workspace_files is None and len(self.md_elements) < 2:
+            self.amd_store = get_packed_amd(self.workspace)
+            return amd_file_exists(self.workspace, filename)
+        if self.workspace_files is None:
+            try:
+                self.workspace_files = set(
+                    entry.name for entry in scandir(self.workspace))
+            except OSError:
+                self.workspace_files = set()
+            self.amd_store = get_packed_amd(self.workspace)
+            if self.amd_store is not None:
+                self.workspace_files.update(self.amd_store.names())
+        return filename in self.workspace_files
+
     def write_references(self, ref_file):
         """
         Write "md-references.jsonl" file, which is read by the
@@ -147,93 +231,84 @@ class MetsSectionCreator(object):
 
         reference_file = os.path.join(self.workspace, ref_file)
 
-        path_map = {}
-        paths = []
         # Whether or not the file initially exists.
         file_exists = os.path.exists(reference_file)
-        # Collection of paths that underwent an update.
-        paths_updated = set()
-        for ref in self.references:
-            ref_path = _parse_refs(ref['path'])
-
-            # We'll first set data to path-variable for processing.
-            try:
-                # Set a reference if path being processed already exists.
-                path = paths[path_map[ref_path]][ref_path]
-            except KeyError:
-                path = None
-                if file_exists:
-                    # Get existing path entry from a file.
-                    path = _get_path_from_reference_file(reference_file,
-                                                         ref_path)
-                    if path is not None:
-                        # Existing entry found.
-                        paths_updated.add(ref_path)
+        # Existing entries of the reference file are first indexed, so
+        # that only the entries of the updated paths need to be decoded.
+        offsets = {}
+        paths = collections.OrderedDict()
+        rewrite = False
+        # An empty file is read if the reference file does not exist
+        with open(reference_file if file_exists else os.devnull,
+                  'rb') as in_file:
+            if file_exists:
+                offsets = _index_reference_file(in_file)
+
+            for ref in self.references:
+                ref_path = _parse_refs(ref['path'])
+
+                # We'll first set data to path-variable for processing.
+                path = paths.get(ref_path)
                 if path is None:
-                    # No prior existing path so setting up new one.
-                    path = _setup_new_path(ref['path_type'])
-                # Map to list of paths that underwent processing.
-                paths.append({ref_path: path})
-                path_map[ref_path] = len(paths) - 1
-
-            # Based on whether or not stream exists for the reference, we'll
-            # update the reference list.
-            if ref['stream']:
-                try:
-                    path['streams'][ref['stream']] = _uniques_list(
-                        path['streams'][ref['stream']],
-                        ref['md_id']
-                    )
-                except KeyError:
-                    path['streams'][ref['stream']] = list()
-                    path['streams'][ref['stream']].append(ref['md_id'])
-            else:
-                path['md_ids'] = _uniques_list(path['md_ids'], ref['md_id'])
-
-            # After path-variable has been modified enough, set the updated
-            # path dictionary back paths-collection.
-            paths[path_map[ref_path]][ref_path] = path
-
-        # Write reference list JSON line file
-        if paths_updated:
-            # Existing entries in reference file must be updated.
-            # We'll proceed to write to a separate temporary file.
-            with open(reference_file,
-                      'rt') as in_file, open('%s.tmp' % reference_file,
-                                             'at') as out_file:
-                for line in in_file:
-                    existing_json_data = json.loads(line)
-                    for key in existing_json_data:
-                        if key not in paths_updated:
+                    if ref_path in offsets:
+                        # Get existing path entry from the file.
+                        path = _read_reference(in_file, offsets[ref_path],
+                                               ref_path)
+                    else:
+                        # No prior existing path so setting up new one.
+                        path = _setup_new_path(ref['path_type'])
+                    paths[ref_path] = path
+
+                # Based on whether or not stream exists for the reference,
+                # we'll update the reference list.
+                if ref['stream']:
+                    try:
+                        path['streams'][ref['stream']] = _uniques_list(
+                            path['streams'][ref['stream']],
+                            ref['md_id']
+                        )
+                    except KeyError:
+                        path['streams'][ref['stream']] = list()
+                        path['streams'][ref['stream']].append(ref['md_id'])
+                else:
+                    path['md_ids'] = _uniques_list(path['md_ids'],
+                                                   ref['md_id'])
+
+            # Write reference list JSON line file
+            rewrite = any(ref_path in offsets for ref_path in paths)
+            if rewrite:
+                # Existing entries in reference file must be updated, so
+                # the file is rewritten once to a separate temporary file.
+                in_file.seek(0)
+                with open('%s.tmp' % reference_file, 'wb') as out_file:
+                    for line in in_file:
+                        if line.strip() and \
+                                _reference_key(line) not in paths:
                             out_file.write(line)
-
-            for path in paths:
-                with open('%s.tmp' % reference_file, 'at') as out_file:
-                    json.dump(path, out_file)
-                    out_file.write('\n')
-        else:
-            # If no existing entries required update, we'll append directly
-            # to reference file.
-            for path in paths:
-                with open(reference_file, 'at') as out_file:
-                    json.dump(path, out_file)
-                    out_file.write('\n')
+                    _write_references(out_file, paths)
+            elif paths:
+                # If no existing entries required update, we'll append
+                # directly to reference file.
+                with open(reference_file, 'ab') as out_file:
+                    _write_references(out_file, paths)
 
         # If temporary file was written, it'll replace the existing reference
         # file as a whole.
-        if os.path.exists('%s.tmp' % reference_file):
+        if rewrite:
             os.rename('%s.tmp' % reference_file, reference_file)
 
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-locals
     def write_md(self, metadata, mdtype, mdtypeversion, othermdtype=None,
-                 section=None, stdout=False):
+                 section=None, stdout=False, md_key=None):
         """
         Wraps XML metadata into MD element and writes it to a lxml.etree XML
         file in the workspace. The output filename is
             <mdtype>-<hash>-othermd.xml,
         where <mdtype> is the type of metadata given as parameter and <hash>
-        is a string generated from the metadata.
+        is a string generated from the metadata. In a packed workspace the
+        file is appended to the packed store instead, see
+        siptools.packed_amd.
 
         Serializing and hashing the root xml element can be rather time
         consuming and as such this method should not be called for each file
@@ -241,21 +316,30 @@ class MetsSectionCreator(object):
         be easily implemented. This implementation should be done by the
         subclasses of metadata_creator.
 
+        If md_key is given, the metadata is hashed and written only the
+        first time the key is seen. The key must identify the metadata
+        uniquely, e.g. the serialized metadata dict the XML element was
+        created from.
+
         :metadata (Element): metadata XML element
         :mdtype (string): Value of mdWrap MDTYPE attribute
         :mdtypeversion (string): Value of mdWrap MDTYPEVERSION attribute
         :othermdtype (string): Value of mdWrap OTHERMDTYPE attribute
         :section (string): Type of mets metadata section
         :stdout (boolean): Print also to stdout
+        :md_key: Hashable value that identifies the metadata
         :returns: md_id, filename - Metadata id and filename
         """
-        digest = generate_digest(metadata)
         suffix = othermdtype if othermdtype else mdtype
-        filename = encode_path("%s-%s-amd.xml" % (digest, suffix))
+        if md_key is not None and (suffix, md_key) in self.written_md:
+            return self.written_md[(suffix, md_key)]
+
+        digest = generate_digest(metadata)
+        basename = encode_path("%s-%s-amd.xml" % (digest, suffix))
         md_id = '_{}'.format(digest)
-        filename = os.path.join(self.workspace, filename)
+        filename = os.path.join(self.workspace, basename)
 
-        if not os.path.exists(filename):
+        if not self.workspace_file_exists(basename):
 
             xmldata = mets.xmldata()
             xmldata.append(metadata)
@@ -271,15 +355,22 @@ class MetsSectionCreator(object):
             mets_ = mets.mets()
             mets_.append(amdsec)
 
-            with open(filename, 'wb+') as outfile:
-                outfile.write(xml_helpers.utils.serialize(mets_))
-                if stdout:
-                    print(xml_helpers.utils.serialize(mets_).decode("utf-8"))
-                print(
-                    "Wrote lxml.etree %s administrative metadata to file "
-                    "%s" % (mdtype, outfile.name)
-                )
+            xml_data = xml_helpers.utils.serialize(mets_)
+            if self.amd_store is not None:
+                self.amd_store.write(basename, xml_data)
+            else:
+                with open(filename, 'wb+') as outfile:
+                    outfile.write(xml_data)
+            if stdout:
+                print(xml_data.decode("utf-8"))
+            print(
+                "Wrote lxml.etree %s administrative metadata to file "
+                "%s" % (mdtype, filename)
+            )
+            self._add_workspace_file(basename)
 
+        if md_key is not None:
+            self.written_md[(suffix, md_key)] = (md_id, filename)
         return md_id, filename
 
     def write_dict(self, file_metadata_dict, premis_amd_id):
@@ -290,13 +381,24 @@ class MetsSectionCreator(object):
         :premis_amd_id: The AMDID of corresponding premis FILE object
         """
         digest = premis_amd_id[1:]
-        filename = encode_path("%s-scraper.json" % digest)
-        filename = os.path.join(self.workspace, filename)
+        basename = encode_path("%s-scraper.json" % digest)
+        filename = os.path.join(self.workspace, basename)
 
-        if not os.path.exists(filename):
+        if not self.workspace_file_exists(basename):
             with open(filename, 'wt') as outfile:
                 json.dump(file_metadata_dict, outfile)
             print("Wrote technical data to: %s" % (outfile.name))
+            self._add_workspace_file(basename)
+
+    def _add_workspace_file(self, filename):
+        """
+        Add a written file to the listing of the workspace, if the
+        workspace has been listed.
+
+        :filename: File name in the workspace
+        """
+        if self.workspace_files is not None:
+            self.workspace_files.add(filename)
 
     # pylint: disable=too-many-arguments
     def write(self, mdtype="type", mdtypeversion="version",
@@ -325,10 +427,11 @@ class MetsSectionCreator(object):
              filename,
              stream,
              directory,
-             given_metadata_dict) in self.md_elements:
+             given_metadata_dict,
+             md_key) in self.md_elements:
             md_id, _ = self.write_md(
                 metadata, mdtype, mdtypeversion, othermdtype=othermdtype,
-                section=section, stdout=stdout
+                section=section, stdout=stdout, md_key=md_key
             )
             if given_metadata_dict:
                 file_metadata_dict = given_metadata_dict
@@ -339,5 +442,18 @@ class MetsSectionCreator(object):
         # Write md-references
         self.write_references(ref_file)
 
-        # Clear references and md_elements
+        self.clear()
+
+    def clear(self):
+        """
+        Clear the metadata elements and references after they have been
+        written, so that the creator can be used for the next write().
+
+        The listing of the workspace and its packed store are kept, as
+        they are kept up to date by the writes.
+        """
+        workspace_files = self.workspace_files
+        amd_store = self.amd_store
         self.__init__(self.workspace)
+        self.workspace_files = workspace_files
+        self.amd_store = amd_store
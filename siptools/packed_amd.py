@@ -0,0 +1,289 @@
+"""Packed storage of administrative metadata files in the workspace.
+
+By default, each administrative metadata element is written to its own
+<digest>-<type>-amd.xml file in the workspace. In a packed workspace,
+the serialized files are instead appended to a few large segment files,
+and an index records the segment, offset and length of each file. The
+files keep their names, and the readers of the workspace find them in
+either format.
+
+A workspace is packed once the index file exists, see init_packed_amd().
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+
+import lxml.etree
+
+INDEX_FILE = 'packed-amd-index.jsonl'
+SEGMENT_FILE = 'packed-amd-%05d.seg'
+SEGMENT_PATTERN = re.compile(r'^packed-amd-\d{5,}\.seg$')
+
+# Maximum size of a segment file in bytes
+MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Stores opened in this process, by workspace
+_STORES = {}
+
+
+def init_packed_amd(workspace):
+    """Make the workspace packed, so that the administrative metadata
+    written after this is stored in segment files.
+
+    :workspace: Workspace path
+    """
+    index_path = os.path.join(workspace, INDEX_FILE)
+    if not os.path.exists(index_path):
+        with open(index_path, 'ab'):
+            pass
+
+
+def get_packed_amd(workspace):
+    """Return the packed store of the workspace.
+
+    The store is shared by all the callers in the process, so that the
+    index is read only once and the writes are appended in order. It is
+    reloaded if the index has been changed by some other process.
+
+    :workspace: Workspace path
+    :returns: PackedAmdStore, or None if the workspace is not packed
+    """
+    key = os.path.abspath(workspace)
+    store = _STORES.get(key)
+    try:
+        stat = os.stat(os.path.join(workspace, INDEX_FILE))
+    except OSError:
+        if store is not None:
+            store.close()
+            del _STORES[key]
+        return None
+
+    if store is None or not store.is_current(stat):
+        if store is not None:
+            store.close()
+        store = PackedAmdStore(workspace)
+        _STORES[key] = store
+    return store
+
+
+def is_packed_amd_file(name):
+    """Check whether a file name in the workspace is the index or a
+    segment file of the packed store.
+
+    :name: File name in the workspace
+    :returns: True if the file belongs to the packed store
+    """
+    return name == INDEX_FILE or SEGMENT_PATTERN.match(name) is not None
+
+
+def amd_file_exists(workspace, name):
+    """Check whether an administrative metadata file exists in the
+    workspace, either as a file or in the packed store.
+
+    :workspace: Workspace path
+    :name: File name in the workspace
+    :returns: True if the file exists, False otherwise
+    """
+    if os.path.exists(os.path.join(workspace, name)):
+        return True
+    store = get_packed_amd(workspace)
+    return store is not None and name in store
+
+
+def parse_amd_file(workspace, name):
+    """Parse an administrative metadata file of the workspace, either
+    from a file or from the packed store.
+
+    :workspace: Workspace path
+    :name: File name in the workspace
+    :returns: ElementTree of the file
+    :raises: IOError if the file does not exist.
+    """
+    path = os.path.join(workspace, name)
+    store = get_packed_amd(workspace)
+    if store is not None and name in store and not os.path.exists(path):
+        return lxml.etree.ElementTree(lxml.etree.fromstring(store.read(name)))
+    return lxml.etree.parse(path)
+
+
+class PackedAmdStore(object):
+    """Administrative metadata files appended to segment files.
+
+    The index is a JSON lines file, where each line gives the name,
+    segment number, offset and length of a file. Files are never
+    modified in place: a rewritten file is appended again, and the last
+    line of a name in the index is the valid one. A removed file is
+    recorded in the index with a line without a segment.
+    """
+
+    def __init__(self, workspace):
+        """
+        Read the index of the packed store.
+
+        :workspace: Workspace path
+        """
+        self.workspace = workspace
+        self.entries = {}
+        self._index_path = os.path.join(workspace, INDEX_FILE)
+        self._index_file = None
+        self._segment_file = None
+        self._segment = 0
+        self._segment_size = None
+        self._index_stat = None
+
+        with open(self._index_path, 'rb') as in_file:
+            for line in in_file:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Incomplete line of an interrupted write
+                    continue
+                if entry.get('removed'):
+                    self.entries.pop(entry['name'], None)
+                    continue
+                self.entries[entry['name']] = (
+                    entry['segment'], entry['offset'], entry['length'])
+                self._segment = max(self._segment, entry['segment'])
+        self._update_stat()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        """Return the names of the files in the store."""
+        return self.entries.keys()
+
+    def is_current(self, stat):
+        """Check that the index has not been changed by others.
+
+        :stat: Current os.stat() result of the index file
+        :returns: True if the index is as this store left it
+        """
+        return self._index_stat == (stat.st_ino, stat.st_size)
+
+    def _update_stat(self):
+        """Record the state of the index file after reading it."""
+        stat = os.stat(self._index_path)
+        self._index_stat = (stat.st_ino, stat.st_size)
+
+    def _segment_path(self, segment):
+        """Return the path of a segment file."""
+        return os.path.join(self.workspace, SEGMENT_FILE % segment)
+
+    def read(self, name):
+        """Read a file from the store.
+
+        :name: File name
+        :returns: Contents of the file as bytes
+        """
+        (segment, offset, length) = self.entries[name]
+        with open(self._segment_path(segment), 'rb') as in_file:
+            in_file.seek(offset)
+            return in_file.read(length)
+
+    def iter_files(self):
+        """Iterate the files of the store in the order they are stored,
+        reading each segment file sequentially.
+
+        :returns: Generator of file names and contents
+        """
+        entries = sorted(
+            (entry, name) for (name, entry) in self.entries.items())
+        in_file = None
+        try:
+            for ((segment, offset, length), name) in entries:
+                if in_file is None or in_file.name != \
+                        self._segment_path(segment):
+                    if in_file is not None:
+                        in_file.close()
+                    in_file = open(self._segment_path(segment), 'rb')
+                in_file.seek(offset)
+                yield (name, in_file.read(length))
+        finally:
+            if in_file is not None:
+                in_file.close()
+
+    def write(self, name, data):
+        """Append a file to the store. A file that already exists in the
+        store is replaced.
+
+        :name: File name
+        :data: Contents of the file as bytes
+        """
+        self._open_files()
+
+        if self._segment_size and \
+                self._segment_size + len(data) > MAX_SEGMENT_SIZE:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(
+                self._segment_path(self._segment), 'ab')
+            self._segment_size = self._segment_file.tell()
+
+        offset = self._segment_size
+        self._segment_file.write(data)
+        self._segment_file.flush()
+        self._segment_size += len(data)
+
+        # The index is written after the data, so that an interrupted
+        # write never leaves the index pointing to missing data
+        self._write_index(json.dumps({
+            'name': name,
+            'segment': self._segment,
+            'offset': offset,
+            'length': len(data)}).encode('utf-8') + b'\n')
+        self.entries[name] = (self._segment, offset, len(data))
+
+    def remove(self, name):
+        """Remove a file from the store. The data of the file is left in
+        the segment file.
+
+        :name: File name
+        """
+        if name not in self.entries:
+            return
+        self._open_files()
+        self._write_index(json.dumps({
+            'name': name,
+            'removed': True}).encode('utf-8') + b'\n')
+        del self.entries[name]
+
+    def _open_files(self):
+        """Open the current segment file and the index for appending."""
+        if self._segment_file is not None:
+            return
+        self._segment_file = open(self._segment_path(self._segment), 'ab')
+        self._segment_size = self._segment_file.tell()
+        self._index_file = open(self._index_path, 'ab')
+        self._end_index_line()
+
+    def _write_index(self, line):
+        """Append a line to the index file.
+
+        :line: Line as bytes
+        """
+        self._index_file.write(line)
+        self._index_file.flush()
+        self._index_stat = (self._index_stat[0],
+                            self._index_stat[1] + len(line))
+
+    def _end_index_line(self):
+        """End the last line of the index, if an interrupted write has
+        left it incomplete.
+        """
+        if not self._index_stat[1]:
+            return
+        with open(self._index_path, 'rb') as in_file:
+            in_file.seek(-1, os.SEEK_END)
+            if in_file.read(1) != b'\n':
+                self._write_index(b'\n')
+
+    def close(self):
+        """Close the files opened for writing."""
+        for open_file in (self._segment_file, self._index_file):
+            if open_file is not None:
+                open_file.close()
+        self._segment_file = None
+        self._index_file = None
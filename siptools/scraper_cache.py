@@ -0,0 +1,193 @@
+"""Persistent cache of file scraping results in the workspace."""
+from __future__ import unicode_literals
+
+import json
+import os
+import sqlite3
+import time
+
+import six
+
+CACHE_FILE = 'import-object-scraper-cache.db'
+
+# Default maximum total size of the cached results in bytes
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Number of cache updates after which the changes are committed
+COMMIT_INTERVAL = 100
+
+
+def file_identity(filepath):
+    """Return the identity of a file for the cache.
+
+    A file is considered unchanged as long as its path, size,
+    modification time and inode stay the same.
+
+    :filepath: File path
+    :returns: Tuple of absolute path, size, modification time in
+              nanoseconds and inode number
+    """
+    stat = os.stat(filepath)
+    try:
+        mtime_ns = stat.st_mtime_ns
+    except AttributeError:  # Python 2
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return (os.path.abspath(filepath), stat.st_size, mtime_ns, stat.st_ino)
+
+
+def _encode_result(scraped):
+    """Serialize scraping result to JSON.
+
+    :scraped: Tuple of stream dict, info dict, grade and checksums
+    :returns: JSON string
+    """
+    (streams, info, grade, checksums) = scraped
+    return json.dumps({'streams': streams,
+                       'info': info,
+                       'grade': grade,
+                       'checksums': checksums})
+
+
+def _decode_result(data):
+    """Deserialize scraping result from JSON.
+
+    JSON has only string keys, so the stream and info indexes are
+    converted back to integers.
+
+    :data: JSON string
+    :returns: Tuple of stream dict, info dict, grade and checksums
+    """
+    result = json.loads(data)
+    streams = dict((int(index), stream)
+                   for (index, stream) in six.iteritems(result['streams']))
+    info = dict((int(index), scraper_info)
+                for (index, scraper_info) in six.iteritems(result['info']))
+    checksums = [tuple(checksum) for checksum in result['checksums']]
+    return (streams, info, result['grade'], checksums)
+
+
+class ScraperCache(object):
+    """SQLite backed cache of scraping results.
+
+    The results are keyed by the file path and the scraping options.
+    A cached result is used only if the size, modification time and
+    inode of the file are unchanged. When the total size of the cached
+    results grows beyond the maximum size, the least recently used
+    results are evicted.
+    """
+
+    def __init__(self, workspace, options, max_size=DEFAULT_MAX_SIZE):
+        """
+        Open the cache of the workspace.
+
+        :workspace: Workspace path
+        :options: Dict of the options affecting the scraping results
+        :max_size: Maximum total size of the cached results in bytes
+        """
+        self.path = os.path.join(workspace, CACHE_FILE)
+        self.options = json.dumps(options, sort_keys=True)
+        self.max_size = max_size
+        self._uncommitted = 0
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS scraper_cache ('
+            'path TEXT NOT NULL, '
+            'options TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'result TEXT NOT NULL, '
+            'result_size INTEGER NOT NULL, '
+            'last_used REAL NOT NULL, '
+            'PRIMARY KEY (path, options))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS scraper_cache_last_used '
+            'ON scraper_cache (last_used)')
+        self._total_size = self._connection.execute(
+            'SELECT COALESCE(SUM(result_size), 0) FROM scraper_cache'
+        ).fetchone()[0]
+
+    def get(self, identity):
+        """Return cached scraping result of a file.
+
+        :identity: File identity from file_identity()
+        :returns: Tuple of stream dict, info dict, grade and checksums,
+                  or None if the file is not in the cache or has changed
+        """
+        (path, size, mtime_ns, inode) = identity
+        row = self._connection.execute(
+            'SELECT size, mtime_ns, inode, result FROM scraper_cache '
+            'WHERE path = ? AND options = ?',
+            (path, self.options)).fetchone()
+        if row is None or tuple(row[:3]) != (size, mtime_ns, inode):
+            return None
+
+        self._connection.execute(
+            'UPDATE scraper_cache SET last_used = ? '
+            'WHERE path = ? AND options = ?',
+            (time.time(), path, self.options))
+        self._changed()
+        return _decode_result(row[3])
+
+    def put(self, identity, scraped):
+        """Add scraping result of a file to the cache.
+
+        :identity: File identity from file_identity(), taken before the
+                   file was scraped
+        :scraped: Tuple of stream dict, info dict, grade and checksums
+        """
+        (path, size, mtime_ns, inode) = identity
+        result = _encode_result(scraped)
+
+        row = self._connection.execute(
+            'SELECT result_size FROM scraper_cache '
+            'WHERE path = ? AND options = ?',
+            (path, self.options)).fetchone()
+        if row is not None:
+            self._total_size -= row[0]
+
+        self._connection.execute(
+            'INSERT OR REPLACE INTO scraper_cache '
+            '(path, options, size, mtime_ns, inode, result, result_size, '
+            'last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, self.options, size, mtime_ns, inode, result, len(result),
+             time.time()))
+        self._total_size += len(result)
+
+        if self._total_size > self.max_size:
+            self._evict()
+        self._changed()
+
+    def _evict(self):
+        """Remove the least recently used results until the cache is
+        at most 90% of the maximum size.
+        """
+        target_size = self.max_size * 0.9
+        evicted = []
+        for (path, options, result_size) in self._connection.execute(
+                'SELECT path, options, result_size FROM scraper_cache '
+                'ORDER BY last_used'):
+            if self._total_size <= target_size:
+                break
+            evicted.append((path, options))
+            self._total_size -= result_size
+
+        self._connection.executemany(
+            'DELETE FROM scraper_cache WHERE path = ? AND options = ?',
+            evicted)
+
+    def _changed(self):
+        """Commit the changes after every COMMIT_INTERVAL updates."""
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Commit the changes to the cache file."""
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        """Commit the changes and close the cache."""
+        self.commit()
+        self._connection.close()
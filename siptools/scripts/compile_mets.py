@@ -3,7 +3,12 @@ directory.
 """
 from __future__ import print_function, unicode_literals
 
+import collections
+import copy
 import datetime
+import io
+import itertools
+import multiprocessing
 import os
 import sys
 import uuid
@@ -15,6 +20,10 @@ import click
 import lxml.etree
 import mets
 import xml_helpers.utils as xml_utils
+from siptools.packed_amd import get_packed_amd, is_packed_amd_file
+from siptools.scraper_cache import CACHE_FILE
+from siptools.scripts.import_object import JOURNAL_FILE
+from siptools.scripts.premis_event import AGENT_INDEX_FILE
 from siptools.utils import get_objectlist, read_md_references
 from siptools.xml.mets import (METS_CATALOG, METS_PROFILE, METS_SPECIFICATION,
                                NAMESPACES, RECORD_STATUS_TYPES, mets_extend)
@@ -27,6 +36,17 @@ except ImportError:
 
 click.disable_unicode_literals_warning = True
 
+# Suffixes of the partial METS documents in the workspace
+PARTIAL_SUFFIXES = ('-amd.xml', 'dmdsec.xml', 'structmap.xml',
+                    'filesec.xml', 'rightsmd.xml')
+
+AMDSEC = '{%s}amdSec' % NAMESPACES['mets']
+
+# Number of partial documents parsed by a worker process in one task,
+# and the number of tasks per worker queued ahead of the merge
+WORKER_BATCH_SIZE = 64
+WORKER_QUEUE_SIZE = 4
+
 
 @click.command()
 @click.argument('mets_profile', type=click.Choice(METS_PROFILE))
@@ -84,6 +104,17 @@ click.disable_unicode_literals_warning = True
               metavar='<PACKAGING SERVICE>',
               help='If defined, add packaging service as CREATOR '
                    'agent to METS Header.')
+@click.option('--stream',
+              is_flag=True,
+              help='Write the METS document incrementally, keeping only '
+                   'one section in memory at a time.')
+@click.option('--workers',
+              type=click.IntRange(min=1),
+              default=1,
+              metavar='<WORKERS>',
+              help='Number of worker processes used for parsing the '
+                   'partial METS documents. Not used with --stream. '
+                   'Defaults to 1.')
 def main(**kwargs):
     """Merge partial METS documents in workspace directory into
     one METS document.
@@ -122,6 +153,8 @@ def _attribute_values(given_params, fill_contentid=False):
         "label": None,
         "last_moddate": None,
         "packagingservice": None,
+        "stream": False,
+        "workers": 1,
     }
     for key in given_params:
         if given_params[key]:
@@ -158,21 +191,30 @@ def compile_mets(**kwargs):
                          workspace
              stdout: True prints the output to stdout
              packagingservice: Packaging service specific parameter
+             stream: True writes the METS document incrementally
+             workers: Number of worker processes used for parsing
     """
     attributes = _attribute_values(kwargs, True)
 
-    mets_document = create_mets(**attributes)
-
-    if attributes["stdout"]:
-        print(xml_utils.serialize(mets_document.getroot()))
-
     output_file = os.path.join(attributes["workspace"], 'mets.xml')
 
     if not os.path.exists(os.path.dirname(output_file)):
         os.makedirs(os.path.dirname(output_file))
 
-    with open(output_file, 'wb+') as outfile:
-        outfile.write(xml_utils.serialize(mets_document.getroot()))
+    if attributes["stream"]:
+        write_mets_stream(output_file, **attributes)
+        if attributes["stdout"]:
+            with io.open(output_file, 'rt', encoding='utf-8') as infile:
+                for line in infile:
+                    print(line, end='')
+    else:
+        mets_document = create_mets(**attributes)
+
+        if attributes["stdout"]:
+            print(xml_utils.serialize(mets_document.getroot()))
+
+        with open(output_file, 'wb+') as outfile:
+            outfile.write(xml_utils.serialize(mets_document.getroot()))
 
     print("compile_mets created file: %s" % output_file)
 
@@ -191,8 +233,9 @@ def create_mets(fill_contentid=False, **attributes):
     "-amd.xml", "dmdsec.xml", "structmap.xml", "filesec.xml", and
     "rightsmd.xml" from workspace and merges the dmdSec,
     amdSec, fileSec, and structMap elements (one element from each file) into
-    one METS document. Also metsHdr element is created and included in
-    document.
+    one METS document. In a packed workspace, the "-amd.xml" files are also
+    read from the packed store. Also metsHdr element is created and included
+    in document.
 
     :fill_contentid: True sets attribute "contentid" same as "objid" if
                      "objid" is given, but "contentid" is not.
@@ -208,9 +251,98 @@ def create_mets(fill_contentid=False, **attributes):
                  record_status: Record status
                  label: Short description about the package
                  packagingservice: Packaging service specific parameter
+                 workers: Number of worker processes used for parsing
+                          the partial documents
     :returns: METS document ElementTree object
     """
     attributes = _attribute_values(attributes, fill_contentid)
+    metshdr = _create_metshdr(attributes)
+
+    # Collect elements from workspace XML files
+    sources = [('file', entry.path)
+               for entry in scandir(attributes["workspace"])
+               if entry.name.endswith(PARTIAL_SUFFIXES) and entry.is_file()]
+    store = get_packed_amd(attributes["workspace"])
+    if store is not None:
+        sources = itertools.chain(
+            sources,
+            (('data', xml_data) for (_, xml_data) in store.iter_files()))
+    elements = list(_iter_sections(sources, attributes["workers"]))
+
+    elements = mets.merge_elements(AMDSEC, elements)
+    elements.sort(key=mets.order)
+
+    # Create METS element
+    mets_element = _create_mets_element(attributes)
+    mets_element.append(metshdr)
+    for element in elements:
+        mets_element.append(element)
+    lxml.etree.cleanup_namespaces(mets_element)
+
+    return lxml.etree.ElementTree(mets_element)
+
+
+def write_mets_stream(output_file, fill_contentid=False, **attributes):
+    """Write METS document incrementally to a file. The document has the
+    same sections in the same order as the one created by create_mets(),
+    but only one section of the workspace is in memory at a time.
+
+    The partial documents of the workspace are read twice: first to find
+    out the sections and their order, and then to write them one by one.
+    The amdSec elements are merged into one amdSec element, whose child
+    elements are ordered like the sections by mets.order().
+
+    :output_file: Path of the METS document to write
+    :fill_contentid: True sets attribute "contentid" same as "objid" if
+                     "objid" is given, but "contentid" is not.
+    :attributes: The same keys as in create_mets()
+    """
+    attributes = _attribute_values(attributes, fill_contentid)
+    metshdr = _create_metshdr(attributes)
+    mets_element = _create_mets_element(attributes)
+    store = get_packed_amd(attributes["workspace"])
+    (sections, amd_children, amd_attrib) = _scan_sections(
+        attributes["workspace"], store)
+
+    # The merged amdSec takes the place of the first amdSec element
+    if amd_children:
+        sections.append((mets.order(lxml.etree.Element(AMDSEC)),
+                         amd_children[0][1], None))
+    sections.sort(key=lambda section: section[:2])
+    amd_children.sort(key=lambda child: child[:2])
+
+    with lxml.etree.xmlfile(output_file, encoding='UTF-8') as xml_file:
+        xml_file.write_declaration()
+        with xml_file.element(mets_element.tag,
+                              attrib=dict(mets_element.attrib),
+                              nsmap=mets_element.nsmap):
+            xml_file.write("\n")
+            # Use the namespace prefixes of the METS element
+            mets_element.append(metshdr)
+            xml_file.write(_detached(metshdr), pretty_print=True)
+            for (_, _, source) in sections:
+                if source is not None:
+                    section = _parse_partial(source, store)
+                    xml_file.write(_detached(section), pretty_print=True)
+                    continue
+
+                with xml_file.element(AMDSEC, attrib=amd_attrib):
+                    xml_file.write("\n")
+                    for (order, _, source) in amd_children:
+                        for child in _parse_partial(source, store):
+                            if isinstance(child.tag, six.string_types) \
+                                    and mets.order(child) == order:
+                                xml_file.write(_detached(child),
+                                               pretty_print=True)
+                xml_file.write("\n")
+
+
+def _create_metshdr(attributes):
+    """Create metsHdr element.
+
+    :attributes: Attributes of create_mets()
+    :returns: metsHdr element
+    """
     # Create list of agent elements
     if attributes["packagingservice"]:
         agents = [mets.agent(attributes["organization_name"],
@@ -224,39 +356,163 @@ def create_mets(fill_contentid=False, **attributes):
                              agent_role='CREATOR')]
 
     # Create mets header
-    metshdr = mets.metshdr(attributes["create_date"],
-                           attributes["last_moddate"],
-                           attributes["record_status"],
-                           agents)
+    return mets.metshdr(attributes["create_date"],
+                        attributes["last_moddate"],
+                        attributes["record_status"],
+                        agents)
 
-    # Collect elements from workspace XML files
-    elements = []
-    for entry in scandir(attributes["workspace"]):
-        if entry.name.endswith(('-amd.xml', 'dmdsec.xml',
-                                'structmap.xml', 'filesec.xml',
-                                'rightsmd.xml')) and entry.is_file():
-            element = lxml.etree.parse(entry.path).getroot()[0]
-            elements.append(element)
-
-    elements = mets.merge_elements('{%s}amdSec' % NAMESPACES['mets'], elements)
-    elements.sort(key=mets.order)
 
-    # Create METS element
+def _create_mets_element(attributes):
+    """Create the root element of METS document without any sections.
+
+    :attributes: Attributes of create_mets()
+    :returns: METS element
+    """
     mets_element = mets.mets(METS_PROFILE[attributes["mets_profile"]],
                              objid=attributes["objid"],
                              label=attributes["label"],
                              namespaces=NAMESPACES)
-    mets_element = mets_extend(mets_element,
-                               METS_CATALOG,
-                               METS_SPECIFICATION,
-                               attributes["contentid"],
-                               attributes["contractid"])
-    mets_element.append(metshdr)
-    for element in elements:
-        mets_element.append(element)
-    lxml.etree.cleanup_namespaces(mets_element)
+    return mets_extend(mets_element,
+                       METS_CATALOG,
+                       METS_SPECIFICATION,
+                       attributes["contentid"],
+                       attributes["contractid"])
+
+
+def _iter_sections(sources, workers=1):
+    """Parse the section elements of partial documents, in a pool of
+    worker processes if several workers are requested.
+
+    The worker processes parse the partial documents in batches and
+    return the section elements serialized, as the elements can not be
+    passed between processes. The sections are yielded in the order of
+    the given sources, so that the result does not depend on the number
+    of workers.
+
+    :sources: Iterable of partial documents given as tuples of
+              "file" and a path, or "data" and the document as bytes
+    :workers: Number of worker processes
+    :returns: Generator of section elements
+    """
+    if workers == 1:
+        for source in sources:
+            yield _parse_section(source)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        sources = iter(sources)
+        while True:
+            batch = list(itertools.islice(sources, WORKER_BATCH_SIZE))
+            if batch:
+                pending.append(
+                    pool.apply_async(_serialize_sections, (batch,)))
+            if pending and (not batch or
+                            len(pending) >= workers * WORKER_QUEUE_SIZE):
+                for xml_data in pending.popleft().get():
+                    yield lxml.etree.fromstring(xml_data)
+            elif not batch:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_section(source):
+    """Parse the section element of a partial document.
+
+    :source: Tuple of "file" and a path, or "data" and the document as
+             bytes
+    :returns: Section element
+    """
+    if source[0] == 'file':
+        return lxml.etree.parse(source[1]).getroot()[0]
+    return lxml.etree.fromstring(source[1])[0]
 
-    return lxml.etree.ElementTree(mets_element)
+
+def _serialize_sections(sources):
+    """Parse the section elements of partial documents and serialize
+    them. Run in the worker processes of _iter_sections().
+
+    :sources: List of partial documents, see _parse_section()
+    :returns: List of serialized section elements
+    """
+    return [lxml.etree.tostring(_parse_section(source))
+            for source in sources]
+
+
+def _scan_sections(workspace, store):
+    """Find out the sections of the partial documents in the workspace
+    without keeping the documents in memory.
+
+    :workspace: Workspace path
+    :store: Packed store of the workspace or None
+    :returns: Tuple of the sections, the child elements of the amdSec
+              sections and the attributes of the first amdSec element.
+              The sections and child elements are given as lists of
+              tuples of the order of the element, the index of the
+              partial document and the source of the partial document.
+    """
+    sources = [('file', entry.path) for entry in scandir(workspace)
+               if entry.name.endswith(PARTIAL_SUFFIXES) and entry.is_file()]
+    if store is not None:
+        sources.extend(('packed', name) for (name, _) in sorted(
+            store.entries.items(), key=lambda entry: entry[1]))
+
+    sections = []
+    amd_children = []
+    amd_attrib = None
+    for (index, source) in enumerate(sources):
+        if source[0] == 'file':
+            xml_source = source[1]
+        else:
+            xml_source = io.BytesIO(store.read(source[1]))
+
+        depth = 0
+        orders = set()
+        for (event, element) in lxml.etree.iterparse(
+                xml_source, events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                if depth <= 1:
+                    element.clear()
+                continue
+            depth += 1
+            if depth == 2 and element.tag != AMDSEC:
+                sections.append((mets.order(element), index, source))
+            elif depth == 2 and amd_attrib is None:
+                amd_attrib = dict(element.attrib)
+            elif depth == 3 and element.getparent().tag == AMDSEC:
+                orders.add(mets.order(element))
+        amd_children.extend((order, index, source) for order in orders)
+
+    return (sections, amd_children, amd_attrib)
+
+
+def _parse_partial(source, store):
+    """Parse the section element of a partial document.
+
+    :source: Source of the partial document from _scan_sections()
+    :store: Packed store of the workspace or None
+    :returns: Section element
+    """
+    if source[0] == 'packed':
+        source = ('data', store.read(source[1]))
+    return _parse_section(source)
+
+
+def _detached(element):
+    """Copy element from its partial document, so that it declares only
+    the namespaces it uses.
+
+    :element: Element to copy
+    :returns: Copy of the element
+    """
+    element = copy.deepcopy(element)
+    element.tail = None
+    lxml.etree.cleanup_namespaces(element)
+    return element
 
 
 def clean_metsparts(path):
@@ -273,6 +529,14 @@ def clean_metsparts(path):
                                '-scraper.json', '-amd.json'))):
                 os.remove(os.path.join(root, name))
 
+    # The other files are matched by their exact names in the top level
+    # of the workspace only, so that no copied digital objects are
+    # removed
+    for name in os.listdir(path):
+        if name in (CACHE_FILE, JOURNAL_FILE, AGENT_INDEX_FILE) or \
+                is_packed_amd_file(name):
+            os.remove(os.path.join(path, name))
+
 
 def copy_objects(workspace, data_dir):
     """
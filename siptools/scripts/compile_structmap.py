@@ -15,17 +15,18 @@ import xml_helpers.utils as xml_utils
 from siptools.scripts.create_agent import create_agent
 from siptools.scripts.premis_event import premis_event
 from siptools.ead_utils import compile_ead3_structmap
-from siptools.utils import (add,
-                            add_file_div,
+from siptools.utils import (add_file_div,
+                            DirectoryReferences,
+                            DivNode,
                             create_filegrp,
-                            encode_path,
+                            decode_path,
                             get_md_references,
                             get_reference_lists,
                             iter_supplementary,
-                            read_md_references,
-                            SUPPLEMENTARY_TYPES,
-                            tree)
+                            ReferenceContext,
+                            SUPPLEMENTARY_TYPES)
 from siptools.xml.mets import NAMESPACES
+from siptools.xml.xpath import METS_FILE_LOCATIONS
 
 import siptools
 
@@ -102,11 +103,13 @@ def compile_structmap(workspace='./workspace/',
     )
 
     # Get reference list only after the structmap creation event
+    reference_context = ReferenceContext(workspace)
     (all_amd_refs,
      all_dmd_refs,
      object_refs,
      filelist,
-     file_properties) = get_reference_lists(workspace=workspace)
+     file_properties) = get_reference_lists(
+         workspace=workspace, reference_context=reference_context)
 
     # Get all supplementary files.
     (supplementary_files, supplementary_types) = iter_supplementary(
@@ -123,7 +126,8 @@ def compile_structmap(workspace='./workspace/',
             object_refs=object_refs,
             file_properties=file_properties,
             supplementary_files=supplementary_files,
-            supplementary_types=supplementary_types)
+            supplementary_types=supplementary_types,
+            directory_references=reference_context.directory_references())
 
     else:
         (filesec, file_ids) = create_filesec(
@@ -144,7 +148,11 @@ def compile_structmap(workspace='./workspace/',
                                      root_type=root_type,
                                      file_ids=file_ids,
                                      file_properties=file_properties,
-                                     workspace=workspace)
+                                     workspace=workspace,
+                                     reference_context=reference_context,
+                                     directory_references=(
+                                         reference_context
+                                         .directory_references()))
 
     # Create a separate structmap for supplementary files if they exist
     if supplementary_files:
@@ -160,7 +168,9 @@ def compile_structmap(workspace='./workspace/',
             root_type=root_type,
             file_ids=file_ids,
             file_properties=file_properties,
-            workspace=workspace)
+            workspace=workspace,
+            reference_context=reference_context,
+            directory_references=reference_context.directory_references())
 
     if stdout:
         print(xml_utils.serialize(filesec).decode("utf-8"))
@@ -257,7 +267,9 @@ def create_structmap(filesec,
                      file_ids,
                      file_properties,
                      workspace,
-                     root_type='directory'):
+                     root_type='directory',
+                     reference_context=None,
+                     directory_references=None):
     """
     Create METS document element tree that contains structural map.
 
@@ -273,16 +285,29 @@ def create_structmap(filesec,
     :param structmap_type: TYPE attribute of structMap element If
                            missing, default value is None.
     :param file_ids: Dict with file paths and identifiers. Required by
-        create_div(). Will be computed if missing.
+        create_div(). Will be computed from filesec if missing.
     :param file_properties: Dictionary collection of file properties.
     :param workspace: Workspace path, required by create_div(). If
                       missing, default value is "./workspace/".
     :param root_type: TYPE attribute of root div element. If missing,
         default value is "directory".
+    :param reference_context: ReferenceContext of the workspace, for
+        reading the references of supplementary files. Will be created
+        if missing.
+    :param directory_references: DirectoryReferences of all_amd_refs
+        and all_dmd_refs. Will be created if missing.
     :returns: structural map element
     """
-    amdids = get_md_references(all_amd_refs, directory='.')
-    dmdids = get_md_references(all_dmd_refs, directory='.')
+    if directory_references is None:
+        directory_references = DirectoryReferences(all_amd_refs,
+                                                   all_dmd_refs)
+    (amdids, dmdids) = directory_references['.']
+
+    # Look up the file IDs from fileSec only once
+    if not file_ids:
+        file_ids = get_file_ids(filesec)
+    if reference_context is None:
+        reference_context = ReferenceContext(workspace)
 
     is_supplementary = False
     if structmap_type == 'Directory-physical':
@@ -312,12 +337,13 @@ def create_structmap(filesec,
                filesec=filesec,
                all_amd_refs=all_amd_refs,
                all_dmd_refs=all_dmd_refs,
-               supplementary_files=supplementary_files,
                file_ids=file_ids,
                structmap_type=structmap_type,
                workspace=workspace,
                file_properties=file_properties,
-               is_supplementary=is_supplementary)
+               is_supplementary=is_supplementary,
+               reference_context=reference_context,
+               directory_references=directory_references)
 
     mets_element = mets.mets(child_elements=[structmap])
     ET.cleanup_namespaces(mets_element)
@@ -337,33 +363,57 @@ def div_structure(filelist,
     :param supplementary_types: Supplementary types.
     :param is_supplementary: Boolean to indicate whether the structure
         should be for supplemenjtary files or not.
-    :returns: The div structure as a dict like object
+    :returns: The div structure as a DivNode, whose children are the
+        topmost divs
     """
-    divs = tree()
+    divs = DivNode()
+    names = {}
     if is_supplementary:
         for supplementary_type in supplementary_types:
             # Supplementary structure is flat, but with one div
-            # surrounding the files
-            root_div = divs[SUPPLEMENTARY_TYPES[supplementary_type]]
+            # surrounding the files. The surrounding div is not part of
+            # the file paths.
+            root_div = divs.child(SUPPLEMENTARY_TYPES[supplementary_type],
+                                  path='')
             for amd_file in supplementary_files:
                 if supplementary_files[amd_file] == supplementary_type:
-                    add(root_div, [amd_file])
+                    root_div.child(amd_file).is_file = True
     else:
         # Directory based structure is like a directory tree
         for amd_file in filelist:
             # Do not add supplementary files to the directory based
             # structmap
             if amd_file not in supplementary_files:
-                add(divs, amd_file.split('/'))
+                divs.add_file(amd_file, names=names)
     return divs
 
 
+def get_file_ids(filesec):
+    """Return the IDs of all files in fileSec.
+
+    The fileSec is read only once, so that the file IDs can be looked
+    up without searching the fileSec for every file.
+
+    :filesec: fileSec element
+    :returns: Dict of file paths and file IDs
+    """
+    file_ids = {}
+    for flocat in METS_FILE_LOCATIONS(filesec):
+        href = flocat.get('{%s}href' % NAMESPACES['xlink'])
+        if href is None or not href.startswith('file://'):
+            continue
+        # The first file with the path is used, as in the fileSec search
+        file_ids.setdefault(decode_path(href[len('file://'):]),
+                            flocat.getparent().attrib['ID'])
+    return file_ids
+
+
 def get_fileid(filesec, path, file_ids=None):
     """Return the ID for a file.
 
-    Either finds a file with `path` from
-    fileSec or reads the ID from a dict of `path` and `ID`. Returns the
-    ID attribute of the matching file element.
+    Reads the ID from a dict of `path` and `ID`. If the dict is not
+    given, it is created from fileSec with get_file_ids(). To look up
+    several files, create the dict once and give it in `file_ids`.
 
     :filesec: fileSec element
     :path: path of the file
@@ -371,18 +421,9 @@ def get_fileid(filesec, path, file_ids=None):
     :returns: file identifier
     """
     if not file_ids:
-        encoded_path = encode_path(path, safe='/')
-        element = filesec.xpath(
-            '//mets:fileGrp/mets:file/mets:FLocat[@xlink:href="file://%s"]/..'
-            % encoded_path,
-            namespaces=NAMESPACES
-        )[0]
-
-        fileid = element.attrib['ID']
-    else:
-        fileid = file_ids[path]
+        file_ids = get_file_ids(filesec)
 
-    return fileid
+    return file_ids[path]
 
 
 # pylint: disable=too-many-arguments
@@ -393,100 +434,102 @@ def create_div(divs,
                filesec,
                all_amd_refs,
                all_dmd_refs,
-               supplementary_files,
                file_ids,
                structmap_type,
                workspace,
                file_properties,
-               path='',
-               is_supplementary=False):
-    """Recursively create fileSec and structmap divs based on directory
-    structure.
-
-    :param divs: Current directory or file in directory structure
-                 walkthrough
+               is_supplementary=False,
+               reference_context=None,
+               directory_references=None):
+    """Create fileSec and structmap divs based on directory structure.
+
+    The directory structure is walked with an explicit stack instead of
+    recursion, so that the depth of the structure is not limited by the
+    recursion limit. The child elements of each div are the fptr
+    elements first, then the file divs and then the directory divs.
+
+    :param divs: DivNode of the topmost directory in directory
+                 structure walkthrough, see div_structure()
     :param parent: Parent element in structMap
     :param filesec: filesec element
     :param all_amd_refs: XML element tree of administrative metadata
         references.
     :param all_dmd_refs: XML element tree of descriptive metadata
         references.
-    :param supplementary_files: ID list of supplementary objects.
-        Will be populated if supplementary objects exist.
     :param file_ids: Dict with file paths and identifiers.
     :param workspace: Workspace path, required by add_file_div().
     :param file_properties: Dictionary collection of file properties.
-    :param path: Current path in directory structure walkthrough
     :param is_supplementary: A boolean to indicate if a supplementary
-                       structure is expected or not
+                       structure is expected or not. Only the divs
+                       directly under the topmost directory can be
+                       supplementary divs.
+    :param reference_context: ReferenceContext of the workspace. Will
+                              be created if missing.
+    :param directory_references: DirectoryReferences of all_amd_refs
+                                 and all_dmd_refs. Will be created if
+                                 missing.
     :returns: ``None``
     """
-    fptr_list = []
-    property_list = []
-    div_list = []
-    collection = file_properties
-    for div in divs.keys():
-        div_path = os.path.join(path, div)
-        if is_supplementary:
-            collection = supplementary_files
-            # Remove supplementary root div from current div path
-            supplementary_type = div_path.split('/')[0]
-            div_path = div_path[len(supplementary_type) + 1:]
-        # It's a file, lets create file+fptr elements
-        if div_path in collection:
-            fptr = mets.fptr(get_fileid(filesec, div_path, file_ids))
-            div_elem = add_file_div(fptr=fptr,
-                                    properties=file_properties[div_path])
-            if div_elem is not None:
-                property_list.append(div_elem)
-            else:
-                fptr_list.append(fptr)
-
-        # It's not a file, lets create a div element
-        else:
-            amdids = get_md_references(all_amd_refs, directory=div_path)
-            dmdsec_id = get_md_references(all_dmd_refs, directory=div_path)
-
-            # Some supplementary divs require links to the amdSec
-            if is_supplementary:
-                try:
-                    amdids = get_md_references(
-                        read_md_references(
-                            workspace,
-                            SUPPLEMENTARY_REFERENCE_FILES[div]),
-                        directory='.')
-                except KeyError:
-                    pass
-
-            if structmap_type == 'Directory-physical':
-                div_elem = mets.div(type_attr='directory',
-                                    label=div,
-                                    dmdid=dmdsec_id,
-                                    admid=amdids)
+    if reference_context is None:
+        reference_context = ReferenceContext(workspace)
+    if directory_references is None:
+        directory_references = DirectoryReferences(all_amd_refs,
+                                                   all_dmd_refs)
+
+    # Directories whose child elements are still to be created, with
+    # their parent elements
+    stack = [(divs, parent, is_supplementary)]
+    while stack:
+        (divs, parent, is_supplementary) = stack.pop()
+        fptr_list = []
+        property_list = []
+        div_list = []
+        for node in divs.iter_children():
+            div = node.name
+            div_path = node.path
+            # It's a file, lets create file+fptr elements
+            if node.is_file:
+                fptr = mets.fptr(get_fileid(filesec, div_path, file_ids))
+                div_elem = add_file_div(
+                    fptr=fptr, properties=file_properties[div_path])
+                if div_elem is not None:
+                    property_list.append(div_elem)
+                else:
+                    fptr_list.append(fptr)
+
+            # It's not a file, lets create a div element
             else:
-                div_elem = mets.div(type_attr=div,
-                                    dmdid=dmdsec_id,
-                                    admid=amdids)
-            div_list.append(div_elem)
-            create_div(divs=divs[div],
-                       parent=div_elem,
-                       filesec=filesec,
-                       all_amd_refs=all_amd_refs,
-                       all_dmd_refs=all_dmd_refs,
-                       supplementary_files=supplementary_files,
-                       file_ids=file_ids,
-                       structmap_type=structmap_type,
-                       workspace=workspace,
-                       file_properties=file_properties,
-                       path=div_path)
-
-    # Add fptr list first, then div list
-    for fptr in fptr_list:
-        parent.append(fptr)
-    for div_elem in property_list:
-        parent.append(div_elem)
-    for div_elem in div_list:
-        parent.append(div_elem)
+                (amdids, dmdsec_id) = directory_references[div_path]
+
+                # Some supplementary divs require links to the amdSec
+                if is_supplementary:
+                    try:
+                        amdids = get_md_references(
+                            reference_context.md_references(
+                                SUPPLEMENTARY_REFERENCE_FILES[div]),
+                            directory='.')
+                    except KeyError:
+                        pass
+
+                if structmap_type == 'Directory-physical':
+                    div_elem = mets.div(type_attr='directory',
+                                        label=div,
+                                        dmdid=dmdsec_id,
+                                        admid=amdids)
+                else:
+                    div_elem = mets.div(type_attr=div,
+                                        dmdid=dmdsec_id,
+                                        admid=amdids)
+                div_list.append(div_elem)
+                stack.append((node, div_elem, False))
+
+        # Add fptr list first, then div list
+        for fptr in fptr_list:
+            parent.append(fptr)
+        for div_elem in property_list:
+            parent.append(div_elem)
+        for div_elem in div_list:
+            parent.append(div_elem)
 
 
 def _create_event(
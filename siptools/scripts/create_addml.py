@@ -197,13 +197,14 @@ class AddmlCreator(MetsSectionCreator):
                 flat_file_str(encode_path(filename), "ref001")
                 for filename in filenames
             ]
-            append_lines(amd_fname, "<addml:flatFiles>", append)
+            append_lines(amd_fname, "<addml:flatFiles>", append,
+                         amd_store=self.amd_store)
 
         # Write md-references
         self.write_references(ref_file=ref_file)
 
         # Clear filenames and etrees
-        self.__init__(self.workspace)
+        self.clear()
 
 
 def flat_file_str(fname, def_ref):
@@ -275,31 +276,43 @@ def csv_header(attributes):
     return header
 
 
-def append_lines(fname, xml_elem, append):
+def append_lines(fname, xml_elem, append, amd_store=None):
     """Append all the lines in list append to file fname below
     the line with xml_elem.
 
     :fname: File name
     :xml_elem: Element below which to append
     :append: List of lines to append
+    :amd_store: Packed store of the workspace, used if the file is
+                stored in it
     :returns: None
     """
+    name = os.path.basename(fname)
+    packed = amd_store is not None and name in amd_store
 
     # Read all the lines into memory
-    with io.open(fname, 'rt') as f_in:
-        lines = f_in.readlines()
+    if packed:
+        lines = amd_store.read(name).decode('utf-8').splitlines(True)
+    else:
+        with io.open(fname, 'rt') as f_in:
+            lines = f_in.readlines()
 
-    # Overwrite the file appending line_content
-    with io.open(fname, 'wt') as f_out:
+    output = []
+    for line in lines:
+        output.append(line)
 
-        for line in lines:
-            f_out.write(line)
+        if line.strip() == xml_elem:
+            indent = len(line) - len(line.lstrip()) + 2
 
-            if line.strip() == xml_elem:
-                indent = len(line) - len(line.lstrip()) + 2
+            for new_line in append:
+                output.append(" " * indent + new_line)
 
-                for new_line in append:
-                    f_out.write(" " * indent + new_line)
+    # Overwrite the file appending line_content
+    if packed:
+        amd_store.write(name, "".join(output).encode('utf-8'))
+    else:
+        with io.open(fname, 'wt') as f_out:
+            f_out.writelines(output)
 
 
 # pylint: disable=too-many-locals
@@ -11,7 +11,7 @@ import six
 import nisomix
 from file_scraper.defaults import UNAV
 from siptools.mdcreator import MetsSectionCreator
-from siptools.utils import scrape_file
+from siptools.utils import metadata_key, scrape_file
 
 click.disable_unicode_literals_warning = True
 
@@ -89,11 +89,22 @@ class MixCreator(MetsSectionCreator):
         :returns: None
         """
 
+        (streams, _, _) = scrape_file(filepath=filepath,
+                                      filerel=filerel,
+                                      workspace=self.workspace,
+                                      skip_well_check=True)
+
+        # MIX metadata depends only on the stream metadata, so identical
+        # images are hashed only once
+        md_key = metadata_key(streams[0])
+
         # Create MIX metadata
-        mix = create_mix_metadata(filepath, filerel, self.workspace)
+        mix = create_mix_metadata(filepath, filerel, self.workspace,
+                                  streams=streams)
         if mix is not None:
             self.add_md(metadata=mix,
-                        filename=(filerel if filerel else filepath))
+                        filename=(filerel if filerel else filepath),
+                        md_key=md_key)
 
     # Change the default write parameters
     # pylint: disable=too-many-arguments
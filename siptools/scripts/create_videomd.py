@@ -9,7 +9,8 @@ import six
 
 import videomd
 from siptools.mdcreator import MetsSectionCreator
-from siptools.utils import fix_missing_metadata, scrape_file
+from siptools.utils import (fix_missing_metadata, metadata_key,
+                            scrape_file)
 
 click.disable_unicode_literals_warning = True
 
@@ -81,18 +82,30 @@ class VideomdCreator(MetsSectionCreator):
         :filerel: Video file path relative to base path
         """
 
+        (streams, _, _) = scrape_file(filepath=filepath,
+                                      filerel=filerel,
+                                      workspace=self.workspace,
+                                      skip_well_check=True)
+
+        # VideoMD metadata depends only on the stream metadata, so identical
+        # streams are hashed only once
+        md_keys = dict((six.text_type(index), metadata_key(stream))
+                       for (index, stream) in six.iteritems(streams))
+
         # Create videoMD metadata
         videomd_dict = create_videomd_metadata(
-            filepath, filerel, self.workspace
+            filepath, filerel, self.workspace, streams=streams
         )
         if '0' in videomd_dict and len(videomd_dict) == 1:
             self.add_md(metadata=videomd_dict['0'],
-                        filename=(filerel if filerel else filepath))
+                        filename=(filerel if filerel else filepath),
+                        md_key=md_keys['0'])
         else:
             for index, video in six.iteritems(videomd_dict):
                 self.add_md(metadata=video,
                             filename=(filerel if filerel else filepath),
-                            stream=index)
+                            stream=index,
+                            md_key=md_keys[index])
 
     # pylint: disable=too-many-arguments
     def write(self, mdtype="OTHER", mdtypeversion="2.0",
@@ -1,11 +1,17 @@
 """Command line tool for importing digital objects."""
 from __future__ import unicode_literals
 
+import collections
 import datetime
 import fnmatch
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import platform
 import sys
+import time
 from uuid import uuid4
 import file_scraper
 
@@ -14,10 +20,20 @@ import six
 
 import premis
 from siptools.mdcreator import MetsSectionCreator
-from siptools.utils import scrape_file, calc_checksum
-from siptools.scripts.premis_event import premis_event, create_premis_event
+from siptools.packed_amd import (amd_file_exists, get_packed_amd,
+                                 init_packed_amd)
+from siptools.scraper_cache import ScraperCache, file_identity
+from siptools.utils import scrape_file, calc_checksums
+from siptools.scripts.premis_event import (premis_events,
+                                           create_premis_event)
 from siptools.scripts.create_agent import create_agent
-from siptools.utils import generate_digest, encode_path
+from siptools.utils import (encode_path, fsdecode_path, generate_digest,
+                            iter_md_references, read_md_references)
+
+try:
+    from scandir import scandir  # Python 2
+except ImportError:
+    from os import scandir  # Python 3+
 
 
 click.disable_unicode_literals_warning = True
@@ -41,6 +57,32 @@ UNKNOWN_VERSION = '(:unav)'
 # Supported bit-level preservation types
 SUPPLEMENTARY_TYPES = ["xml_schema"]
 
+# Supported checksum algorithms and their names in PREMIS
+CHECKSUM_ALGORITHMS = {
+    'md5': 'MD5',
+    'sha1': 'SHA-1',
+    'sha224': 'SHA-224',
+    'sha256': 'SHA-256',
+    'sha384': 'SHA-384',
+    'sha512': 'SHA-512',
+}
+
+# How many files per worker process may be scraped ahead of the PREMIS
+# metadata creation
+WORKER_QUEUE_SIZE = 4
+
+# Progress journal of checkpointed runs
+JOURNAL_FILE = 'import-object-journal.jsonl'
+
+# Options that are not part of the key of a run in the journal
+JOURNAL_IGNORED_OPTIONS = ('event_datetime', 'stdout', 'workers',
+                           'checkpoint_files', 'checkpoint_seconds',
+                           'no_cache')
+
+# Files of the PREMIS objects that are removed, if they are left
+# unreferenced by an interrupted run
+UNREFERENCED_SUFFIXES = ('-PREMIS%3AOBJECT-amd.xml', '-scraper.json')
+
 
 @click.command()
 @click.argument('filepaths', nargs=-1, type=str)
@@ -77,6 +119,12 @@ SUPPLEMENTARY_TYPES = ["xml_schema"]
     '--checksum', nargs=2, type=str,
     metavar='<CHECKSUM ALGORITHM> <CHECKSUM VALUE>',
     help='Checksum algorithm and value of a given file.')
+@click.option(
+    '--checksum_algorithms', type=str, default='md5',
+    metavar='<ALGORITHM>[,<ALGORITHM>...]',
+    help='Comma separated list of algorithms used for calculating the '
+         'checksums, if --checksum is not given. Supported algorithms are: '
+         '%s. Defaults to md5.' % ', '.join(sorted(CHECKSUM_ALGORITHMS)))
 @click.option(
     '--date_created', type=str,
     metavar='<ISO-8601 TIME>',
@@ -109,6 +157,34 @@ SUPPLEMENTARY_TYPES = ["xml_schema"]
     help='Used to mark supplementary files, files that are not part of the '
          'contents per se, but are to be included in the SIP. May be used '
          'multiple times, but currently only "xml_schema" type is supported.')
+@click.option(
+    '--workers', type=click.IntRange(min=1), default=1,
+    metavar='<WORKERS>',
+    help='Number of worker processes used for scraping the files. '
+         'Defaults to 1.')
+@click.option(
+    '--checkpoint_files', type=click.IntRange(min=1),
+    metavar='<NUMBER OF FILES>',
+    help='Write the metadata of the imported files to the workspace '
+         'after every given number of files. The progress is recorded in '
+         'a journal, and a restarted run with the same arguments skips the '
+         'files already written.')
+@click.option(
+    '--checkpoint_seconds', type=click.IntRange(min=1),
+    metavar='<SECONDS>',
+    help='Write the metadata of the imported files to the workspace '
+         'after every given number of seconds. Works like '
+         '--checkpoint_files, and the two may be used together.')
+@click.option(
+    '--no_cache', is_flag=True,
+    help='Do not use or update the cache of scraping results in the '
+         'workspace.')
+@click.option(
+    '--packed_amd', is_flag=True,
+    help='Store the administrative metadata files of the workspace in a '
+         'few large segment files instead of a file per metadata '
+         'element. All scripts use the packed store of the workspace '
+         'after this.')
 # pylint: disable=too-many-arguments
 def main(**kwargs):
     """Import files to generate digital objects.
@@ -143,6 +219,7 @@ def _attribute_values(given_params):
         "format_registry": (),
         "identifier": (),
         "checksum": (),
+        "checksum_algorithms": ("md5",),
         "date_created": None,
         "creating_application": None,
         "creating_application_version": None,
@@ -150,7 +227,12 @@ def _attribute_values(given_params):
         "event_datetime": datetime.datetime.now().isoformat(),
         "event_target": None,
         "stdout": False,
-        "supplementary": ()
+        "supplementary": (),
+        "workers": 1,
+        "checkpoint_files": None,
+        "checkpoint_seconds": None,
+        "no_cache": False,
+        "packed_amd": False
     }
     for key in given_params:
         if given_params[key]:
@@ -176,6 +258,9 @@ def import_object(**kwargs):
                  format_registry: Format registry name and value (tuple)
                  identifier: File identifier type and value (tuple)
                  checksum: Checksum algorithm and value (tuple)
+                 checksum_algorithms: Algorithms used for calculating
+                                      the checksums, if checksum is not
+                                      given
                  date_created: Creation date of a file
                  creating_application: Software that created the file
                  creating_application_version: Software version of creating application
@@ -184,36 +269,82 @@ def import_object(**kwargs):
                  event_target: The target of the event
                  stdout: True prints output to stdout
                  supplementary: Object type for supplementary files
+                 workers: Number of worker processes used for scraping
+                 checkpoint_files: Write metadata after every given
+                                   number of files
+                 checkpoint_seconds: Write metadata after every given
+                                     number of seconds
+                 no_cache: True disables the cache of scraping results
+                 packed_amd: True makes the workspace packed, see
+                             siptools.packed_amd
     """
     attributes = _attribute_values(kwargs)
+    if attributes["packed_amd"]:
+        init_packed_amd(attributes["workspace"])
+    attributes["checksum_algorithms"] = _parse_checksum_algorithms(
+        attributes["checksum_algorithms"])
     # Loop files and create premis objects
     files = collect_filepaths(dirs=attributes["filepaths"],
                               base=attributes["base_path"])
     creator = PremisCreator(attributes["workspace"])
+    cache = None
+    if not attributes["no_cache"]:
+        cache = ScraperCache(attributes["workspace"],
+                             _scraper_options(attributes))
     agents = []
-    for filepath in files:
-
-        # If the given path is an absolute path and base_path is current
-        # path (i.e. not given), relpath will return ../../.. sequences,
-        # if current path is not part of the absolute path. In such case
-        # we will use the absolute path for filerel and omit base_path
-        # relation.
-        if attributes["base_path"] not in ['.']:
-            filerel = os.path.relpath(filepath, attributes["base_path"])
-        else:
-            filerel = filepath
 
-        properties = {}
-        if attributes["order"] is not None:
-            properties['order'] = six.text_type(attributes["order"])
-        properties["supplementary"] = attributes["supplementary"]
+    # Skip the files written by an interrupted checkpointed run
+    run_key = _journal_run_key(attributes)
+    journal = None
+    if attributes["checkpoint_files"] or attributes["checkpoint_seconds"]:
+        journal = ImportJournal(attributes["workspace"], run_key,
+                                attributes["checkpoint_files"],
+                                attributes["checkpoint_seconds"])
+        agents.extend(journal.agents)
+        grade = journal.grade
+        files = (filepath for filepath in files
+                 if filepath not in journal.paths)
 
-        (streams, scraper_info) = creator.add_premis_md(
-            filepath, attributes, filerel=filerel, properties=properties)
-        for index in scraper_info:
-            agents.append(_parse_scraper_tools(scraper_info[index]))
-
-        grade = streams[0]['properties']['grade']
+    try:
+        for filepath, scraped in _iter_scraped_objects(
+                files, attributes, cache):
+
+            # If the given path is an absolute path and base_path is
+            # current path (i.e. not given), relpath will return
+            # ../../.. sequences, if current path is not part of the
+            # absolute path. In such case we will use the absolute path
+            # for filerel and omit base_path relation.
+            if attributes["base_path"] not in ['.']:
+                filerel = os.path.relpath(filepath,
+                                          attributes["base_path"])
+            else:
+                filerel = filepath
+
+            properties = {}
+            if attributes["order"] is not None:
+                properties['order'] = six.text_type(attributes["order"])
+            properties["supplementary"] = attributes["supplementary"]
+
+            (streams, scraper_info) = creator.add_premis_md(
+                filepath, attributes, filerel=filerel,
+                properties=properties, scraped=scraped)
+            file_agents = [_parse_scraper_tools(scraper_info[index])
+                           for index in scraper_info]
+            agents.extend(file_agents)
+
+            grade = streams[0]['properties']['grade']
+
+            if journal is not None:
+                journal.add(filepath, filerel, file_agents, grade)
+                if journal.checkpoint_due():
+                    journal.prepare()
+                    creator.write(stdout=attributes["stdout"])
+                    if cache is not None:
+                        cache.commit()
+                    journal.commit()
+    finally:
+        if cache is not None:
+            cache.close()
 
     is_native = grade in (
         file_scraper.defaults.BIT_LEVEL,
@@ -225,7 +356,11 @@ def import_object(**kwargs):
         and not is_native
     )
 
+    if journal is not None:
+        journal.prepare()
     creator.write(stdout=attributes["stdout"])
+    if journal is not None:
+        journal.commit()
 
     # Create events documenting the technical metadata creation
     _create_events(
@@ -240,12 +375,260 @@ def import_object(**kwargs):
         agents=agents
     )
 
+    # The run is complete, so the next run must not skip any files
+    _remove_journal(attributes["workspace"], run_key)
+
+
+class ImportJournal(object):
+    """Progress journal of a checkpointed import-object run.
+
+    The journal starts with the key of the run, see _journal_run_key(),
+    so that only a run with the same file paths and options resumes
+    from it. At each checkpoint, the files whose metadata is about to be
+    written to the workspace are recorded in the journal, together with
+    the agents and the grade needed for creating the events at the end
+    of the run. After the metadata has been written, the checkpoint is
+    confirmed with a separate line. If the run is interrupted between
+    these, the files of the checkpoint whose references were written to
+    the workspace are regarded as imported, so that they are not
+    imported again with new PREMIS object identifiers, and the PREMIS
+    object files written for the rest are removed.
+    """
+
+    def __init__(self, workspace, run_key, checkpoint_files=None,
+                 checkpoint_seconds=None):
+        """
+        Read the journal of an interrupted run, if there is one.
+
+        :workspace: Workspace path
+        :run_key: Key of the run, see _journal_run_key()
+        :checkpoint_files: Number of files between checkpoints
+        :checkpoint_seconds: Number of seconds between checkpoints
+        :raises: ValueError if the workspace has a journal of a run with
+                 different file paths or options.
+        """
+        self.workspace = workspace
+        self.path = os.path.join(workspace, JOURNAL_FILE)
+        self.run_key = run_key
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_seconds = checkpoint_seconds
+        self.paths = set()
+        self.agents = []
+        self.grade = None
+        self._pending = []
+        self._pending_filerels = []
+        self._pending_agents = {}
+        self._prepared = False
+        self._started = False
+        self._end_line = False
+        self._last_commit = time.time()
+
+        if os.path.isfile(self.path):
+            if _read_journal_run_key(self.path) != run_key:
+                raise ValueError(
+                    'The workspace has the journal of an interrupted '
+                    'import-object run with different file paths or '
+                    'options. Resume that run with the same arguments, '
+                    'or remove %s to start a new run.' % self.path)
+            self._started = True
+            self._read()
+
+    def _read(self):
+        """Read the imported files, agents and grade from the journal."""
+        checkpoints = []
+        with open(self.path, 'rt') as in_file:
+            for line in in_file:
+                self._end_line = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Incomplete line of an interrupted write
+                    continue
+                if 'run' in record:
+                    continue
+                if record.get('written'):
+                    if checkpoints:
+                        checkpoints[-1]['written'] = True
+                else:
+                    checkpoints.append(record)
+
+        object_refs = None
+        for checkpoint in checkpoints:
+            paths = checkpoint['paths']
+            if not checkpoint.get('written'):
+                # The run was interrupted while writing the metadata
+                if object_refs is None:
+                    object_refs = read_md_references(
+                        self.workspace,
+                        'import-object-md-references.jsonl') or {}
+                paths = [path for (path, filerel)
+                         in zip(paths, checkpoint['filerels'])
+                         if filerel in object_refs]
+                if len(paths) < len(checkpoint['paths']):
+                    _remove_unreferenced_objects(self.workspace)
+                if not paths:
+                    continue
+            self.paths.update(paths)
+            self.agents.extend(checkpoint['agents'])
+            self.grade = checkpoint['grade']
+
+    def add(self, filepath, filerel, agents, grade):
+        """Add an imported file to be recorded at the next checkpoint.
+
+        :filepath: Path of the imported file
+        :filerel: Path of the file in the metadata references
+        :agents: Agents parsed from the scraper info of the file
+        :grade: Digital preservation grade of the file
+        """
+        self._pending.append(filepath)
+        self._pending_filerels.append(fsdecode_path(filerel))
+        for agent in agents:
+            self._pending_agents[json.dumps(agent, sort_keys=True)] = agent
+        self.grade = grade
+
+    def checkpoint_due(self):
+        """Return True if the metadata should be written now."""
+        if self.checkpoint_files and \
+                len(self._pending) >= self.checkpoint_files:
+            return True
+        if self.checkpoint_seconds and \
+                time.time() - self._last_commit >= self.checkpoint_seconds:
+            return True
+        return False
+
+    def prepare(self):
+        """Record the pending files before their metadata is written."""
+        if not self._pending:
+            return
+        self._write({'paths': self._pending,
+                     'filerels': self._pending_filerels,
+                     'agents': list(self._pending_agents.values()),
+                     'grade': self.grade})
+        self._prepared = True
+
+    def commit(self):
+        """Record the pending files as written.
+
+        Must be called only after prepare() and after the metadata of
+        the files has been written to the workspace.
+        """
+        self._last_commit = time.time()
+        if not self._prepared:
+            return
+
+        self._write({'written': True})
+        self.paths.update(self._pending)
+        self._pending = []
+        self._pending_filerels = []
+        self._pending_agents = {}
+        self._prepared = False
+
+    def _write(self, record):
+        """Append a record to the journal and flush it to the disk. The
+        journal is started with the key of the run.
+
+        :record: Record as a dict
+        """
+        with open(self.path, 'at') as out_file:
+            if self._end_line:
+                out_file.write('\n')
+                self._end_line = False
+            if not self._started:
+                out_file.write(json.dumps({'run': self.run_key}) + '\n')
+                self._started = True
+            out_file.write(json.dumps(record) + '\n')
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+
+def _journal_run_key(attributes):
+    """Return the key of an import-object run for the journal.
+
+    The key is a digest of the file paths and of the options that affect
+    the imported metadata. The options that only affect how the run is
+    executed, and the event datetime that defaults to the current time,
+    are left out.
+
+    :attributes: Attributes of the run, see _attribute_values()
+    :returns: Key as a string
+    """
+    options = dict(
+        (key, value) for (key, value) in six.iteritems(attributes)
+        if key not in JOURNAL_IGNORED_OPTIONS)
+    return hashlib.md5(
+        json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _read_journal_run_key(path):
+    """Read the key of the run from a journal.
+
+    :path: Path of the journal
+    :returns: Key of the run, or None if the journal does not exist or
+              does not start with a key
+    """
+    try:
+        with open(path, 'rt') as in_file:
+            return json.loads(in_file.readline()).get('run')
+    except (IOError, ValueError):
+        return None
+
+
+def _remove_journal(workspace, run_key):
+    """Remove the journal of a run after the run has been completed. The
+    journal of some other interrupted run is kept.
+
+    :workspace: Workspace path
+    :run_key: Key of the run, see _journal_run_key()
+    """
+    path = os.path.join(workspace, JOURNAL_FILE)
+    if _read_journal_run_key(path) == run_key:
+        os.remove(path)
+
+
+def _remove_unreferenced_objects(workspace):
+    """Remove the PREMIS object files and the scraper JSON files that are
+    not referenced by any reference file of the workspace.
+
+    These are left behind, when a run is interrupted after writing some
+    of the metadata files of a checkpoint, but before writing their
+    references. The files would otherwise end up in the METS document
+    as PREMIS objects of no file.
+
+    :workspace: Workspace path
+    """
+    md_ids = set()
+    for ref_path in glob.glob(os.path.join(workspace,
+                                           '*md-references.jsonl')):
+        for (_, reference) in iter_md_references(
+                workspace, os.path.basename(ref_path)):
+            md_ids.update(reference['md_ids'])
+            if isinstance(reference.get('streams'), dict):
+                for stream_ids in six.itervalues(reference['streams']):
+                    md_ids.update(stream_ids)
+
+    def _unreferenced(name):
+        """Return True for an unreferenced PREMIS object or scraper
+        JSON file name.
+        """
+        return name.endswith(UNREFERENCED_SUFFIXES) and \
+            '_%s' % name.split('-', 1)[0] not in md_ids
+
+    for entry in scandir(workspace):
+        if _unreferenced(entry.name):
+            os.remove(entry.path)
+    amd_store = get_packed_amd(workspace)
+    if amd_store is not None:
+        for name in [name for name in amd_store.names()
+                     if _unreferenced(name)]:
+            amd_store.remove(name)
+
 
 class PremisCreator(MetsSectionCreator):
     """PREMIS metadata generator for files and streams."""
 
-    def add_premis_md(
-            self, filepath, attributes, filerel=None, properties=None):
+    # pylint: disable=too-many-arguments
+    def add_premis_md(self, filepath, attributes, filerel=None,
+                      properties=None, scraped=None):
         """
         Create metadata for PREMIS metadata.
 
@@ -269,23 +652,14 @@ class PremisCreator(MetsSectionCreator):
                      checksum: Checksum algorithm and value (tuple)
                      date_created: Creation date of a file
         :filerel: Relative path from base_path to file
+        :properties: File properties to add to the stream dict
+        :scraped: Result of _scrape_object() for the file, if the file
+                  has already been scraped
         :returns: Stream dict and info dict from file-scraper as a tuple
         """
-        if not attributes["file_format"]:
-            mimetype = "(:unav)"
-            version = "(:unav)"
-        else:
-            mimetype = attributes["file_format"][0]
-            version = attributes["file_format"][1]
-
-        (streams, info, grade) = scrape_file(
-            filepath=filepath,
-            skip_well_check=attributes["skip_wellformed_check"],
-            mimetype=mimetype,
-            version=version,
-            charset=attributes["charset"],
-            skip_json=True
-        )
+        if scraped is None:
+            scraped = _scrape_object(filepath, attributes)
+        (streams, info, grade, checksums) = scraped
 
         # Add new properties of a file for other script files, e.g.
         # structMap
@@ -293,7 +667,8 @@ class PremisCreator(MetsSectionCreator):
         if properties:
             streams[0]['properties'].update(properties)
 
-        premis_elem = create_premis_object(filepath, streams, **attributes)
+        premis_elem = create_premis_object(
+            filepath, streams, checksums=checksums, **attributes)
         self.add_md(premis_elem, filerel, given_metadata_dict=streams)
         premis_list = create_streams(streams, premis_elem)
 
@@ -316,6 +691,209 @@ class PremisCreator(MetsSectionCreator):
         )
 
 
+def _scrape_object(filepath, attributes):
+    """Scrape a file and calculate its checksum for PREMIS metadata
+    creation.
+
+    The checksum is calculated right after scraping, while the file
+    contents are still likely to be in the page cache. This is run in
+    the worker processes, so it must not write anything to the
+    workspace.
+
+    :filepath: Full path to file (including base_path)
+    :attributes: The following keys
+                 skip_wellformed_check: True skips well-formedness
+                                        checking
+                 charset: Character encoding of a file
+                 file_format: File format and version (tuple) of a
+                              file
+                 checksum: Checksum algorithm and value (tuple)
+                 checksum_algorithms: Algorithms used for calculating
+                                      the checksums
+    :returns: Stream dict, info dict and digital preservation grade
+              from file-scraper, and list of checksum algorithm and
+              value tuples as a tuple
+    """
+    if not attributes["file_format"]:
+        mimetype = "(:unav)"
+        version = "(:unav)"
+    else:
+        mimetype = attributes["file_format"][0]
+        version = attributes["file_format"][1]
+
+    (streams, info, grade) = scrape_file(
+        filepath=filepath,
+        skip_well_check=attributes["skip_wellformed_check"],
+        mimetype=mimetype,
+        version=version,
+        charset=attributes["charset"],
+        skip_json=True
+    )
+
+    checksums = _object_checksums(filepath, attributes)
+
+    return (streams, info, grade, checksums)
+
+
+def _parse_checksum_algorithms(algorithms):
+    """Parse and check the checksum algorithms.
+
+    :algorithms: Comma separated string or list of algorithm names
+    :returns: List of unique lowercase algorithm names
+    :raises: ValueError if an algorithm is not supported.
+    """
+    if isinstance(algorithms, six.string_types):
+        algorithms = algorithms.split(',')
+
+    parsed = []
+    for algorithm in algorithms:
+        algorithm = algorithm.strip().lower()
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError(
+                'Unsupported checksum algorithm: %s' % algorithm)
+        if algorithm not in parsed:
+            parsed.append(algorithm)
+
+    return parsed
+
+
+def _object_checksums(filepath, attributes):
+    """Return the checksums of a file for the PREMIS fixity elements.
+
+    The given checksum is used if there is one, otherwise the checksums
+    are calculated with all the algorithms in one read of the file.
+
+    :filepath: Full path to file (including base_path)
+    :attributes: The following keys
+                 checksum: Checksum algorithm and value (tuple)
+                 checksum_algorithms: Algorithms used for calculating
+                                      the checksums
+    :returns: List of checksum algorithm and value tuples
+    """
+    if attributes["checksum"]:
+        return [tuple(attributes["checksum"])]
+
+    algorithms = _parse_checksum_algorithms(
+        attributes["checksum_algorithms"])
+    values = calc_checksums(filepath, algorithms)
+    return [(CHECKSUM_ALGORITHMS[algorithm], value)
+            for (algorithm, value) in zip(algorithms, values)]
+
+
+def _scraper_options(attributes):
+    """Return the options that affect the result of _scrape_object().
+
+    :attributes: Attributes for _scrape_object()
+    :returns: Dict of options
+    """
+    return {
+        'file_scraper_version': file_scraper.__version__,
+        'skip_wellformed_check': bool(attributes["skip_wellformed_check"]),
+        'charset': attributes["charset"],
+        'file_format': list(attributes["file_format"]),
+        'checksum': list(attributes["checksum"]),
+        'checksum_algorithms': list(_parse_checksum_algorithms(
+            attributes["checksum_algorithms"]))
+    }
+
+
+def _iter_scraped_objects(files, attributes, cache=None):
+    """Scrape files, in a pool of worker processes if several workers
+    are requested.
+
+    The results are yielded in the order of the given files, so that
+    the metadata is always created in the same order. Only
+    WORKER_QUEUE_SIZE files per worker are scraped ahead of the
+    consumer, and none when the files are scraped in this process, so
+    that the consumer can write the metadata of all the scraped files at
+    a checkpoint. Files found in the cache are not scraped again, and
+    new results are added to the cache. The worker pool is created only
+    when the first file not found in the cache is scraped.
+
+    :files: Iterable of file paths
+    :attributes: Attributes for _scrape_object(), and the number of
+                 worker processes in key "workers"
+    :cache: ScraperCache instance or None
+    :returns: Generator of tuples of file path and the result of
+              _scrape_object()
+    """
+    workers = attributes["workers"]
+    pool = None
+    queue_size = 1
+    if workers > 1:
+        queue_size = workers * WORKER_QUEUE_SIZE
+    try:
+        pending = collections.deque()
+        for filepath in files:
+            (identity, scraped) = _cached_scraping(filepath, cache)
+            if scraped is not None:
+                pending.append((filepath, None, scraped, None))
+            else:
+                if pool is None and workers > 1:
+                    pool = multiprocessing.Pool(workers)
+                pending.append(_submit_scraping(
+                    filepath, attributes, identity, pool))
+            if len(pending) >= queue_size:
+                yield _collect_scraping(pending.popleft(), cache)
+        while pending:
+            yield _collect_scraping(pending.popleft(), cache)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _cached_scraping(filepath, cache):
+    """Look up the scraping result of a file from the cache.
+
+    :filepath: Full path to file (including base_path)
+    :cache: ScraperCache instance or None
+    :returns: Tuple of file identity for caching the result (None if
+              the result must not be cached) and the cached result of
+              _scrape_object() (None if not found)
+    """
+    if cache is None:
+        return (None, None)
+    identity = file_identity(filepath)
+    scraped = cache.get(identity)
+    if scraped is not None:
+        return (None, scraped)
+    return (identity, None)
+
+
+def _submit_scraping(filepath, attributes, identity, pool):
+    """Start scraping a file.
+
+    :filepath: Full path to file (including base_path)
+    :attributes: Attributes for _scrape_object()
+    :identity: File identity for caching the result, or None
+    :pool: Worker pool, or None for scraping in this process
+    :returns: Tuple of file path, file identity, the result of
+              _scrape_object() (None if pending) and the pending result
+              from the pool (or None)
+    """
+    if pool is None:
+        return (filepath, identity, _scrape_object(filepath, attributes),
+                None)
+    return (filepath, identity, None,
+            pool.apply_async(_scrape_object, (filepath, attributes)))
+
+
+def _collect_scraping(submitted, cache):
+    """Wait for the result of _submit_scraping() and cache it.
+
+    :submitted: Tuple returned by _submit_scraping()
+    :cache: ScraperCache instance or None
+    :returns: Tuple of file path and the result of _scrape_object()
+    """
+    (filepath, identity, scraped, pending) = submitted
+    if pending is not None:
+        scraped = pending.get()
+    if cache is not None and identity is not None:
+        cache.put(identity, scraped)
+    return (filepath, scraped)
+
+
 def create_streams(streams, premis_file):
     """Create PREMIS objects for streams.
 
@@ -380,18 +958,22 @@ def check_metadata(mimetype, version, streams, fname):
 
 
 # pylint: disable=too-many-locals
-def create_premis_object(fname, streams, **attributes):
+def create_premis_object(fname, streams, checksums=None, **attributes):
     """
     Create Premis object for given file.
 
     :fname: File name of the digital object
     :streams: Streams from the Scraper
+    :checksums: List of checksum algorithm and value tuples. Calculated
+                if not given.
     :attributes: The following keys:
                  charset: Character encoding of a file
                  file_format: File format and version (tuple) of a file
                  format_registry: Format registry name and value (tuple)
                  identifier: File identifier type and value (tuple)
                  checksum: Checksum algorithm and value (tuple)
+                 checksum_algorithms: Algorithms used for calculating
+                                      the checksums
                  date_created: Creation date of a file
                  creating_application: Software that created the file
                  creating_application_version: Software version of creating application
@@ -399,13 +981,11 @@ def create_premis_object(fname, streams, **attributes):
     :raises: ValueError if character set is invalid for text files.
     """
     attributes = _attribute_values(attributes)
-    if not attributes["checksum"]:
-        attributes["checksum"] = ("MD5", calc_checksum(fname))
+    if checksums is None:
+        checksums = _object_checksums(fname, attributes)
     date_created = attributes["date_created"] or creation_date(fname)
-    if attributes["creating_application"]:
-        creating_application = attributes["creating_application"]
-    if attributes["creating_application_version"]:
-        creating_application_version = attributes["creating_application_version"]    
+    creating_application = attributes["creating_application"]
+    creating_application_version = attributes["creating_application_version"]
     if streams[0]['stream_type'] == 'text':
         charset = attributes["charset"] or streams[0]['charset']
     else:
@@ -443,8 +1023,8 @@ def create_premis_object(fname, streams, **attributes):
         identifier_value=identifier_value
     )
 
-    premis_fixity = premis.fixity(attributes["checksum"][1],
-                                  attributes["checksum"][0])
+    premis_fixities = [premis.fixity(value, algorithm)
+                       for (algorithm, value) in checksums]
     premis_format_des = premis.format_designation(
         file_format[0] + charset_mime, file_format[1])
     if not attributes["format_registry"]:
@@ -465,7 +1045,7 @@ def create_premis_object(fname, streams, **attributes):
     premis_create = \
         premis.creating_application(child_elements=creating_application_elements)
     premis_objchar = premis.object_characteristics(
-        child_elements=[premis_fixity, premis_format, premis_create])
+        child_elements=premis_fixities + [premis_format, premis_create])
 
     # Create object element
     el_premis_object = premis.object(
@@ -478,28 +1058,66 @@ def collect_filepaths(dirs=None, pattern='*', base='.'):
     """
     Collect file paths recursively from given directory.
 
+    The given paths are checked immediately, but the directories are
+    walked lazily, so that the files can be processed while the rest of
+    the directories are still being walked. The files of each directory
+    are yielded in sorted order before the sorted subdirectories.
+
     :dirs: Directories from arguments
     :pattern: Filter to match the file names
     :base: Base path (see --base_path)
-    :raises: IOError if given path does not exist.
+    :returns: Generator of file paths
+    :raises: IOError if given path is not a file or a directory.
     """
     if dirs is None:
         dirs = ['.']
-    files = []
 
+    paths = []
     for directory in dirs:
         directory = os.path.normpath(os.path.join(base, directory))
-        if os.path.isdir(directory):
-            files += [os.path.join(looproot, filename)
-                      for looproot, _, filenames in os.walk(directory)
-                      for filename in filenames
-                      if fnmatch.fnmatch(filename, pattern)]
-        elif os.path.isfile(directory):
-            files += [directory]
-        else:
+        if not os.path.isdir(directory) and not os.path.isfile(directory):
             raise IOError
+        paths.append(directory)
+
+    return _iter_filepaths(paths, pattern)
+
 
-    return files
+def _iter_filepaths(paths, pattern):
+    """Iterate files in the given paths.
+
+    Like os.walk(), symbolic links to directories are not followed.
+
+    :paths: List of file and directory paths
+    :pattern: Filter to match the file names in the directories
+    :returns: Generator of file paths
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            filenames = []
+            subdirectories = []
+            try:
+                for entry in scandir(directory):
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirectories.append(entry.name)
+                    elif fnmatch.fnmatch(entry.name, pattern):
+                        filenames.append(entry.name)
+            except OSError:
+                # Unreadable directories are skipped, like in os.walk()
+                continue
+
+            for filename in sorted(filenames):
+                yield os.path.join(directory, filename)
+
+            # Last one is walked first
+            for subdirectory in sorted(subdirectories, reverse=True):
+                directories.append(os.path.join(directory, subdirectory))
 
 
 def creation_date(path_to_file):
@@ -638,6 +1256,7 @@ def _create_events(
     else:
         event_targets = filepaths
 
+    batch = []
     for event_name, event in six.iteritems(events):
         found_event = _find_event(workspace,
                                   event['event_type'],
@@ -669,17 +1288,16 @@ def _create_events(
                     agent_role='executing program',
                     create_agent_file='import-object-%s' % event_name)
         if not found_event or not event_target:
-            for target in event_targets:
-                premis_event(event_type=event['event_type'],
-                             event_datetime=event['event_datetime'],
-                             event_detail=event['event_detail'],
-                             event_outcome=event['event_outcome'],
-                             event_outcome_detail=event[
-                                 'event_outcome_detail'],
-                             workspace=workspace,
-                             base_path=base_path,
-                             event_target=(target,),
-                             create_agent_file='import-object-%s' % event_name)
+            event = dict(event)
+            event['create_agent_file'] = 'import-object-%s' % event_name
+            batch.append(event)
+
+    # Each event is created once and linked to all the targets
+    if batch:
+        premis_events(batch,
+                      workspace=workspace,
+                      base_path=base_path,
+                      event_target=tuple(event_targets))
 
 
 def _find_event(workspace,
@@ -703,7 +1321,7 @@ def _find_event(workspace,
     digest = generate_digest(event)
     expected_filename = encode_path("%s-PREMIS:EVENT-amd.xml" % digest)
 
-    return os.path.exists(os.path.join(workspace, expected_filename))
+    return amd_file_exists(workspace, expected_filename)
 
 
 if __name__ == "__main__":
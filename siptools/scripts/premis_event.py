@@ -13,12 +13,17 @@ import six
 
 import premis
 from siptools.mdcreator import MetsSectionCreator
-from siptools.xml.mets import NAMESPACES
+from siptools.packed_amd import get_packed_amd
 from siptools.xml.premis import PREMIS_EVENT_OUTCOME_TYPES
-from siptools.utils import list2str, read_object_id
+from siptools.xml.xpath import (PREMIS_AGENT, PREMIS_AGENT_ID_TYPE,
+                                PREMIS_AGENT_ID_VALUE, PREMIS_AGENT_NAME,
+                                PREMIS_AGENT_TYPE)
+from siptools.utils import list2str, read_md_references, read_object_id
 
 click.disable_unicode_literals_warning = True
 
+AGENT_INDEX_FILE = 'premis-agent-identifiers.json'
+
 
 @click.command()
 @click.argument('event_type', required=True, type=str)
@@ -167,43 +172,77 @@ def premis_event(**kwargs):
                                that import-object script has already been
                                used.
     """
-    attributes = _attribute_values(kwargs)
-    creator = PremisCreator(attributes["workspace"])
+    premis_events([kwargs], **kwargs)
+
+
+def premis_events(events, **kwargs):
+    """
+    Create provenance metadata of several events at once.
+
+    The agent identifiers and the PREMIS object references are read
+    from the workspace only once, each event and agent element is
+    written only once, and the references of all the events are
+    written in a single pass. Each event is linked to all of its
+    targets.
+
+    :events: List of dicts of event specific arguments, see
+             premis_event()
+    :kwargs: Arguments common to all events, see premis_event(). The
+             workspace and stdout arguments apply to all events.
+    """
+    workspace = kwargs.get("workspace") or "./workspace/"
+    stdout = bool(kwargs.get("stdout"))
+    creator = PremisCreator(workspace)
 
-    agents = _resolve_agents(**attributes)
+    # Get existing agent identifiers for reuse
+    premis_agent_identifiers = get_premis_agent_identifiers(workspace)
+    object_refs = None
+
+    for event in events:
+        given_params = dict(kwargs)
+        given_params.update(event)
+        attributes = _attribute_values(given_params)
+        linking_objects = list(iterate_linking_objects(
+            attributes["base_path"], attributes["linking_objects"]))
 
-    for agent in agents:
+        agents = _resolve_agents(
+            premis_agent_identifiers=premis_agent_identifiers,
+            **attributes)
 
-        attributes["linking_agents"].add(
-            (agent["agent_identifier"][0],
-             agent["agent_identifier"][1],
-             agent["agent_role"]))
+        for agent in agents:
 
-        agent = create_premis_agent(**agent)
+            attributes["linking_agents"].add(
+                (agent["agent_identifier"][0],
+                 agent["agent_identifier"][1],
+                 agent["agent_role"]))
 
-        agent_creator = PremisCreator(attributes["workspace"])
-        for (directory, event_file, role) in iterate_linking_objects(
-                attributes["base_path"], attributes["linking_objects"]):
-            agent_creator.add_md(agent, event_file, directory=directory)
-        agent_creator.write(mdtype="PREMIS:AGENT",
-                            stdout=attributes["stdout"])
+            # Later events reuse the identifier of the same agent
+            premis_agent_identifiers[
+                (agent["agent_type"], agent["agent_name"])
+            ] = agent["agent_identifier"]
 
-    if attributes["add_object_links"]:
-        for (directory, event_file, role) in iterate_linking_objects(
-                attributes["base_path"], attributes["linking_objects"]):
-            if event_file is not None:
-                linking_object = read_object_id(
-                    event_file, attributes["workspace"])
-                attributes["linking_object_ids"].add(
-                    (linking_object[0], linking_object[1], role))
+            creator.add_linked_md(create_premis_agent(**agent),
+                                  linking_objects,
+                                  mdtype="PREMIS:AGENT",
+                                  stdout=stdout)
 
-    event = create_premis_event(**attributes)
+        if attributes["add_object_links"]:
+            if object_refs is None:
+                object_refs = read_md_references(
+                    workspace, "import-object-md-references.jsonl")
+            for (directory, event_file, role) in linking_objects:
+                if event_file is not None:
+                    linking_object = read_object_id(
+                        event_file, workspace, object_refs)
+                    attributes["linking_object_ids"].add(
+                        (linking_object[0], linking_object[1], role))
 
-    for (directory, event_file, role) in iterate_linking_objects(
-            attributes["base_path"], attributes["linking_objects"]):
-        creator.add_md(event, event_file, directory=directory)
+        creator.add_linked_md(create_premis_event(**attributes),
+                              linking_objects,
+                              mdtype="PREMIS:EVENT",
+                              stdout=stdout)
 
-    creator.write(mdtype="PREMIS:EVENT", stdout=attributes["stdout"])
+    creator.write(stdout=stdout)
 
 
 def iterate_linking_objects(base_path, linking_objects):
@@ -264,10 +303,36 @@ class PremisCreator(MetsSectionCreator):
     Subclass of MetsSectionCreator, which generates PREMIS event or agent
     metadata.
     """
+
+    def __init__(self, workspace):
+        """
+        Initialize PREMIS creator.
+
+        :workspace: Output path
+        """
+        super(PremisCreator, self).__init__(workspace)
+        self.agent_identifiers = {}
+
+    # pylint: disable=too-many-arguments
+    def write_md(self, metadata, mdtype, mdtypeversion, othermdtype=None,
+                 section=None, stdout=False, md_key=None):
+        """
+        Write metadata as in MetsSectionCreator.write_md(). Identifiers
+        of PREMIS agents are collected for the agent index, which is
+        updated by write().
+        """
+        if mdtype == "PREMIS:AGENT":
+            self.agent_identifiers.update(_agent_identifiers(metadata))
+        return super(PremisCreator, self).write_md(
+            metadata, mdtype, mdtypeversion, othermdtype=othermdtype,
+            section=section, stdout=stdout, md_key=md_key)
+
     # pylint: disable=too-many-arguments
     def write(self, mdtype="PREMIS", mdtypeversion="2.3", othermdtype=None,
               section="digiprovmd", stdout=False, file_metadata_dict=None,
               ref_file="premis-event-md-references.jsonl"):
+        # Taken before writing, as the state is reset after it
+        agent_identifiers = self.agent_identifiers
         super(PremisCreator, self).write(
             mdtype=mdtype,
             mdtypeversion=mdtypeversion,
@@ -277,6 +342,29 @@ class PremisCreator(MetsSectionCreator):
             file_metadata_dict=file_metadata_dict,
             ref_file=ref_file
         )
+        if agent_identifiers:
+            update_premis_agent_identifiers(self.workspace,
+                                            agent_identifiers)
+
+    def add_linked_md(self, metadata, linking_objects, mdtype="PREMIS",
+                      stdout=False):
+        """
+        Write metadata element immediately and reference it from all the
+        given linking objects. The references are written by write().
+
+        Unlike add_md(), the element is serialized and hashed only once
+        regardless of the number of linking objects.
+
+        :metadata: PREMIS event or agent XML element
+        :linking_objects: Tuples of directory, file and role, see
+                          iterate_linking_objects()
+        :mdtype: Value of mdWrap MDTYPE attribute
+        :stdout: True prints the metadata also to stdout
+        """
+        md_id, _ = self.write_md(metadata, mdtype, "2.3",
+                                 section="digiprovmd", stdout=stdout)
+        for (directory, event_file, _) in linking_objects:
+            self.add_reference(md_id, event_file, directory=directory)
 
 
 def get_premis_agent_identifiers(workspace):
@@ -284,41 +372,93 @@ def get_premis_agent_identifiers(workspace):
     Get a dictionary of PREMIS agent name and type pairs and their
     corresponding agent identifiers
 
+    The identifiers are read from the agent index of the workspace. If
+    the index does not exist yet, they are read from the PREMIS agent
+    files of the workspace, including the files in the packed store.
+    The index is written only when events are created, see
+    update_premis_agent_identifiers().
+
     :param workspace: Path to the workspace
 
     :returns: A dictionary with the following tuple-to-tuple mapping
               {(agent_type, agent_name): (agent_ident_type, agent_ident_value)}
     """
+    index_path = os.path.join(workspace, AGENT_INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, 'rt') as in_file:
+            return dict(
+                ((agent[0], agent[1]), (agent[2], agent[3]))
+                for agent in json.load(in_file))
+
     result = {}
 
     search_path = os.path.join(workspace, "*AGENT-amd.xml")
 
-    for path in glob.glob(search_path):
-        element = lxml.etree.parse(path).getroot()[0]
-        agent = element.find(
-            "mets:digiprovMD/mets:mdWrap/mets:xmlData/premis:agent",
-            namespaces=NAMESPACES
-        )
+    roots = [lxml.etree.parse(path).getroot()
+             for path in glob.glob(search_path)]
+    store = get_packed_amd(workspace)
+    if store is not None:
+        roots.extend(lxml.etree.fromstring(xml_data)
+                     for (name, xml_data) in store.iter_files()
+                     if name.endswith("AGENT-amd.xml"))
 
-        agent_type = agent.find(
-            "premis:agentType", namespaces=NAMESPACES
-        ).text
-        agent_name = agent.find(
-            "premis:agentName", namespaces=NAMESPACES
-        ).text
+    for root in roots:
+        agent = PREMIS_AGENT(root[0])[0]
+        result.update(_agent_identifiers(agent))
 
-        id_type = agent.find(
-            "premis:agentIdentifier/premis:agentIdentifierType",
-            namespaces=NAMESPACES
-        ).text
-        id_value = agent.find(
-            "premis:agentIdentifier/premis:agentIdentifierValue",
-            namespaces=NAMESPACES
-        ).text
+    return result
 
-        result[(agent_type, agent_name)] = (id_type, id_value)
 
-    return result
+def update_premis_agent_identifiers(workspace, agent_identifiers):
+    """
+    Add agent identifiers to the agent index of the workspace. The
+    index is created if it does not exist yet.
+
+    :param workspace: Path to the workspace
+    :param agent_identifiers: A dictionary of agent identifiers, see
+        get_premis_agent_identifiers()
+    """
+    index_exists = os.path.exists(os.path.join(workspace, AGENT_INDEX_FILE))
+    result = get_premis_agent_identifiers(workspace)
+    if index_exists and all(
+            result.get(key) == value
+            for (key, value) in six.iteritems(agent_identifiers)):
+        return
+    result.update(agent_identifiers)
+    _write_agent_index(workspace, result)
+
+
+def _write_agent_index(workspace, agent_identifiers):
+    """
+    Replace the agent index of the workspace.
+
+    :param workspace: Path to the workspace
+    :param agent_identifiers: A dictionary of agent identifiers, see
+        get_premis_agent_identifiers()
+    """
+    index_path = os.path.join(workspace, AGENT_INDEX_FILE)
+    agents = [key + value
+              for (key, value) in six.iteritems(agent_identifiers)]
+    with open('%s.tmp' % index_path, 'wt') as out_file:
+        json.dump(agents, out_file)
+    os.rename('%s.tmp' % index_path, index_path)
+
+
+def _agent_identifiers(agent):
+    """
+    Get the identifier of a PREMIS agent element.
+
+    :param agent: PREMIS agent element
+
+    :returns: A dictionary with the agent type and name as key and the
+              agent identifier type and value as value
+    """
+    agent_type = PREMIS_AGENT_TYPE(agent)[0].text
+    agent_name = PREMIS_AGENT_NAME(agent)[0].text
+    id_type = PREMIS_AGENT_ID_TYPE(agent)[0].text
+    id_value = PREMIS_AGENT_ID_VALUE(agent)[0].text
+
+    return {(agent_type, agent_name): (id_type, id_value)}
 
 
 def create_premis_agent(**attributes):
@@ -404,7 +544,7 @@ def create_premis_event(**attributes):
     return premis_event_elem
 
 
-def _resolve_agents(**attributes):
+def _resolve_agents(premis_agent_identifiers=None, **attributes):
     """Resolves linked agents that can be added to the event in a few
     different ways and outputs the agent information as json.
 
@@ -414,6 +554,10 @@ def _resolve_agents(**attributes):
     and agent_type options are used.
     If the agent_identifier is provided, that identifier is used,
     otherwise a UUID identifier is created.
+
+    :premis_agent_identifiers: Existing agent identifiers, see
+                               get_premis_agent_identifiers(). Read from
+                               the workspace if not given.
     """
     agent_list = []
 
@@ -422,9 +566,10 @@ def _resolve_agents(**attributes):
         attributes["create_agent_file"] + '-AGENTS-amd.json')
 
     # Get existing agent identifiers for reuse
-    premis_agent_identifiers = get_premis_agent_identifiers(
-        attributes["workspace"]
-    )
+    if premis_agent_identifiers is None:
+        premis_agent_identifiers = get_premis_agent_identifiers(
+            attributes["workspace"]
+        )
 
     if attributes["create_agent_file"] and os.path.exists(agents_filepath):
 
@@ -16,12 +16,18 @@ import mets
 import premis
 import xml_helpers
 import file_scraper.scraper
+from siptools.packed_amd import parse_amd_file
 
 try:
     from urllib.parse import quote_plus, unquote_plus
 except ImportError:  # Python 2
     from urllib import quote_plus, unquote_plus
 
+try:
+    from scandir import scandir  # Python 2
+except ImportError:
+    from os import scandir  # Python 3+
+
 
 SUPPLEMENTARY_TYPES = {
     'main': 'fi-dpres-supplementary',
@@ -30,6 +36,18 @@ SUPPLEMENTARY_TYPES = {
 }
 
 
+# Size of the chunks in which files are read for checksum calculation
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Reference files of administrative metadata
+AMD_REFERENCE_FILES = ["import-object-md-references.jsonl",
+                       "create-addml-md-references.jsonl",
+                       "create-audiomd-md-references.jsonl",
+                       "create-mix-md-references.jsonl",
+                       "create-videomd-md-references.jsonl",
+                       "premis-event-md-references.jsonl"]
+
+
 def calc_checksum(filepath, algorithm="md5"):
     """
     Calculate checksum of a file.
@@ -38,8 +56,26 @@ def calc_checksum(filepath, algorithm="md5"):
     :algorithm: Algorithm name
     :returns: Checksum of the file
     """
-    scraper = file_scraper.scraper.Scraper(filepath)
-    return scraper.checksum(algorithm=algorithm)
+    return calc_checksums(filepath, [algorithm])[0]
+
+
+def calc_checksums(filepath, algorithms=("md5",)):
+    """
+    Calculate checksums of a file with several algorithms.
+
+    The file is read once, in chunks of CHECKSUM_BUFFER_SIZE bytes, and
+    each chunk is given to all the algorithms.
+
+    :filepath: File path
+    :algorithms: List of algorithm names
+    :returns: List of checksums in the order of the given algorithms
+    """
+    checksums = [hashlib.new(algorithm.lower()) for algorithm in algorithms]
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHECKSUM_BUFFER_SIZE), b''):
+            for checksum in checksums:
+                checksum.update(chunk)
+    return [checksum.hexdigest() for checksum in checksums]
 
 
 def load_scraper_json(json_name):
@@ -220,6 +256,18 @@ def fix_missing_metadata(streams, filename, allow_unav, allow_zero):
                         'index %s for file %s' % (key, index, filename))
 
 
+def metadata_key(metadata):
+    """Create a key of the metadata dict an XML element is created from.
+
+    The key can be given to MetsSectionCreator.write_md() to avoid
+    hashing identical metadata elements repeatedly.
+
+    :metadata: Metadata dict, e.g. metadata of a stream
+    :returns: Metadata dict serialized as string
+    """
+    return json.dumps(metadata, sort_keys=True)
+
+
 def encode_path(path, suffix='', prefix='', safe=""):
     """
     Encode given path to URL encoding with given perfix and suffix.
@@ -327,6 +375,74 @@ def add(treedict, path):
     return root
 
 
+class DivNode(object):
+    """Node of a tree of directories and files, for creating the divs of
+    a structMap.
+
+    Each node knows its full path and whether it is a file, so that the
+    tree can be walked without joining paths or looking them up. Leaf
+    nodes have no dict of children.
+    """
+
+    __slots__ = ('name', 'path', 'is_file', 'children')
+
+    def __init__(self, name='', path='', is_file=False):
+        """
+        :name: Name of the directory or file
+        :path: Full path of the directory or file
+        :is_file: True for files
+        """
+        self.name = name
+        self.path = path
+        self.is_file = is_file
+        self.children = None
+
+    def child(self, name, path=None, names=None):
+        """Return the child node with the given name. The node is
+        created if it does not exist.
+
+        :name: Name of the child
+        :path: Full path of a new child. Defaults to the name joined to
+               the path of this node.
+        :names: Dict of names already used in the tree, so that equal
+                names are stored only once
+        :returns: Child node
+        """
+        if self.children is None:
+            self.children = {}
+        node = self.children.get(name)
+        if node is None:
+            if names is not None:
+                name = names.setdefault(name, name)
+            if path is None:
+                path = os.path.join(self.path, name)
+            node = DivNode(name, path)
+            self.children[name] = node
+        return node
+
+    def add_file(self, path, names=None):
+        """Add a file and its parent directories below this node.
+
+        :path: Path of the file, relative to this node
+        :names: Dict of names already used in the tree, see child()
+        :returns: Node of the file
+        """
+        node = self
+        for name in path.split('/'):
+            node = node.child(name, names=names)
+        node.is_file = True
+        return node
+
+    def iter_children(self):
+        """Iterate the child nodes in the order they were added.
+
+        :returns: Iterator of child nodes
+        """
+        if self.children is None:
+            return iter(())
+        return six.itervalues(self.children)
+
+
 def copy_etree(etree):
     """Copy etree recursively.
 
@@ -345,9 +461,9 @@ def _pop_attributes(attributes, attrib_list, path):
     :attrib_list: List of all the attributes
     :path: Path from root XML element to current element
     """
-    for key in attributes:
-        attribute = attributes.pop(key)
+    for key, attribute in attributes.items():
         attrib_list.append('%s="%s" @ %s\n' % (key, attribute, path))
+    attributes.clear()
 
 
 def _remove_elements(metadata, element_name):
@@ -378,11 +494,15 @@ def generate_digest(etree):
     This function creates a copy of the etree. All the attributes of the
     copy are removed and collected to a separete list with path
     information to the XML element the attributes belong to. This list
-    is sorted and appended to the end of the serialized XML string
-    without the attributes. Thus creating a string with all the original
-    information except the information about attribute ordering inside
-    any given XML element. This string is hashed and the digest
-    returned. For some PREMIS metadata identifiers are also removed.
+    is sorted and hashed after the serialized XML string without the
+    attributes. Thus hashing all the original information except the
+    information about attribute ordering inside any given XML element.
+    For some PREMIS metadata identifiers are also removed.
+
+    The copy is needed, as the digest is calculated from the serialized
+    tree, and removing the identifier elements also removes their tails.
+    The tree is walked only once, and the path is resolved only for the
+    elements that have attributes.
 
     :etree: XML element for which the MD5 hash is generated
     :returns: MD5 hash
@@ -401,16 +521,17 @@ def generate_digest(etree):
     # pop all attributes
     for element in root.iter():
         attributes = element.attrib
-        path = elem_tree.getpath(element)
-        _pop_attributes(attributes, attrib_list, path)
+        if attributes:
+            _pop_attributes(attributes, attrib_list,
+                            elem_tree.getpath(element))
 
     attrib_list.sort()
-    xml_data = xml_helpers.utils.serialize(root)
+    digest = hashlib.md5(xml_helpers.utils.serialize(root))
 
-    # Add the sorted attributes at the end of the serialized XML
-    attr_data = b"".join([attr.encode("utf-8") for attr in attrib_list])
-    xml_data = b"".join([xml_data, attr_data])
-    return hashlib.md5(xml_data).hexdigest()
+    # Add the sorted attributes after the serialized XML
+    for attr in attrib_list:
+        digest.update(attr.encode("utf-8"))
+    return digest.hexdigest()
 
 
 def list2str(lst):
@@ -432,15 +553,27 @@ def read_md_references(workspace, ref_file):
     :returns: A dict of references or None if reference file doesn't
               exist
     """
+    if os.path.isfile(os.path.join(workspace, ref_file)):
+        return dict(iter_md_references(workspace, ref_file))
+    return None
+
+
+def iter_md_references(workspace, ref_file):
+    """Iterate the references of a reference file line by line, without
+    collecting them in a dictionary.
+
+    :workspace: path to workspace directory
+    :ref_file: Metadata reference file
+    :returns: Generator of paths and their references, empty if the
+              reference file doesn't exist
+    """
     reference_file = os.path.join(workspace, ref_file)
 
     if os.path.isfile(reference_file):
-        references = {}
         with open(reference_file) as in_file:
             for line in in_file:
-                references.update(json.loads(line))
-        return references
-    return None
+                for path_references in six.iteritems(json.loads(line)):
+                    yield path_references
 
 
 def get_objectlist(refs_dict, file_path=None):
@@ -453,16 +586,13 @@ def get_objectlist(refs_dict, file_path=None):
                 If None, finds a sorted list all file paths.
     :returns: Sorted list of files, or streams of a given file
     """
-    objectset = set()
+    # The keys of the dictionaries are unique already
     if file_path is not None:
-        for stream in refs_dict[file_path]['streams']:
-            objectset.add(stream)
-    elif refs_dict:
-        for key, value in six.iteritems(refs_dict):
-            if value['path_type'] == 'file':
-                objectset.add(key)
-
-    return sorted(objectset)
+        return sorted(refs_dict[file_path]['streams'])
+    if refs_dict:
+        return sorted(key for key, value in six.iteritems(refs_dict)
+                      if value['path_type'] == 'file')
+    return []
 
 
 def remove_dmdsec_references(workspace):
@@ -476,40 +606,103 @@ def remove_dmdsec_references(workspace):
         os.remove(refs_file)
 
 
-def read_all_amd_references(workspace):
+def read_all_amd_references(workspace, read_references=None):
     """
     Collect all administrative references.
 
+    The reference files are read line by line, and the references of a
+    path in the different files are merged in one pass, so that each MD
+    ID is listed only once for the path and for each of its streams, in
+    the order the IDs were first found. The references of a path found
+    in only one file are shared with the references read, so the result
+    must not be modified.
+
     :workspace: path to workspace directory
+    :read_references: Function for reading a reference file, called with
+                      the name of the file. Returns an iterable of paths
+                      and their references, which are not modified.
+                      Defaults to iter_md_references() in the workspace.
     :returns: a set of administrative MD IDs
     """
+    if read_references is None:
+        def read_references(ref_file):
+            """Read a reference file from the workspace."""
+            return iter_md_references(workspace, ref_file)
+
     references = {}
-    for ref_file in ["import-object-md-references.jsonl",
-                     "create-addml-md-references.jsonl",
-                     "create-audiomd-md-references.jsonl",
-                     "create-mix-md-references.jsonl",
-                     "create-videomd-md-references.jsonl",
-                     "premis-event-md-references.jsonl"]:
-        refs = read_md_references(workspace, ref_file)
-        if refs:
-            for ref in refs:
-                if ref in references:
-                    references[ref]['md_ids'].extend(refs[ref]['md_ids'])
-
-                    for stream in refs[ref]['streams']:
-                        if stream in references[ref]['streams']:
-                            references[ref]['streams'][stream].extend(
-                                refs[ref]['streams'][stream])
-                        else:
-                            references[ref]['streams'][stream] = \
-                                refs[ref]['streams'][stream]
+    # IDs of the paths whose references have been copied for merging,
+    # as sets of the path and of each stream
+    merged = {}
+    for ref_file in AMD_REFERENCE_FILES:
+        for (path, reference) in read_references(ref_file):
+            if path not in references:
+                references[path] = reference
+                continue
 
-                else:
-                    references[ref] = refs[ref]
+            if path not in merged:
+                references[path] = _copy_reference(references[path])
+                merged[path] = (set(references[path]['md_ids']), {})
+            target = references[path]
+            (known_ids, known_stream_ids) = merged[path]
+
+            _merge_ids(target['md_ids'], reference['md_ids'], known_ids)
+            for (stream, md_ids) in six.iteritems(
+                    _reference_streams(reference)):
+                if stream not in target['streams']:
+                    target['streams'][stream] = []
+                if stream not in known_stream_ids:
+                    known_stream_ids[stream] = set(
+                        target['streams'][stream])
+                _merge_ids(target['streams'][stream], md_ids,
+                           known_stream_ids[stream])
 
     return references
 
 
+def _merge_ids(md_ids, new_ids, known_ids):
+    """Append the IDs that are not listed yet to a list of MD IDs.
+
+    :md_ids: List of MD IDs to extend
+    :new_ids: MD IDs to append
+    :known_ids: Set of the IDs in md_ids, updated with the new IDs
+    """
+    for md_id in new_ids:
+        if md_id not in known_ids:
+            known_ids.add(md_id)
+            md_ids.append(md_id)
+
+
+def _copy_reference(reference):
+    """Copy the references of a path, so that the lists of MD IDs can
+    be extended without modifying the original.
+
+    :reference: References of a path
+    :returns: Copy of the references
+    """
+    reference = dict(reference)
+    reference['md_ids'] = list(reference['md_ids'])
+    reference['streams'] = dict(
+        (stream, list(md_ids))
+        for (stream, md_ids) in six.iteritems(
+            _reference_streams(reference)))
+    return reference
+
+
+def _reference_streams(reference):
+    """Return the stream references of a path.
+
+    Directories may have their streams as a list instead of a dict. As
+    directories have no streams, the list has no stream references.
+
+    :reference: References of a path
+    :returns: Dict of streams and their MD IDs
+    """
+    streams = reference.get('streams')
+    if isinstance(streams, dict):
+        return streams
+    return {}
+
+
 def get_md_references(refs_dict, path=None, stream=None, directory=None):
     """Return filtered references from a set of given references.
 
@@ -533,51 +726,59 @@ def get_md_references(refs_dict, path=None, stream=None, directory=None):
         elif stream is None:
             md_ids = refs_dict[path]['md_ids']
         else:
-            md_ref = refs_dict[path]
-            for ref_stream in md_ref['streams']:
-                if ref_stream == stream:
-                    md_ids = md_ref['streams'][ref_stream]
+            md_ids = refs_dict[path]['streams'][stream]
     except KeyError:
         pass
 
     return set(md_ids)
 
 
-def read_object_id(path, workspace):
+def read_object_id(path, workspace, object_refs=None):
     """Find PREMIS Object ID of a given file.
 
     :path: Path of file related to current path or base path.
     :workspace: Workspace path
+    :object_refs: References of import-object, read from the workspace
+                  if not given
     :returns: Tuple of ID type and value
     """
-    object_refs = read_md_references(
-        workspace, "import-object-md-references.jsonl")
+    if object_refs is None:
+        object_refs = read_md_references(
+            workspace, "import-object-md-references.jsonl")
     premis_file = "%s-PREMIS%%3AOBJECT-amd.xml" \
         % object_refs[path]["md_ids"][0][1:]
-    root = lxml.etree.parse(os.path.join(workspace, premis_file))
+    root = parse_amd_file(workspace, premis_file)
     return premis.parse_identifier_type_value(
         premis.parse_identifier(root))
 
 
-def get_file_properties(path, all_amd_refs, workspace):
+def get_file_properties(path, all_amd_refs, workspace, scraper_files=None):
     """Return file properties from the json data file.
 
     :param path: File path
     :param all_amd_refs: XML element tree of administrative metadata
         references.
     :param workspace: Workspace path
+    :param scraper_files: Set of the names of the scraper json files in
+        the workspace. If not given, the files are looked up from the
+        workspace one by one.
     :returns: A dict with properties or None
     """
     json_name = None
     for amdref in get_md_references(all_amd_refs, path=path):
-        json_name = os.path.join(workspace,
-                                 '{}-scraper.json'.format(amdref[1:]))
-        if os.path.isfile(json_name):
+        name = '{}-scraper.json'.format(amdref[1:])
+        if scraper_files is None:
+            if os.path.isfile(os.path.join(workspace, name)):
+                json_name = name
+                break
+        elif name in scraper_files:
+            json_name = name
             break
 
-    if json_name is None or not os.path.isfile(json_name):
+    if json_name is None:
         return None
-    file_metadata_dict = load_scraper_json(json_name)
+    file_metadata_dict = load_scraper_json(os.path.join(workspace,
+                                                        json_name))
 
     if 'properties' not in file_metadata_dict[0]:
         return None
@@ -585,11 +786,146 @@ def get_file_properties(path, all_amd_refs, workspace):
     return file_metadata_dict[0]['properties']
 
 
-def get_reference_lists(workspace):
+class DirectoryReferences(dict):
+    """Administrative and descriptive MD IDs of directories, as a dict
+    of directory paths and tuples of the sets of the IDs, see
+    get_md_references().
+
+    The IDs of all directories in the references are collected when the
+    dict is created. Other paths are looked up from the references when
+    they are first used, and the result is kept in the dict. The sets
+    of IDs must not be modified by the users.
+    """
+
+    def __init__(self, all_amd_refs, all_dmd_refs):
+        """
+        :all_amd_refs: All administrative metadata references
+        :all_dmd_refs: All descriptive metadata references
+        """
+        super(DirectoryReferences, self).__init__()
+        self.all_amd_refs = all_amd_refs
+        self.all_dmd_refs = all_dmd_refs
+
+        directories = set(['.'])
+        for refs in (all_amd_refs, all_dmd_refs):
+            if refs:
+                directories.update(
+                    path for (path, reference) in six.iteritems(refs)
+                    if reference.get('path_type') == 'directory')
+        for directory in directories:
+            self[directory] = self.__missing__(directory)
+
+    def __missing__(self, directory):
+        """Look up the IDs of a directory from the references.
+
+        :directory: Directory path
+        :returns: Tuple of the sets of administrative and descriptive
+                  MD IDs
+        """
+        md_ids = (get_md_references(self.all_amd_refs, directory=directory),
+                  get_md_references(self.all_dmd_refs, directory=directory))
+        self[directory] = md_ids
+        return md_ids
+
+
+class ReferenceContext(object):
+    """Metadata references of a workspace, for creating the fileSec and
+    structMap.
+
+    Each reference file and scraper json file of the workspace is read
+    at most once, when it is first needed. The files read with
+    md_references() are kept in memory, and the other administrative
+    reference files are only merged to all_amd_references(). The
+    references must not be modified by the users.
+    """
+
+    def __init__(self, workspace):
+        """
+        :workspace: Workspace path
+        """
+        self.workspace = workspace
+        self._references = {}
+        self._all_amd_references = None
+        self._scraper_files = None
+        self._file_properties = {}
+        self._directory_references = None
+
+    def md_references(self, ref_file):
+        """Return the references of a reference file, see
+        read_md_references().
+
+        :ref_file: Metadata reference file
+        :returns: A dict of references or None if reference file doesn't
+                  exist
+        """
+        if ref_file not in self._references:
+            self._references[ref_file] = read_md_references(
+                self.workspace, ref_file)
+        return self._references[ref_file]
+
+    def all_amd_references(self):
+        """Return all administrative references, see
+        read_all_amd_references().
+
+        :returns: a set of administrative MD IDs
+        """
+        if self._all_amd_references is None:
+            self._all_amd_references = read_all_amd_references(
+                self.workspace, read_references=self._iter_md_references)
+        return self._all_amd_references
+
+    def _iter_md_references(self, ref_file):
+        """Iterate the references of a reference file. A file that has
+        already been read is not read again, and other files are read
+        line by line, see iter_md_references().
+
+        :ref_file: Metadata reference file
+        :returns: Iterable of paths and their references
+        """
+        if ref_file in self._references:
+            return six.iteritems(self._references[ref_file] or {})
+        return iter_md_references(self.workspace, ref_file)
+
+    def directory_references(self):
+        """Return the MD IDs of the directories, see
+        DirectoryReferences.
+
+        :returns: DirectoryReferences instance
+        """
+        if self._directory_references is None:
+            self._directory_references = DirectoryReferences(
+                self.all_amd_references(),
+                self.md_references("import-description-md-references.jsonl"))
+        return self._directory_references
+
+    def file_properties(self, path):
+        """Return the file properties of a file, see
+        get_file_properties(). The scraper json files are looked up
+        from one listing of the workspace.
+
+        :path: File path
+        :returns: A dict with properties or None
+        """
+        if path not in self._file_properties:
+            if self._scraper_files is None:
+                self._scraper_files = set(
+                    entry.name for entry in scandir(self.workspace)
+                    if entry.name.endswith('-scraper.json'))
+            self._file_properties[path] = get_file_properties(
+                path=path,
+                all_amd_refs=self.all_amd_references(),
+                workspace=self.workspace,
+                scraper_files=self._scraper_files)
+        return self._file_properties[path]
+
+
+def get_reference_lists(workspace, reference_context=None):
     """
     Get reference lists.
 
     :param workspace: Workspace path
+    :param reference_context: ReferenceContext of the workspace. If not
+        given, the references are read from the workspace.
     :returns: Tuple of following things:
         - all_amd_refs: All administrative metadata references.
         - all_dmd_refs: All descriptive metadata references.
@@ -598,20 +934,21 @@ def get_reference_lists(workspace):
         - file_properties: Properties of all the files discovered in
                            filelist.
     """
-    object_refs = read_md_references(workspace,
-                                     "import-object-md-references.jsonl")
+    if reference_context is None:
+        reference_context = ReferenceContext(workspace)
+
+    object_refs = reference_context.md_references(
+        "import-object-md-references.jsonl")
     filelist = get_objectlist(object_refs)
-    all_amd_refs = read_all_amd_references(workspace)
-    all_dmd_refs = read_md_references(workspace,
-                                      "import-description-md-references.jsonl")
+    all_amd_refs = reference_context.all_amd_references()
+    all_dmd_refs = reference_context.md_references(
+        "import-description-md-references.jsonl")
 
     # Get file properties for all the files after fetching reference
     # lists.
     file_properties = {}
     for path in filelist:
-        file_properties[path] = get_file_properties(path=path,
-                                                    all_amd_refs=all_amd_refs,
-                                                    workspace=workspace)
+        file_properties[path] = reference_context.file_properties(path)
     return (all_amd_refs,
             all_dmd_refs,
             object_refs,
@@ -703,14 +1040,12 @@ def add_file_to_filesec(all_amd_refs,
         use=use
     )
 
-    streams = get_objectlist(object_refs, path)
-    if streams:
-        for stream in streams:
-            stream_ids = get_md_references(refs_dict=all_amd_refs,
-                                           path=path,
-                                           stream=stream)
-            stream_el = mets.stream(admid_elements=stream_ids)
-            file_el.append(stream_el)
+    for stream in get_objectlist(object_refs, path):
+        stream_ids = get_md_references(refs_dict=all_amd_refs,
+                                       path=path,
+                                       stream=stream)
+        stream_el = mets.stream(admid_elements=stream_ids)
+        file_el.append(stream_el)
 
     filegrp.append(file_el)
 
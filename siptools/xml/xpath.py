@@ -0,0 +1,35 @@
+"""
+Precompiled XPath expressions used in loops over METS and PREMIS
+elements. Calling xpath() with an expression string compiles the
+expression every time, so the expressions evaluated for many elements
+are compiled here once.
+"""
+from __future__ import unicode_literals
+
+import lxml.etree
+
+from siptools.xml.mets import NAMESPACES
+
+
+def _xpath(expression):
+    """Compile an XPath expression with the namespaces of siptools.
+
+    :expression: XPath expression
+    :returns: lxml.etree.XPath object
+    """
+    return lxml.etree.XPath(expression, namespaces=NAMESPACES)
+
+
+# File locations in a fileSec element
+METS_FILE_LOCATIONS = _xpath('//mets:fileGrp/mets:file/mets:FLocat')
+
+# PREMIS agent in a partial METS document, and its type, name and
+# identifier
+PREMIS_AGENT = _xpath(
+    'mets:digiprovMD/mets:mdWrap/mets:xmlData/premis:agent')
+PREMIS_AGENT_TYPE = _xpath('premis:agentType')
+PREMIS_AGENT_NAME = _xpath('premis:agentName')
+PREMIS_AGENT_ID_TYPE = _xpath(
+    'premis:agentIdentifier/premis:agentIdentifierType')
+PREMIS_AGENT_ID_VALUE = _xpath(
+    'premis:agentIdentifier/premis:agentIdentifierValue')
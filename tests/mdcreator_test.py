@@ -6,9 +6,9 @@ import os
 import json
 import pytest
 import lxml.etree
-from siptools.mdcreator import (MetsSectionCreator)
+from siptools.mdcreator import MetsSectionCreator, scandir
 from siptools.utils import read_md_references, remove_dmdsec_references, \
-    get_md_references
+    get_md_references, get_objectlist, generate_digest
 
 
 def test_create_amdfile(testpath):
@@ -45,6 +45,75 @@ def test_create_amdfile(testpath):
     assert len(sample_data_elements) == 1
 
 
+def test_write_md_key(testpath, monkeypatch):
+    """Test that metadata with a known md_key is not hashed or written
+    again, and that other metadata types do not share the keys.
+    """
+    digests = []
+
+    def _generate_digest(metadata):
+        """Count the calls of generate_digest."""
+        digest = generate_digest(metadata)
+        digests.append(digest)
+        return digest
+
+    monkeypatch.setattr(
+        'siptools.mdcreator.generate_digest', _generate_digest)
+
+    md_creator = MetsSectionCreator(testpath)
+    sample_data = lxml.etree.Element('sampleData')
+
+    result = md_creator.write_md(sample_data, 'NISOIMG', '2.0', md_key='a')
+    assert md_creator.write_md(
+        sample_data, 'NISOIMG', '2.0', md_key='a') == result
+    assert len(digests) == 1
+
+    md_creator.write_md(sample_data, 'OTHER', '2.0', md_key='a')
+    md_creator.write_md(sample_data, 'NISOIMG', '2.0')
+    assert len(digests) == 3
+
+
+def test_workspace_listing(testpath, monkeypatch):
+    """Test that the workspace is listed only once, also over several
+    writes, that existing files are not overwritten, and that written
+    files are added to the listing. A single metadata element must be
+    written without listing the workspace.
+    """
+    listings = []
+
+    def _scandir(path):
+        """Count the workspace listings."""
+        listings.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr('siptools.mdcreator.scandir', _scandir)
+
+    existing = os.path.join(
+        testpath, '455752263d67f67402b0dc9e7119e5b3-NISOIMG-amd.xml')
+    with open(existing, 'w') as outfile:
+        outfile.write('existing')
+
+    md_creator = MetsSectionCreator(testpath)
+    md_creator.write_md(lxml.etree.Element('sampleData'), 'NISOIMG', '2.0')
+    with open(existing) as infile:
+        assert infile.read() == 'existing'
+    assert not listings
+
+    for name in ['a', 'b']:
+        md_creator.add_md(lxml.etree.Element('sampleData'), 'file_%s' % name)
+        md_creator.add_md(lxml.etree.Element(name), 'file_%s' % name)
+        md_creator.write(mdtype='NISOIMG', mdtypeversion='2.0',
+                         ref_file='md-references.jsonl')
+    with open(existing) as infile:
+        assert infile.read() == 'existing'
+
+    _, filename = md_creator.write_md(
+        lxml.etree.Element('b'), 'NISOIMG', '2.0')
+    assert os.path.isfile(filename)
+    assert md_creator.workspace_file_exists(os.path.basename(filename))
+    assert len(listings) == 1
+
+
 @pytest.mark.parametrize(('references', 'expected'), [
     ([['abcd1234', 'path/to/file1', None]],
      ({'path/to/file1': {'path_type': 'file',
@@ -148,6 +217,40 @@ def test_add_mdreference(testpath, references, expected):
                 assert stream_id in created_references[path]['streams'][stream]
 
 
+def test_update_mdreferences(testpath):
+    """Test that write_references updates the existing entries of the
+    reference file and appends the new ones, so that each path has one
+    line in the file.
+    """
+    md_creator = MetsSectionCreator(testpath)
+    md_creator.add_reference('abcd1234', 'path/to/file1')
+    md_creator.add_reference('abcd5678', 'path/to/file2', stream=1)
+    md_creator.add_reference('efgh1234', 'path/to/\u00e4')
+    md_creator.write_references('md-references.jsonl')
+
+    md_creator = MetsSectionCreator(testpath)
+    md_creator.add_reference('efgh5678', 'path/to/file2')
+    md_creator.add_reference('ijkl1234', 'path/to/file3')
+    md_creator.add_reference('ijkl5678', 'path/to/\u00e4')
+    md_creator.write_references('md-references.jsonl')
+
+    with open(os.path.join(testpath, 'md-references.jsonl')) as in_file:
+        paths = [list(json.loads(line))[0] for line in in_file]
+    assert sorted(paths) == ['path/to/file1', 'path/to/file2',
+                             'path/to/file3', 'path/to/\u00e4']
+    assert not os.path.exists(
+        os.path.join(testpath, 'md-references.jsonl.tmp'))
+
+    created_references = read_md_references(testpath, 'md-references.jsonl')
+    assert created_references['path/to/file1']['md_ids'] == ['abcd1234']
+    assert created_references['path/to/file2'] == {
+        'path_type': 'file',
+        'md_ids': ['efgh5678'],
+        'streams': {'1': ['abcd5678']}}
+    assert sorted(created_references['path/to/\u00e4']['md_ids']) == [
+        'efgh1234', 'ijkl5678']
+
+
 def test_get_md_references():
     """Test get_md_references function. Reads the administrative MD IDs from
     a file.
@@ -160,6 +263,26 @@ def test_get_md_references():
     assert set(ids) == set(['abcd1234', 'efgh5678'])
 
 
+def test_get_md_references_streams():
+    """Test that get_md_references and get_objectlist find the streams of
+    a file.
+    """
+    references = {
+        'path/to/file': {
+            'path_type': 'file',
+            'md_ids': ['abcd1234'],
+            'streams': {'1': ['efgh5678'], '0': ['ijkl1234', 'mnop5678']}}}
+
+    assert get_objectlist(references) == ['path/to/file']
+    assert get_objectlist(references, 'path/to/file') == ['0', '1']
+    assert get_md_references(references, 'path/to/file', stream='0') == \
+        set(['ijkl1234', 'mnop5678'])
+    assert get_md_references(references, 'path/to/file', stream='2') == \
+        set()
+    assert get_md_references(references, 'path/to/other', stream='0') == \
+        set()
+
+
 def test_remove_dmdsec_references(testpath):
     """Tests the remove_dmdsec_references function."""
     refs = {
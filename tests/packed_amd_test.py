@@ -0,0 +1,107 @@
+"""Tests for the packed_amd module."""
+from __future__ import unicode_literals
+
+import os
+
+import lxml.etree
+
+from siptools import packed_amd
+from siptools.packed_amd import (INDEX_FILE, PackedAmdStore, amd_file_exists,
+                                 get_packed_amd, init_packed_amd,
+                                 parse_amd_file)
+
+
+def test_not_packed(testpath):
+    """Test that a workspace is not packed by default, and that the files
+    are then read from the workspace.
+    """
+    with open(os.path.join(testpath, 'a-amd.xml'), 'wb') as outfile:
+        outfile.write(b'<a/>')
+
+    assert get_packed_amd(testpath) is None
+    assert amd_file_exists(testpath, 'a-amd.xml')
+    assert not amd_file_exists(testpath, 'b-amd.xml')
+    assert parse_amd_file(testpath, 'a-amd.xml').getroot().tag == 'a'
+
+
+def test_write_read(testpath):
+    """Test that the files written to the store can be read, also after
+    the store is reopened, and that a rewritten file replaces the old
+    one.
+    """
+    init_packed_amd(testpath)
+    store = get_packed_amd(testpath)
+    store.write('a-amd.xml', b'<a/>')
+    store.write('b-amd.xml', b'<b/>')
+    store.write('a-amd.xml', b'<a><c/></a>')
+    assert get_packed_amd(testpath) is store
+
+    store = PackedAmdStore(testpath)
+    assert sorted(store.names()) == ['a-amd.xml', 'b-amd.xml']
+    assert store.read('b-amd.xml') == b'<b/>'
+    assert list(store.iter_files()) == [('b-amd.xml', b'<b/>'),
+                                        ('a-amd.xml', b'<a><c/></a>')]
+
+    assert amd_file_exists(testpath, 'a-amd.xml')
+    assert len(parse_amd_file(testpath, 'a-amd.xml').getroot()) == 1
+    assert 'a-amd.xml' not in os.listdir(testpath)
+
+
+def test_remove(testpath):
+    """Test that a removed file is not found in the store, also after the
+    store is reopened, and that it can be written again.
+    """
+    init_packed_amd(testpath)
+    store = get_packed_amd(testpath)
+    store.write('a-amd.xml', b'<a/>')
+    store.write('b-amd.xml', b'<b/>')
+    store.remove('a-amd.xml')
+    store.remove('c-amd.xml')
+    assert list(store.names()) == ['b-amd.xml']
+
+    store = PackedAmdStore(testpath)
+    assert list(store.names()) == ['b-amd.xml']
+    assert list(store.iter_files()) == [('b-amd.xml', b'<b/>')]
+    store.write('a-amd.xml', b'<a><c/></a>')
+    store.close()
+    assert PackedAmdStore(testpath).read('a-amd.xml') == b'<a><c/></a>'
+
+
+def test_segments(testpath, monkeypatch):
+    """Test that a new segment file is started when a segment is full."""
+    monkeypatch.setattr(packed_amd, 'MAX_SEGMENT_SIZE', 10)
+    init_packed_amd(testpath)
+    store = get_packed_amd(testpath)
+    for name in ['a', 'b', 'c']:
+        store.write(name, b'<%s>1</%s>' % (name.encode(), name.encode()))
+
+    assert sorted(name for name in os.listdir(testpath)
+                  if name.endswith('.seg')) == [
+                      'packed-amd-00000.seg', 'packed-amd-00001.seg',
+                      'packed-amd-00002.seg']
+    assert [lxml.etree.fromstring(data).tag
+            for (_, data) in PackedAmdStore(testpath).iter_files()] == [
+                'a', 'b', 'c']
+
+
+def test_changed_index(testpath):
+    """Test that the store is reloaded if the index is changed by some
+    other process, and that an incomplete index line is skipped.
+    """
+    init_packed_amd(testpath)
+    store = get_packed_amd(testpath)
+    store.write('a', b'<a/>')
+
+    other = PackedAmdStore(testpath)
+    other.write('b', b'<b/>')
+    other.close()
+    with open(os.path.join(testpath, INDEX_FILE), 'ab') as outfile:
+        outfile.write(b'{"name": "c", "seg')
+
+    store = get_packed_amd(testpath)
+    assert sorted(store.names()) == ['a', 'b']
+    store.write('d', b'<d/>')
+    assert sorted(PackedAmdStore(testpath).names()) == ['a', 'b', 'd']
+
+    os.remove(os.path.join(testpath, INDEX_FILE))
+    assert get_packed_amd(testpath) is None
@@ -0,0 +1,96 @@
+"""Tests for the scraper_cache module."""
+from __future__ import unicode_literals
+
+import io
+import os
+
+from siptools.scraper_cache import (ScraperCache, _encode_result,
+                                    file_identity)
+
+SCRAPED = ({0: {'index': 0, 'mimetype': 'text/plain', 'version': '(:unap)',
+                'stream_type': 'text', 'charset': 'UTF-8'}},
+           {0: {'class': 'TextfileScraper', 'messages': ['OK'],
+                'errors': [], 'tools': []}},
+           'fi-dpres-recommended-file-format',
+           [('MD5', 'd41d8cd98f00b204e9800998ecf8427e')])
+
+
+def _write_file(path, content):
+    """Write text content to a file."""
+    with io.open(path, 'wt') as outfile:
+        outfile.write(content)
+
+
+def test_cache_roundtrip(testpath):
+    """Test that a cached result is returned as it was stored, also
+    after the cache is reopened.
+    """
+    filepath = os.path.join(testpath, 'file.txt')
+    _write_file(filepath, 'content')
+    identity = file_identity(filepath)
+
+    cache = ScraperCache(testpath, {'option': 1})
+    assert cache.get(identity) is None
+    cache.put(identity, SCRAPED)
+    assert cache.get(identity) == SCRAPED
+    cache.close()
+
+    cache = ScraperCache(testpath, {'option': 1})
+    assert cache.get(identity) == SCRAPED
+    cache.close()
+
+
+def test_cache_options(testpath):
+    """Test that results scraped with different options are not
+    mixed.
+    """
+    filepath = os.path.join(testpath, 'file.txt')
+    _write_file(filepath, 'content')
+    identity = file_identity(filepath)
+
+    cache = ScraperCache(testpath, {'option': 1})
+    cache.put(identity, SCRAPED)
+    cache.close()
+
+    cache = ScraperCache(testpath, {'option': 2})
+    assert cache.get(identity) is None
+    cache.close()
+
+
+def test_cache_changed_file(testpath):
+    """Test that the cached result is not used if the file changes."""
+    filepath = os.path.join(testpath, 'file.txt')
+    _write_file(filepath, 'content')
+
+    cache = ScraperCache(testpath, {})
+    cache.put(file_identity(filepath), SCRAPED)
+
+    _write_file(filepath, 'changed content')
+    assert cache.get(file_identity(filepath)) is None
+    cache.close()
+
+
+def test_cache_eviction(testpath):
+    """Test that the least recently used results are evicted when the
+    cache grows too large.
+    """
+    identities = []
+    for index in range(3):
+        filepath = os.path.join(testpath, 'file%s.txt' % index)
+        _write_file(filepath, 'content')
+        identities.append(file_identity(filepath))
+
+    # Room for two results
+    cache = ScraperCache(testpath, {},
+                         max_size=2.5 * len(_encode_result(SCRAPED)))
+    cache.put(identities[0], SCRAPED)
+    cache.put(identities[1], SCRAPED)
+
+    # Use the first result, so that the second one is evicted
+    assert cache.get(identities[0]) == SCRAPED
+    cache.put(identities[2], SCRAPED)
+
+    assert cache.get(identities[0]) == SCRAPED
+    assert cache.get(identities[1]) is None
+    assert cache.get(identities[2]) == SCRAPED
+    cache.close()
@@ -164,6 +164,32 @@ def test_compile_mets_cleanup_ok(testpath, run_cli):
                       namespaces=NAMESPACES)[0].text == 'CSC'
 
 
+def test_clean_metsparts(testpath):
+    """Test that the cleanup removes the workspace files, but not the
+    copied digital objects with similar names.
+    """
+    os.makedirs(os.path.join(testpath, 'data'))
+    workspace_files = ['packed-amd-index.jsonl', 'packed-amd-00000.seg',
+                       'import-object-scraper-cache.db',
+                       'import-object-journal.jsonl',
+                       'premis-agent-identifiers.json']
+    object_files = ['data/packed-amd-00000.seg', 'data/video.seg',
+                    'packed-amd-index.jsonl.seg', 'data/results-cache.db',
+                    'data/import-object-scraper-cache.db',
+                    'data/agent-identifiers.json',
+                    'data/import-object-journal.jsonl']
+    for name in workspace_files + object_files:
+        with open(os.path.join(testpath, name), 'wb'):
+            pass
+
+    compile_mets.clean_metsparts(testpath)
+
+    for name in workspace_files:
+        assert not os.path.exists(os.path.join(testpath, name))
+    for name in object_files:
+        assert os.path.exists(os.path.join(testpath, name))
+
+
 def test_compile_mets_fail(testpath, run_cli):
     """
     Test that METS compilation terminates on failure.
@@ -180,3 +206,63 @@ def test_compile_mets_fail(testpath, run_cli):
                  '--workspace', testpath]
     result = run_cli(compile_mets.main, arguments, success=False)
     assert isinstance(result.exception, SystemExit)
+
+
+def _canonical(path):
+    """
+    Return the canonical form of an XML file, which does not depend on
+    the indentation or on where the namespaces are declared.
+
+    :path: Path of the XML file
+    :returns: Exclusive canonical XML as bytes
+    """
+    parser = ET.XMLParser(remove_blank_text=True)
+    return ET.tostring(ET.parse(path, parser), method='c14n', exclusive=True)
+
+
+def test_compile_mets_stream(testpath, run_cli):
+    """
+    Test that the streaming compilation results in the same METS
+    document as the normal compilation, apart from the indentation and
+    the namespace declarations.
+    """
+    create_test_data(testpath, run_cli)
+    arguments = ['ch',
+                 'CSC',
+                 'urn:uuid:89e92a4f-f0e4-4768-b785-4781d3299b20',
+                 '--objid', 'ABC-123',
+                 '--contentid', 'Aineisto-123',
+                 '--create_date', '2016-10-28T09:30:55',
+                 '--workspace', testpath]
+    output_file = os.path.join(testpath, 'mets.xml')
+
+    run_cli(compile_mets.main, arguments)
+    mets_data = _canonical(output_file)
+    os.remove(output_file)
+
+    run_cli(compile_mets.main, arguments + ['--stream'])
+    assert _canonical(output_file) == mets_data
+
+
+def test_compile_mets_workers(testpath, run_cli):
+    """
+    Test that METS compilation with several worker processes results in
+    the same METS document as compilation in one process.
+    """
+    create_test_data(testpath, run_cli)
+    arguments = ['ch',
+                 'CSC',
+                 'urn:uuid:89e92a4f-f0e4-4768-b785-4781d3299b20',
+                 '--objid', 'ABC-123',
+                 '--create_date', '2016-10-28T09:30:55',
+                 '--workspace', testpath]
+    output_file = os.path.join(testpath, 'mets.xml')
+
+    run_cli(compile_mets.main, arguments)
+    with open(output_file, 'rb') as infile:
+        mets_data = infile.read()
+    os.remove(output_file)
+
+    run_cli(compile_mets.main, arguments + ['--workers', '2'])
+    with open(output_file, 'rb') as infile:
+        assert infile.read() == mets_data
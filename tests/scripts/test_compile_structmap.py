@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import shutil
+import sys
 
 import file_scraper.scraper
 import lxml.etree
@@ -339,6 +340,60 @@ def test_get_fileid():
         filegrp, 'path/to/file name1', file_ids={}) == 'identifier1'
 
 
+def test_create_div_deep():
+    """Test that create_div creates the divs of a directory structure
+    that is deeper than the recursion limit, with the fptr elements
+    before the directory divs.
+    """
+    depth = sys.getrecursionlimit() + 100
+    directory = '/'.join(['dir'] * depth)
+    filelist = ['file1', directory + '/file2', directory + '/file3']
+    divs = compile_structmap.div_structure(filelist=filelist,
+                                           supplementary_files={},
+                                           supplementary_types=set(),
+                                           is_supplementary=False)
+    parent = mets.div(type_attr='directory')
+    compile_structmap.create_div(
+        divs=divs,
+        parent=parent,
+        filesec=None,
+        all_amd_refs={},
+        all_dmd_refs={},
+        file_ids=dict((path, 'id-%s' % path.split('/')[-1])
+                      for path in filelist),
+        structmap_type=None,
+        workspace='.',
+        file_properties=dict((path, None) for path in filelist))
+
+    assert [elem.tag for elem in parent] == [
+        '{%s}fptr' % NAMESPACES['mets'], '{%s}div' % NAMESPACES['mets']]
+    assert parent[0].get('FILEID') == 'id-file1'
+    fptrs = parent.findall('.//{%s}fptr' % NAMESPACES['mets'])
+    assert [fptr.get('FILEID') for fptr in fptrs] == [
+        'id-file1', 'id-file2', 'id-file3']
+    assert len(list(fptrs[1].iterancestors())) == depth + 1
+
+
+def test_get_file_ids():
+    """Test get_file_ids function.
+
+    Create a fileGrp element with few files and test that the IDs of all
+    files are returned by their decoded paths.
+    """
+    files = [mets.file_elem(file_id='identifier%s' % num,
+                            admid_elements=['foo', 'bar'],
+                            loctype='foo',
+                            xlink_href='file://path/to/%%C3%%A4+name%s' % num,
+                            xlink_type='foo') for num in range(3)]
+
+    filegrp = mets.filegrp(child_elements=files)
+
+    assert compile_structmap.get_file_ids(filegrp) == {
+        'path/to/\xe4 name0': 'identifier0',
+        'path/to/\xe4 name1': 'identifier1',
+        'path/to/\xe4 name2': 'identifier2'}
+
+
 @pytest.mark.parametrize(
     [
         'grade',
@@ -1,6 +1,7 @@
 """Tests the compile_structmap module with ead3 metadata."""
 from __future__ import unicode_literals
 
+import itertools
 import os
 import mets
 import pytest
@@ -8,8 +9,12 @@ import pytest
 import lxml.etree as ET
 import premis
 
-from siptools.utils import read_md_references, get_file_properties
-from siptools.ead_utils import add_fptrs_div_ead, collect_dao_hrefs
+import siptools.utils
+from siptools.utils import (get_file_properties, get_md_references,
+                            read_md_references)
+from siptools.ead_utils import (ALLOWED_C_SUBS, _create_structmap,
+                                add_fptrs_div_ead, collect_dao_hrefs,
+                                match_hrefs)
 from siptools.scripts import compile_structmap, import_object
 from siptools.xml.mets import NAMESPACES
 
@@ -142,6 +147,180 @@ def test_compile_structmap_ok(testpath, run_cli, path, daosets):
                                            'type EAD3-logical')
 
 
+EAD3_NESTED = """<ead xmlns="http://ead3.archivists.org/schema/">
+<archdesc level="fonds"><did/><dsc>
+<head>Contents</head>
+<c01 level="series"><did><dao href="/data/a.txt"/></did>
+  <c02 level="file"><did><dao href="data/b.txt"/>
+    <dao href="data/missing.txt"/><dao href="data/c.txt"/></did>
+    <c03 level="item"><did><dao href="d.txt"/></did></c03>
+    <c03 level="item"><did/></c03>
+  </c02>
+  <c02 level="file"/>
+</c01>
+<c level="file"><c level="item"><c><did><dao href="e.txt"/></did></c></c>
+  <c level="item"><did><dao href="data/a.txt"/></did></c></c>
+</dsc></archdesc></ead>"""
+
+EAD3_DAOSETS = """<ead xmlns="http://ead3.archivists.org/schema/">
+<archdesc level="fonds"><dsc>
+<c level="file"><did><dao href="data/a.txt"/>
+  <daoset label="First"><dao href="b.txt"/><dao href="c.txt" label="C"/>
+  </daoset>
+  <dao href="data/d.txt"/>
+  <daoset><dao href="e.txt"/></daoset></did>
+  <c level="item"><did><daoset label="Inner"><dao href="a.txt"/></daoset>
+  </did></c>
+</c>
+</dsc></archdesc></ead>"""
+
+EAD3_LABELS = """<ead xmlns="http://ead3.archivists.org/schema/">
+<archdesc otherlevel="collection" level="fonds"><dsc>
+<c label="Label" level="file"><did><dao href="a.txt"/></did></c>
+<c level="file" label="Label"><did><dao href="b.txt"/></did></c>
+<c otherlevel="other" level="file"/>
+<c level="file" otherlevel="other"/>
+<c level="item" otherlevel="other" label="Label"/>
+<c/>
+</dsc></archdesc></ead>"""
+
+EAD3_NESTED_DSC = """<ead xmlns="http://ead3.archivists.org/schema/">
+<archdesc level="fonds"><dsc>
+<c level="series"><did><dao href="data/a.txt"/></did>
+  <dsc><c level="nested"><did><dao href="data/b.txt"/></did></c></dsc>
+  <c level="file"/>
+</c>
+<c level="item"/>
+</dsc></archdesc></ead>"""
+
+
+def _recursive_structmap(dmdsec_loc, all_amd_refs, all_dmd_refs,
+                         **kwargs):
+    """Create the archdesc div of an EAD3 document recursively from the
+    parsed document, as before the document was read with iterparse.
+    """
+    root = ET.parse(dmdsec_loc).getroot()
+    labels = root.xpath('//ead3:archdesc/@otherlevel | '
+                        '//ead3:archdesc/@level', namespaces=NAMESPACES)
+    div_ead = mets.div(
+        type_attr='archdesc', label=labels[0] if labels else 'archdesc',
+        dmdid=get_md_references(all_dmd_refs, directory='.'),
+        admid=get_md_references(all_amd_refs, directory='.'))
+    kwargs['all_amd_refs'] = all_amd_refs
+    kwargs['href_paths'] = match_hrefs(
+        [href.lstrip('/') for href in root.xpath(
+            '//ead3:dao/@href', namespaces=NAMESPACES)],
+        kwargs['file_properties'])
+
+    if root.xpath('//ead3:archdesc/ead3:dsc', namespaces=NAMESPACES):
+        for elem in root.xpath('//ead3:dsc/*', namespaces=NAMESPACES):
+            if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
+                _recursive_c_div(elem, div_ead, **kwargs)
+    return div_ead
+
+
+def _recursive_c_div(parent, div, **kwargs):
+    """Create the div of an EAD3 c element recursively."""
+    c_div = mets.div(type_attr=ET.QName(parent.tag).localname,
+                     label=_recursive_label(parent))
+    for elem in parent.findall('./*'):
+        if ET.QName(elem.tag).localname in ALLOWED_C_SUBS:
+            _recursive_c_div(elem, c_div, **kwargs)
+    for elem in parent.xpath('./ead3:did/*', namespaces=NAMESPACES):
+        if ET.QName(elem.tag).localname == 'daoset':
+            c_div.append(add_fptrs_div_ead(
+                c_div=mets.div(type_attr='daoset',
+                               label=_recursive_label(elem)),
+                hrefs=collect_dao_hrefs(elem), **kwargs))
+    div.append(add_fptrs_div_ead(c_div=c_div,
+                                 hrefs=collect_dao_hrefs(parent), **kwargs))
+
+
+def _recursive_label(elem):
+    """Return the label of an element, as before the document was read
+    with iterparse.
+    """
+    labels = elem.xpath('./@label | ./@otherlevel | ./@level')
+    return labels[0] if labels else ET.QName(elem.tag).localname
+
+
+@pytest.mark.parametrize('ead3', [EAD3_NESTED, EAD3_DAOSETS, EAD3_LABELS],
+                         ids=('Nested c elements', 'Daosets',
+                              'Labels from several attributes'))
+def test_iterparse_structmap(testpath, monkeypatch, ead3):
+    """Test that the structMap divs and the fileGrp created by reading
+    the EAD3 document with iterparse are the same, in content and in
+    order, as with the recursive traversal of the parsed document.
+    """
+    dmdsec_loc = os.path.join(testpath, 'ead3.xml')
+    with open(dmdsec_loc, 'wb') as out_file:
+        out_file.write(ead3.encode('utf-8'))
+
+    paths = ['data/a.txt', 'data/b.txt', 'data/c.txt', 'data/d.txt',
+             'data/e.txt']
+    refs = {path: {'path_type': 'file', 'md_ids': ['_' + path],
+                   'streams': {}} for path in paths}
+    file_properties = {path: {'grade': 'fi-dpres-recommended-file-format',
+                              'supplementary': None}
+                       for path in paths}
+    file_properties['data/c.txt']['order'] = '2'
+    kwargs = {'all_amd_refs': refs,
+              'all_dmd_refs': {},
+              'object_refs': refs,
+              'file_properties': file_properties}
+
+    results = []
+    for create in ('iterparse', 'recursive'):
+        # File IDs from a counter, so that the results can be compared
+        counter = itertools.count()
+        monkeypatch.setattr(siptools.utils, 'uuid4',
+                            lambda: 'id%d' % next(counter))
+        filegrp = mets.filegrp()
+        if create == 'iterparse':
+            structmap = _create_structmap(
+                filegrp=filegrp, dmdsec_loc=dmdsec_loc,
+                structmap_type='EAD3-logical', workspace=testpath,
+                **kwargs)
+            div_ead = structmap.find('.//{%s}div[@TYPE="archdesc"]' %
+                                     NAMESPACES['mets'])
+        else:
+            div_ead = _recursive_structmap(dmdsec_loc, filegrp=filegrp,
+                                           **kwargs)
+        results.append((ET.tostring(div_ead), ET.tostring(filegrp)))
+
+    assert results[0] == results[1]
+    assert len(ET.fromstring(results[0][0]).xpath(
+        '//mets:div', namespaces=NAMESPACES)) > 3
+
+
+def test_iterparse_nested_dsc(testpath):
+    """Test that only the c elements directly under the top-level dsc
+    element get divs in the archdesc div, in the order of the document,
+    and that the c elements of a nested dsc element are skipped.
+    """
+    dmdsec_loc = os.path.join(testpath, 'ead3.xml')
+    with open(dmdsec_loc, 'wb') as out_file:
+        out_file.write(EAD3_NESTED_DSC.encode('utf-8'))
+
+    refs = {path: {'path_type': 'file', 'md_ids': ['_' + path],
+                   'streams': {}} for path in ['data/a.txt', 'data/b.txt']}
+    file_properties = {path: {'grade': 'fi-dpres-recommended-file-format',
+                              'supplementary': None} for path in refs}
+    structmap = _create_structmap(
+        filegrp=mets.filegrp(), dmdsec_loc=dmdsec_loc,
+        structmap_type='EAD3-logical', workspace=testpath,
+        all_amd_refs=refs, all_dmd_refs={}, object_refs=refs,
+        file_properties=file_properties)
+    div_ead = structmap.find('.//{%s}div[@TYPE="archdesc"]' %
+                             NAMESPACES['mets'])
+
+    assert [div.get('LABEL') for div in div_ead] == ['series', 'item']
+    assert [div.get('LABEL') for div in div_ead[0]
+            if div.get('TYPE') == 'c'] == ['file']
+    assert not structmap.xpath('//mets:div[@LABEL="nested"]',
+                               namespaces=NAMESPACES)
+
+
 def test_collect_dao_hrefs():
     """Tests that the function collect_dao_hrefs returns a list with
     hrefs without leading slashes from ead3 test data.
@@ -158,6 +337,31 @@ def test_collect_dao_hrefs():
     assert hrefs == [('file1.txt', None), ('file2.txt', None)]
 
 
+@pytest.mark.parametrize(
+    ('hrefs', 'expected'),
+    [(['koodi.java'], {'koodi.java': 'b/koodi.java'}),
+     (['a/publication.txt', 'publication'],
+      {'a/publication.txt': 'a/publication.txt',
+       'publication': 'a/publication.txt'}),
+     (['.txt', 'java'], {'.txt': 'a/publication.txt', 'java': 'b/koodi.java'}),
+     (['', 'fooo'], {'': 'a/publication.txt'})],
+    ids=('Basename of a path',
+         'First path that contains the href',
+         'Partial file names',
+         'Empty href and non-existing href')
+)
+def test_match_hrefs(hrefs, expected):
+    """Tests that match_hrefs finds the first path that contains each
+    href, as a plain substring search would.
+    """
+    paths = ['a/publication.txt', 'b/koodi.java', 'c/readme.txt',
+             'b/publication.txt']
+    assert match_hrefs(hrefs, paths) == expected
+    assert expected == {
+        href: next(path for path in paths if href in path)
+        for href in hrefs if any(href in path for path in paths)}
+
+
 @pytest.mark.parametrize(
     ('hrefs', 'length', 'child_elem', 'order'),
     [([('koodi.java', None)], 1, 'div', True),
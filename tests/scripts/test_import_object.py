@@ -3,7 +3,9 @@
 from __future__ import unicode_literals
 
 import datetime
+import hashlib
 import io
+import json
 import os.path
 
 import pytest
@@ -12,7 +14,9 @@ import six
 import lxml.etree as ET
 
 from siptools.scripts import import_object
-from siptools.utils import fsdecode_path, load_scraper_json, read_md_references
+from siptools.packed_amd import get_packed_amd
+from siptools.utils import (fsdecode_path, load_scraper_json,
+                            read_md_references, read_object_id)
 from siptools.xml.mets import NAMESPACES
 
 
@@ -181,6 +185,268 @@ def test_import_object_multiple(testpath, run_cli):
     assert count == expected_files
 
 
+def test_import_object_workers(testpath, run_cli):
+    """Test importing directory with several worker processes.
+
+    The result should be the same as when the files are scraped in the
+    main process.
+    """
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--workers', '2', 'tests/data/structured']
+    run_cli(import_object.main, arguments)
+
+    expected_files = 9
+
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == expected_files
+
+    count = 0
+    for filename in os.listdir(testpath):
+        if filename.endswith('-scraper.json'):
+            count += 1
+    assert count == expected_files
+
+
+def test_import_object_workers_cached(testpath, run_cli, monkeypatch):
+    """Test that the worker pool is not created, when all the files are
+    found in the cache.
+    """
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--workers', '2', 'tests/data/structured']
+    run_cli(import_object.main, arguments)
+
+    # pylint: disable=unused-argument
+    def _fail_pool(*args, **kwargs):
+        raise ValueError('Worker pool was created')
+
+    monkeypatch.setattr(import_object.multiprocessing, 'Pool', _fail_pool)
+    run_cli(import_object.main, arguments)
+
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 9
+
+
+def test_import_object_packed_amd(testpath, run_cli):
+    """Test that the administrative metadata of a packed workspace is
+    written to the packed store instead of separate files, and that it is
+    found there by the other scripts.
+    """
+    input_file = 'tests/data/structured/Documentation files/readme.txt'
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--packed_amd', input_file]
+    run_cli(import_object.main, arguments)
+
+    assert not [name for name in os.listdir(testpath)
+                if name.endswith('-amd.xml')]
+    names = list(get_packed_amd(testpath).names())
+    assert [name for name in names
+            if name.endswith('-PREMIS%3AOBJECT-amd.xml')]
+    assert [name for name in names
+            if name.endswith('-PREMIS%3AEVENT-amd.xml')]
+
+    identifier = read_object_id(input_file, testpath)
+    assert identifier[0] == 'UUID'
+
+
+@pytest.mark.parametrize('no_cache', [False, True])
+def test_import_object_cache(testpath, run_cli, monkeypatch, no_cache):
+    """Test that unchanged files are not scraped again, unless the cache
+    is disabled.
+    """
+    input_file = 'tests/data/structured/Documentation files/readme.txt'
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 input_file]
+    if no_cache:
+        arguments.append('--no_cache')
+    run_cli(import_object.main, arguments)
+
+    # pylint: disable=unused-argument
+    def _fail_scraping(*args, **kwargs):
+        raise ValueError('File was scraped again')
+
+    monkeypatch.setattr(import_object, 'scrape_file', _fail_scraping)
+    if no_cache:
+        with pytest.raises(ValueError, match='File was scraped again'):
+            run_cli(import_object.main, arguments)
+    else:
+        run_cli(import_object.main, arguments)
+
+    assert len(get_amd_file(testpath, input_file)) == 2 - no_cache
+
+
+def test_import_object_checkpoint(testpath, run_cli, monkeypatch):
+    """Test that an interrupted checkpointed run can be resumed.
+
+    The first run is interrupted when scraping the sixth file. The
+    metadata of the four files before the last checkpoint must be
+    written, and the restarted run must scrape only the remaining five
+    files.
+    """
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--no_cache', '--checkpoint_files', '2',
+                 'tests/data/structured']
+    original_scrape_file = import_object.scrape_file
+    scraped = []
+
+    def _scrape_file(**kwargs):
+        """Scrape file, but fail after five files."""
+        if len(scraped) == 5:
+            raise ValueError('Interrupted')
+        scraped.append(kwargs['filepath'])
+        return original_scrape_file(**kwargs)
+
+    monkeypatch.setattr(import_object, 'scrape_file', _scrape_file)
+    with pytest.raises(ValueError, match='Interrupted'):
+        run_cli(import_object.main, arguments)
+
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 4
+    assert os.path.isfile(os.path.join(testpath, import_object.JOURNAL_FILE))
+
+    del scraped[:]
+    run_cli(import_object.main, arguments)
+
+    assert len(scraped) == 5
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 9
+    assert not os.path.isfile(
+        os.path.join(testpath, import_object.JOURNAL_FILE))
+
+
+def test_import_object_checkpoint_written(testpath, run_cli, monkeypatch):
+    """Test that the files of a checkpoint are not imported again, if the
+    run is interrupted after their metadata has been written, but before
+    the checkpoint has been recorded as written.
+    """
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--no_cache', '--checkpoint_files', '2',
+                 'tests/data/structured']
+    original_commit = import_object.ImportJournal.commit
+    commits = []
+
+    def _commit(journal):
+        """Interrupt the run at the second checkpoint."""
+        commits.append(journal)
+        if len(commits) == 2:
+            raise ValueError('Interrupted')
+        original_commit(journal)
+
+    monkeypatch.setattr(import_object.ImportJournal, 'commit', _commit)
+    with pytest.raises(ValueError, match='Interrupted'):
+        run_cli(import_object.main, arguments)
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 4
+
+    original_scrape_file = import_object.scrape_file
+    scraped = []
+
+    def _scrape_file(**kwargs):
+        """Record the scraped files."""
+        scraped.append(kwargs['filepath'])
+        return original_scrape_file(**kwargs)
+
+    monkeypatch.setattr(import_object.ImportJournal, 'commit',
+                        original_commit)
+    monkeypatch.setattr(import_object, 'scrape_file', _scrape_file)
+    run_cli(import_object.main, arguments)
+
+    assert len(scraped) == 5
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 9
+    assert all(len(ref['md_ids']) == 1 for ref in refs.values())
+
+
+def test_import_journal(testpath):
+    """Test that the journal gives the files of the confirmed
+    checkpoints, and the files of an unconfirmed checkpoint whose
+    references have been written. The unreferenced PREMIS object files
+    of the unconfirmed checkpoint must be removed.
+    """
+    journal = import_object.ImportJournal(testpath, 'run-a',
+                                          checkpoint_files=2)
+    journal.add('base/a.txt', 'a.txt', [{'name': 'agent'}], 'grade-a')
+    assert not journal.checkpoint_due()
+    journal.add('base/b.txt', 'b.txt', [], 'grade-b')
+    assert journal.checkpoint_due()
+    journal.prepare()
+    journal.commit()
+    assert journal.paths == set(['base/a.txt', 'base/b.txt'])
+
+    # Interrupted after writing the metadata files of c.txt and d.txt,
+    # and the references of c.txt only
+    journal.add('base/c.txt', 'c.txt', [], 'grade-c')
+    journal.add('base/d.txt', 'd.txt', [], 'grade-d')
+    journal.prepare()
+    with open(os.path.join(testpath, 'import-object-md-references.jsonl'),
+              'wt') as out_file:
+        out_file.write(json.dumps({'c.txt': {'path_type': 'file',
+                                             'md_ids': ['_c'],
+                                             'streams': {}}}) + '\n')
+    metadata_files = ['c-PREMIS%3AOBJECT-amd.xml', 'c-scraper.json',
+                      'd-PREMIS%3AOBJECT-amd.xml', 'd-scraper.json',
+                      'e-PREMIS%3AEVENT-amd.xml']
+    for name in metadata_files:
+        with open(os.path.join(testpath, name), 'wb'):
+            pass
+
+    journal = import_object.ImportJournal(testpath, 'run-a',
+                                          checkpoint_files=2)
+    assert journal.paths == set(['base/a.txt', 'base/b.txt', 'base/c.txt'])
+    assert journal.agents == [{'name': 'agent'}]
+    assert journal.grade == 'grade-d'
+    assert sorted(name for name in os.listdir(testpath)
+                  if name in metadata_files) == [
+                      'c-PREMIS%3AOBJECT-amd.xml', 'c-scraper.json',
+                      'e-PREMIS%3AEVENT-amd.xml']
+
+    # The journal of some other run is not used or removed
+    with pytest.raises(ValueError, match='different file paths'):
+        import_object.ImportJournal(testpath, 'run-b', checkpoint_files=2)
+    import_object._remove_journal(testpath, 'run-b')
+    assert os.path.isfile(os.path.join(testpath, import_object.JOURNAL_FILE))
+
+    import_object._remove_journal(testpath, 'run-a')
+    assert not os.path.exists(
+        os.path.join(testpath, import_object.JOURNAL_FILE))
+
+
+def test_import_object_checkpoint_other_run(testpath, run_cli, monkeypatch):
+    """Test that the journal of an interrupted checkpointed run is not
+    used by a run with different file paths, and that it is kept until
+    the interrupted run is completed.
+    """
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--no_cache', '--checkpoint_files', '2']
+    original_scrape_file = import_object.scrape_file
+    scraped = []
+
+    def _scrape_file(**kwargs):
+        """Scrape file, but fail after three files."""
+        if len(scraped) == 3:
+            raise ValueError('Interrupted')
+        scraped.append(kwargs['filepath'])
+        return original_scrape_file(**kwargs)
+
+    monkeypatch.setattr(import_object, 'scrape_file', _scrape_file)
+    with pytest.raises(ValueError, match='Interrupted'):
+        run_cli(import_object.main,
+                arguments + ['tests/data/structured/Documentation files'])
+    monkeypatch.setattr(import_object, 'scrape_file', original_scrape_file)
+
+    other_file = 'tests/data/structured/Software files/koodi.java'
+    with pytest.raises(ValueError, match='different file paths'):
+        run_cli(import_object.main, arguments + [other_file])
+    run_cli(import_object.main, arguments[:-3] + [other_file])
+    assert os.path.isfile(os.path.join(testpath, import_object.JOURNAL_FILE))
+
+    run_cli(import_object.main,
+            arguments + ['tests/data/structured/Documentation files'])
+    refs = read_md_references(testpath, 'import-object-md-references.jsonl')
+    assert len(refs) == 6
+    assert not os.path.isfile(
+        os.path.join(testpath, import_object.JOURNAL_FILE))
+
+
 def test_import_object_order(testpath, run_cli):
     """Test file order."""
     input_file = 'tests/data/structured/Documentation files/readme.txt'
@@ -229,6 +495,42 @@ def test_import_object_identifier(testpath, run_cli):
 
 
 # pylint: disable=invalid-name
+def test_import_object_checksum_algorithms(testpath, run_cli):
+    """Test that a fixity element is created for each given checksum
+    algorithm.
+    """
+    input_file = 'tests/data/structured/Documentation files/readme.txt'
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--checksum_algorithms', 'md5,SHA512', input_file]
+    run_cli(import_object.main, arguments)
+
+    output = get_amd_file(testpath, input_file)
+    root = ET.parse(output[0]).getroot()
+
+    with open(input_file, 'rb') as infile:
+        content = infile.read()
+    expected = {'MD5': hashlib.md5(content).hexdigest(),
+                'SHA-512': hashlib.sha512(content).hexdigest()}
+
+    fixities = root.xpath('//premis:fixity', namespaces=NAMESPACES)
+    assert len(fixities) == 2
+    for fixity in fixities:
+        algorithm = fixity.xpath('./premis:messageDigestAlgorithm',
+                                 namespaces=NAMESPACES)[0].text
+        value = fixity.xpath('./premis:messageDigest',
+                             namespaces=NAMESPACES)[0].text
+        assert expected[algorithm] == value
+
+
+def test_import_object_invalid_checksum_algorithm(testpath, run_cli):
+    """Test that unsupported checksum algorithms are rejected."""
+    input_file = 'tests/data/structured/Documentation files/readme.txt'
+    arguments = ['--workspace', testpath, '--skip_wellformed_check',
+                 '--checksum_algorithms', 'md5,crc32', input_file]
+    with pytest.raises(ValueError, match='crc32'):
+        run_cli(import_object.main, arguments)
+
+
 def test_import_object_format_registry(testpath, run_cli):
     """Test digital object format registry argument."""
     input_file = 'tests/data/structured/Documentation files/readme.txt'
@@ -715,3 +1017,34 @@ def test_import_object_not_recognized(testpath, run_cli):
         = 'Proper scraper was not found. The file was not analyzed'
     with pytest.raises(ValueError, match=expected_error_message):
         run_cli(import_object.main, arguments)
+
+
+def test_collect_filepaths(testpath):
+    """Test that the file paths are collected lazily, sorted within
+    each directory with the files before the subdirectories, and that
+    missing paths and paths that are not files or directories are
+    reported before collecting any files.
+    """
+    for path in ['b/d/file', 'b/c/file', 'b/file2', 'b/file1', 'a/file']:
+        path = os.path.join(testpath, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'wt') as outfile:
+            outfile.write('content')
+
+    files = import_object.collect_filepaths(dirs=['b', 'a'], base=testpath)
+    assert not isinstance(files, list)
+    assert [os.path.relpath(path, testpath) for path in files] == [
+        'b/file1', 'b/file2', 'b/c/file', 'b/d/file', 'a/file']
+
+    files = import_object.collect_filepaths(dirs=['b'], pattern='*1',
+                                            base=testpath)
+    assert [os.path.relpath(path, testpath) for path in files] == ['b/file1']
+
+    with pytest.raises(IOError):
+        import_object.collect_filepaths(dirs=['b', 'missing'], base=testpath)
+
+    # A path that is neither a file nor a directory is not accepted
+    os.mkfifo(os.path.join(testpath, 'fifo'))
+    with pytest.raises(IOError):
+        import_object.collect_filepaths(dirs=['b', 'fifo'], base=testpath)
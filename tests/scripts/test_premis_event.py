@@ -246,6 +246,83 @@ def test_reuse_agent(testpath, run_cli):
     assert agent_identifiers[0] == agent_identifiers[1]
 
 
+def test_agent_index(testpath, run_cli):
+    """Test that the agent identifiers are stored in the agent index,
+    and that the index is rebuilt from the agent files if it is missing.
+    """
+    arguments = ['creation',
+                 '2016-10-13T12:30:55',
+                 '--event_detail', 'Testing',
+                 '--event_outcome', 'success',
+                 '--event_outcome_detail', 'Outcome detail',
+                 '--workspace', testpath,
+                 '--agent_name', 'Demo Application',
+                 '--agent_type', 'software']
+    run_cli(premis_event.main, arguments)
+
+    identifiers = premis_event.get_premis_agent_identifiers(testpath)
+    identifier = identifiers[('software', 'Demo Application')]
+    assert identifier[0] == 'UUID'
+
+    # The index is used without reading the agent files
+    for filename in os.listdir(testpath):
+        if filename.endswith('-PREMIS%3AAGENT-amd.xml'):
+            os.remove(os.path.join(testpath, filename))
+    assert premis_event.get_premis_agent_identifiers(testpath) == identifiers
+
+    # Without the index, the identifiers are read from the agent files,
+    # and the index is written again only when events are created
+    run_cli(premis_event.main, arguments)
+    os.remove(os.path.join(testpath, premis_event.AGENT_INDEX_FILE))
+    assert premis_event.get_premis_agent_identifiers(testpath) == identifiers
+    assert not os.path.exists(
+        os.path.join(testpath, premis_event.AGENT_INDEX_FILE))
+    run_cli(premis_event.main, arguments)
+    assert os.path.isfile(
+        os.path.join(testpath, premis_event.AGENT_INDEX_FILE))
+    assert premis_event.get_premis_agent_identifiers(testpath) == identifiers
+
+
+def test_premis_events(testpath):
+    """Test that a batch of events creates each event and agent once,
+    links them to all the targets, and reuses the agent between the
+    events.
+    """
+    targets = ('tests/data/structured/Software files',
+               'tests/data/structured/Documentation files/readme.txt')
+    premis_event.premis_events(
+        [{'event_type': 'creation',
+          'event_detail': 'Testing: act 1'},
+         {'event_type': 'validation',
+          'event_detail': 'Testing: act 2'}],
+        event_datetime='2016-10-13T12:30:55',
+        event_outcome='success',
+        event_outcome_detail='Outcome detail',
+        event_target=targets,
+        workspace=testpath,
+        agent_name='Demo Application',
+        agent_type='software')
+
+    filenames = os.listdir(testpath)
+    assert len([name for name in filenames
+                if name.endswith('-PREMIS%3AEVENT-amd.xml')]) == 2
+    assert len([name for name in filenames
+                if name.endswith('-PREMIS%3AAGENT-amd.xml')]) == 1
+
+    agent_identifiers = set()
+    for target in targets:
+        for event_type in ['creation', 'validation']:
+            event = ET.parse(get_md_file(testpath,
+                                         input_target=os.path.normpath(target),
+                                         event_type=event_type)).getroot()
+            agent_identifiers.add(event.find(
+                ".//premis:linkingAgentIdentifierValue",
+                namespaces=NAMESPACES).text)
+
+    # Both events link to the same agent
+    assert len(agent_identifiers) == 1
+
+
 @pytest.mark.parametrize(
     ("agent_identifier_type",
      "agent_identifier_value",
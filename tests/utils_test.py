@@ -2,8 +2,14 @@
 """Tests for the utility functions."""
 from __future__ import unicode_literals
 
+import copy
+import hashlib
+import json
+import os
+
 import pytest
 import lxml.etree
+import xml_helpers.utils
 from file_scraper.scraper import Scraper
 
 import siptools.utils as utils
@@ -37,6 +43,19 @@ def test_decode_path():
     assert decoded_path == 't\u00e4sts/t\u00f8stpath'
 
 
+@pytest.mark.parametrize('algorithm', ['md5', 'MD5', 'sha512'])
+def test_calc_checksum(algorithm, monkeypatch):
+    """Test that calc_checksum reads the whole file even if it is larger
+    than the read buffer.
+    """
+    monkeypatch.setattr(utils, 'CHECKSUM_BUFFER_SIZE', 10)
+    filepath = 'tests/data/csvfile.csv'
+    with open(filepath, 'rb') as infile:
+        expected = hashlib.new(algorithm.lower(), infile.read()).hexdigest()
+
+    assert utils.calc_checksum(filepath, algorithm) == expected
+
+
 def test_copy_etree():
     """Test that copy_etree creates a new lxml.etree
     instance with identical data.
@@ -110,6 +129,65 @@ def test_different_ids_same_hash():
     assert utils.generate_digest(xml1) == utils.generate_digest(xml2)
 
 
+def _previous_digest(etree):
+    """The previous implementation of generate_digest, which deep copies
+    the etree and resolves the path of every element.
+    """
+    root = copy.deepcopy(etree)
+    elem_tree = lxml.etree.ElementTree(root)
+    attrib_list = []
+
+    for name in ['eventIdentifierValue', 'agentIdentifierValue',
+                 'linkingAgentIdentifier']:
+        elem_tree = utils._remove_elements(elem_tree, name)
+
+    for element in root.iter():
+        attributes = element.attrib
+        path = elem_tree.getpath(element)
+        for key in attributes:
+            attribute = attributes.pop(key)
+            attrib_list.append('%s="%s" @ %s\n' % (key, attribute, path))
+
+    attrib_list.sort()
+    xml_data = xml_helpers.utils.serialize(root)
+    attr_data = b"".join([attr.encode("utf-8") for attr in attrib_list])
+    xml_data = b"".join([xml_data, attr_data])
+    return hashlib.md5(xml_data).hexdigest()
+
+
+@pytest.mark.parametrize('xml', [
+    '<root/>',
+    '<root a="1" b="2"><sub b="1" a="2">text</sub>tail<sub/></root>',
+    '<root xmlns:x="urn:x" x:a="\u00e4"><!-- comment --><x:sub x:b="1" '
+    'c="2"/><?pi data?><sub>\u00e4</sub></root>',
+    '<premis:event xmlns:premis="info:lc/xmlns/premis-v2">'
+    '<premis:eventIdentifier><premis:eventIdentifierType>a'
+    '</premis:eventIdentifierType><premis:eventIdentifierValue>b'
+    '</premis:eventIdentifierValue>123</premis:eventIdentifier>'
+    '<premis:linkingAgentIdentifier role="x"/>'
+    '<premis:eventDetail lang="fi">detail</premis:eventDetail>'
+    '</premis:event>',
+])
+def test_digest_compatibility(xml):
+    """Test that generate_digest gives the same digest as its previous
+    implementation, and that it does not modify the given etree.
+    """
+    root = lxml.etree.fromstring(xml)
+    serialized = lxml.etree.tostring(root)
+
+    assert utils.generate_digest(root) == _previous_digest(root)
+    assert lxml.etree.tostring(root) == serialized
+
+
+def test_digest_compatibility_file():
+    """Test that generate_digest gives the same digest as its previous
+    implementation for a larger document.
+    """
+    root = lxml.etree.parse(
+        "tests/data/sample_md-references.xml").getroot()
+    assert utils.generate_digest(root) == _previous_digest(root)
+
+
 def test_filescraper_error(monkeypatch):
     """Test that file scraper error works if message contains non-ascii
     characters.
@@ -128,3 +206,142 @@ def test_filescraper_error(monkeypatch):
 
     assert "ValueError" in error.typename
     assert message in str(error.value)
+
+
+def test_reference_context(testpath, monkeypatch):
+    """Test that ReferenceContext merges the administrative references
+    without modifying the references of import-object, and reads each
+    reference file only once.
+    """
+    references = {
+        'import-object-md-references.jsonl': {
+            'file.txt': {'path_type': 'file', 'md_ids': ['_object'],
+                         'streams': {'0': ['_stream']}}},
+        'create-mix-md-references.jsonl': {
+            'file.txt': {'path_type': 'file', 'md_ids': ['_mix'],
+                         'streams': {'0': ['_mixstream']}}}}
+    for (ref_file, refs) in references.items():
+        with open(os.path.join(testpath, ref_file), 'wt') as outfile:
+            outfile.write(json.dumps(refs) + '\n')
+    with open(os.path.join(testpath, 'object-scraper.json'), 'wt') as outfile:
+        json.dump({'0': {'index': 0, 'properties': {'order': '1'}}},
+                  outfile)
+
+    read_files = []
+    iter_md_references = utils.iter_md_references
+
+    def _iter_md_references(workspace, ref_file):
+        """Record the read reference files."""
+        read_files.append(ref_file)
+        return iter_md_references(workspace, ref_file)
+
+    monkeypatch.setattr(utils, 'iter_md_references', _iter_md_references)
+
+    context = utils.ReferenceContext(testpath)
+    (all_amd_refs, _, object_refs, filelist, file_properties) = \
+        utils.get_reference_lists(testpath, reference_context=context)
+
+    assert all_amd_refs['file.txt']['md_ids'] == ['_object', '_mix']
+    assert all_amd_refs['file.txt']['streams'] == {
+        '0': ['_stream', '_mixstream']}
+    assert object_refs == references['import-object-md-references.jsonl']
+    assert filelist == ['file.txt']
+    assert file_properties == {'file.txt': {'order': '1'}}
+
+    assert context.all_amd_references() is all_amd_refs
+    assert context.md_references('import-object-md-references.jsonl') \
+        is object_refs
+    assert sorted(read_files) == sorted(utils.AMD_REFERENCE_FILES)
+
+
+def test_read_all_amd_references(testpath):
+    """Test that the MD IDs of a path and its streams are merged from
+    all the reference files in order, each ID only once, that the
+    streams of directories may be a list, and that the references read
+    are not modified.
+    """
+    references = {
+        'import-object-md-references.jsonl': {
+            'file.txt': {'path_type': 'file', 'md_ids': ['_object'],
+                         'streams': {'0': ['_stream']}},
+            'other.txt': {'path_type': 'file', 'md_ids': ['_other'],
+                          'streams': {}},
+            '.': {'path_type': 'directory', 'md_ids': ['_root'],
+                  'streams': []}},
+        'create-videomd-md-references.jsonl': {
+            'file.txt': {'path_type': 'file', 'md_ids': ['_video'],
+                         'streams': {'0': ['_stream', '_video0'],
+                                     '1': ['_video1']}}},
+        'premis-event-md-references.jsonl': {
+            'file.txt': {'path_type': 'file',
+                         'md_ids': ['_event', '_object'],
+                         'streams': {}},
+            '.': {'path_type': 'directory', 'md_ids': ['_event'],
+                  'streams': []}}}
+    original = copy.deepcopy(references)
+    for (ref_file, refs) in references.items():
+        with open(os.path.join(testpath, ref_file), 'wt') as outfile:
+            for (path, reference) in refs.items():
+                outfile.write(json.dumps({path: reference}) + '\n')
+
+    for all_amd_refs in (
+            utils.read_all_amd_references(testpath),
+            utils.read_all_amd_references(
+                None,
+                read_references=lambda ref_file: references.get(
+                    ref_file, {}).items())):
+        assert all_amd_refs['file.txt']['md_ids'] == [
+            '_object', '_video', '_event']
+        assert all_amd_refs['file.txt']['streams'] == {
+            '0': ['_stream', '_video0'], '1': ['_video1']}
+        assert all_amd_refs['other.txt']['md_ids'] == ['_other']
+        assert all_amd_refs['.'] == {
+            'path_type': 'directory', 'md_ids': ['_root', '_event'],
+            'streams': {}}
+    assert references == original
+
+
+def test_div_node():
+    """Test that DivNode builds a tree of directories and files, where
+    each node knows its full path, and that equal names are stored only
+    once.
+    """
+    root = utils.DivNode()
+    names = {}
+    for path in ['a/subdir/file1', 'a/file2', 'c/subdir/file1']:
+        assert root.add_file(path, names=names).path == path
+
+    assert [node.name for node in root.iter_children()] == ['a', 'c']
+    dir_a = root.children['a']
+    assert (dir_a.path, dir_a.is_file) == ('a', False)
+    assert [(node.path, node.is_file) for node in dir_a.iter_children()] \
+        == [('a/subdir', False), ('a/file2', True)]
+    assert list(dir_a.children['file2'].iter_children()) == []
+
+    assert root.children['c'].children['subdir'].name is \
+        dir_a.children['subdir'].name
+
+
+def test_directory_references():
+    """Test that DirectoryReferences gives the administrative and
+    descriptive MD IDs of the directories, also of the directories
+    without references.
+    """
+    all_amd_refs = {
+        '.': {'path_type': 'directory', 'md_ids': ['_root']},
+        'dir': {'path_type': 'directory', 'md_ids': ['_dir']},
+        'dir/file.txt': {'path_type': 'file', 'md_ids': ['_file'],
+                         'streams': {}}}
+    all_dmd_refs = {
+        'dir': {'path_type': 'directory', 'md_ids': ['_dmd']}}
+
+    directory_references = utils.DirectoryReferences(all_amd_refs,
+                                                     all_dmd_refs)
+    assert sorted(directory_references) == ['.', 'dir']
+    assert directory_references['.'] == (set(['_root']), set())
+    assert directory_references['dir'] == (set(['_dir']), set(['_dmd']))
+    assert directory_references['other'] == (set(), set())
+    assert directory_references['dir/../dir/'] == directory_references['dir']
+
+    directory_references = utils.DirectoryReferences(all_amd_refs, None)
+    assert directory_references['dir'] == (set(['_dir']), None)